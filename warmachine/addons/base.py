@@ -1,12 +1,26 @@
 import asyncio
 import logging
 
+from ..utils.executors import ExecutorPool
+
 
 class WarMachinePlugin(object):
     def __init__(self, *args, **kwargs):
         self._loop = asyncio.get_event_loop()
         self.log = logging.getLogger(self.__class__.__name__)
         self.config_dir = kwargs.pop('config_dir', None)
+        # options from the [plugin:<ClassName>] config section
+        self.options = kwargs.pop('options', None) or {}
+        # handle on the bot's thread and process pools. See run_blocking and
+        # run_cpu
+        self.executor = kwargs.pop('executor', None) or \
+            ExecutorPool.default().for_plugin(self.__class__.__name__)
+        # :class:`warmachine.utils.history.HistoryStore` or None if the
+        # history is disabled
+        self.history = kwargs.pop('history', None)
+        # callable returning the bot's inbound queue, rate limit and executor
+        # statistics, or None when running outside the bot
+        self.bot_stats = kwargs.pop('stats', None)
 
     def recv_msg(self, *args, **kwargs):
         """
@@ -22,3 +36,23 @@ class WarMachinePlugin(object):
         """
         raise NotImplementedError('{} must implement `recv_msg` method'.format(
             self.__class__.__name__))
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """
+        Run a blocking function, such as one doing network or disk I/O, in the
+        bot's thread pool so it doesn't stall the event loop.
+
+        Returns:
+            the return value of ``func``
+        """
+        return await self.executor.run_blocking(func, *args, **kwargs)
+
+    async def run_cpu(self, func, *args, **kwargs):
+        """
+        Run a CPU heavy function in the bot's process pool. ``func`` and its
+        arguments must be picklable.
+
+        Returns:
+            the return value of ``func``
+        """
+        return await self.executor.run_cpu(func, *args, **kwargs)
@@ -0,0 +1,368 @@
+import asyncio
+import collections
+import re
+
+from .base import WarMachinePlugin
+from ..connections.message import Entity
+from ..connections.slack import SlackWS
+from ..utils.dispatch import BLOCK, DROP_OLDEST
+
+__class_name__ = 'ChannelBridge'
+
+#: IRC style addressing at the start of a line, e.g. ``nick: hello``
+IRC_ADDRESS_RE = re.compile(r'^([^\s:,]+)[:,](\s)')
+#: ``@nick`` anywhere in a line
+IRC_MENTION_RE = re.compile(r'(?<![\w<])@([^\s:,.!?]+)')
+
+
+class RateMeter(object):
+    """
+    Counts events per second over a sliding window.
+    """
+    __slots__ = ('window', 'buckets')
+
+    def __init__(self, window=60):
+        self.window = window
+        self.buckets = collections.deque()  # [second, count]
+
+    def add(self, now, n=1):
+        second = int(now)
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += n
+        else:
+            self.buckets.append([second, n])
+        self._trim(second)
+
+    def _trim(self, second):
+        while self.buckets and self.buckets[0][0] <= second - self.window:
+            self.buckets.popleft()
+
+    def rate(self, now):
+        """
+        Returns:
+            float: events per second over the window
+        """
+        self._trim(int(now))
+        return sum(c for _, c in self.buckets) / float(self.window)
+
+
+class BridgeDirection(object):
+    """
+    Carries messages from one channel to another.
+
+    Received messages wait in a bounded queue while a single task delivers
+    them, so a slow destination can only hold ``maxsize`` messages. Messages
+    that arrive close together are sent as one multi-line message.
+    """
+    def __init__(self, bridge, src, dst, maxsize=500, policy=DROP_OLDEST,
+                 batch_window=0.25, max_lines=20):
+        """
+        Args:
+            bridge (ChannelBridge): the plugin
+            src (tuple): (connection section name, channel)
+            dst (tuple): (connection section name, channel)
+            maxsize (int): the maximum number of queued messages
+            policy (str): ``block`` to make the source channel wait for room
+                or ``drop-oldest``
+            batch_window (float): seconds to wait for more messages to send
+                with the first
+            max_lines (int): the most messages sent together
+        """
+        if policy not in (BLOCK, DROP_OLDEST):
+            raise ValueError('Unknown bridge policy {}'.format(policy))
+
+        self._loop = asyncio.get_event_loop()
+        self.bridge = bridge
+        self.log = bridge.log
+
+        self.src = src
+        self.dst = dst
+        self.name = '{}{} -> {}{}'.format(src[0], src[1], dst[0], dst[1])
+
+        self.policy = policy
+        self.batch_window = batch_window
+        self.max_lines = max_lines
+
+        # (loop time received, source connection, sender, text, entities)
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self._task = None
+
+        # monitoring
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.batches = 0
+        self.lag_avg = 0.0
+        self.lag_max = 0.0
+        self.meter = RateMeter()
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def put(self, connection, message):
+        item = (self._loop.time(), connection, message.sender,
+                message.message, message.entities)
+        self.received += 1
+
+        if self.policy == BLOCK:
+            await self.queue.put(item)
+            return
+
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(item)
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+
+            deadline = self._loop.time() + self.batch_window
+            while len(batch) < self.max_lines:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            connection = await self.bridge.wait_for_connection(self.dst[0])
+            try:
+                text = await self.bridge.format_batch(batch, connection)
+                await connection.say(text, self.dst[1])
+            except Exception:
+                self.log.exception('Unable to bridge {} messages {}'.format(
+                    len(batch), self.name))
+                self.dropped += len(batch)
+                continue
+
+            now = self._loop.time()
+            for item in batch:
+                lag = now - item[0]
+                if not self.delivered:
+                    self.lag_avg = lag
+                self.lag_avg += (lag - self.lag_avg) * 0.1
+                self.lag_max = max(self.lag_max, lag)
+            self.delivered += len(batch)
+            self.batches += 1
+            self.meter.add(now, len(batch))
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'queued': self.queue.qsize(),
+            'batches': self.batches,
+            'rate_per_sec': round(self.meter.rate(self._loop.time()), 2),
+            'lag_avg_ms': round(self.lag_avg * 1000),
+            'lag_max_ms': round(self.lag_max * 1000),
+        }
+
+
+class ChannelBridge(WarMachinePlugin):
+    """
+    Mirror channels between connections, e.g. an IRC channel and a Slack
+    channel. The plugin must be used by both connections.
+
+    Bridges are configured in ``[plugin:ChannelBridge]``::
+
+        bridges=irc:freenode#warmachine=slack:myslack#general
+
+    Commands:
+        In a bridged channel:
+            !bridge-stats
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        maxsize = int(self.options.get('queue_size', 500))
+        policy = self.options.get('queue_policy', DROP_OLDEST)
+        batch_window = float(self.options.get('batch_window', 0.25))
+        max_lines = int(self.options.get('max_lines', 20))
+        # Messages from other bots are bridged unless this is false
+        self.bridge_bots = self.options.get('bridge_bots', 'true') == 'true'
+
+        # irc nick -> slack nick. Used for mentions in both directions
+        self.irc_to_slack = {}
+        for pair in self.options.get('nicks', '').split(','):
+            if '=' in pair:
+                irc_nick, slack_nick = pair.split('=', 1)
+                self.irc_to_slack[irc_nick.strip()] = slack_nick.strip()
+        self.slack_to_irc = {v: k for k, v in self.irc_to_slack.items()}
+
+        # (section, channel) -> list of BridgeDirection from that channel
+        self.routes = {}
+        for bridge in self.options.get('bridges', '').split(','):
+            if not bridge.strip():
+                continue
+            try:
+                a, b = (self.parse_end(e) for e in bridge.split('='))
+            except ValueError:
+                self.log.error('Invalid bridge: {}'.format(bridge))
+                continue
+
+            for src, dst in ((a, b), (b, a)):
+                # Only Slack takes several lines as one message. IRC sends a
+                # PRIVMSG per line, paced by the connection.
+                lines = max_lines if dst[0].startswith('slack') else 1
+                d = BridgeDirection(self, src, dst, maxsize=maxsize,
+                                    policy=policy, batch_window=batch_window,
+                                    max_lines=lines)
+                self.routes.setdefault(src, []).append(d)
+
+        # section name -> connected connection
+        self.connections = {}
+        self._connected = collections.defaultdict(asyncio.Event)
+
+    @classmethod
+    def parse_end(cls, end):
+        """
+        Split ``section#channel`` into its parts
+
+        Returns:
+            tuple: (section name, '#channel')
+        """
+        section, sep, channel = end.strip().partition('#')
+        if not section or not sep or not channel:
+            raise ValueError(end)
+        return section, '#' + channel
+
+    def directions(self):
+        for directions in self.routes.values():
+            yield from directions
+
+    def on_connect(self, connection):
+        section = connection.section_name
+        self.connections[section] = connection
+        self._connected[section].set()
+
+        for d in self.directions():
+            d.start()
+
+    def on_disconnect(self, connection):
+        section = connection.section_name
+        if self.connections.get(section) is connection:
+            del self.connections[section]
+            self._connected[section].clear()
+
+    async def wait_for_connection(self, section):
+        """
+        Wait until the connection for ``section`` is connected.
+        Messages for it stay queued meanwhile.
+        """
+        while section not in self.connections:
+            await self._connected[section].wait()
+        return self.connections[section]
+
+    def is_own_message(self, connection, message):
+        """
+        True if the bot itself sent ``message``, which is how bridged messages
+        would loop back.
+        """
+        if message.sender == getattr(connection, 'nick', None):
+            return True
+        return message.sender_id == getattr(connection, 'my_id', None)
+
+    async def recv_msg(self, connection, message):
+        if message.is_dm:
+            return
+
+        directions = self.routes.get(
+            (getattr(connection, 'section_name', None), message.channel))
+        if not directions:
+            return
+
+        if message.command == '!bridge-stats':
+            lines = ['{}: {}'.format(d.name, ', '.join(
+                '{}={}'.format(k, v) for k, v in d.stats().items()))
+                for d in directions]
+            await connection.say('\n'.join(lines), message.channel)
+            return
+
+        if self.is_own_message(connection, message) or \
+           (message.is_bot and not self.bridge_bots):
+            return
+
+        for d in directions:
+            await d.put(connection, message)
+
+    async def format_batch(self, batch, dst):
+        """
+        Format queued messages for the destination connection.
+
+        Returns:
+            str: the lines to send
+        """
+        lines = []
+        for _, src, sender, text, entities in batch:
+            if isinstance(src, SlackWS):
+                sender = self.slack_to_irc.get(sender, sender)
+                text = self.slack_to_text(text, entities)
+            else:
+                sender = self.irc_to_slack.get(sender, sender) \
+                    if isinstance(dst, SlackWS) else sender
+
+            if isinstance(dst, SlackWS):
+                text = self.text_to_slack(dst, text)
+                lines.extend('*{}*: {}'.format(sender, l)
+                             for l in text.split('\n'))
+            else:
+                lines.extend('<{}> {}'.format(sender, l)
+                             for l in text.split('\n') if l)
+
+        return '\n'.join(lines)
+
+    def slack_to_text(self, text, entities):
+        """
+        Use the IRC nicknames of the people mentioned in a Slack message. The
+        connection has already replaced the rest of Slack's markup.
+        """
+        parts = []
+        pos = 0
+        for e in entities:
+            if e.type != Entity.USER:
+                continue
+            parts.append(text[pos:e.start])
+            parts.append('@' + self.slack_to_irc.get(e.name, e.name))
+            pos = e.end
+        parts.append(text[pos:])
+        return ''.join(parts)
+
+    def text_to_slack(self, connection, text):
+        """
+        Escape text for Slack and turn mentions of nicknames known to the
+        connection into Slack mentions
+        """
+        text = text.replace('&', '&amp;').replace('<', '&lt;').replace(
+            '>', '&gt;')
+
+        def mention(nick):
+            nick = self.irc_to_slack.get(nick, nick)
+            user_id = connection.user_nick_to_id.get(nick)
+            return '<@{}>'.format(user_id) if user_id else None
+
+        def replace_address(m):
+            slack = mention(m.group(1))
+            return '{}:{}'.format(slack, m.group(2)) if slack else m.group(0)
+
+        def replace_mention(m):
+            return mention(m.group(1)) or m.group(0)
+
+        text = IRC_ADDRESS_RE.sub(replace_address, text)
+        return IRC_MENTION_RE.sub(replace_mention, text)
+
+    def stats(self):
+        return {d.name: d.stats() for d in self.directions()}
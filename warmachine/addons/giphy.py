@@ -10,8 +10,8 @@ __version__ = 1.0
 
 class GiphySearch(WarMachinePlugin):
     async def recv_msg(self, connection, message):
-        if message['message'].startswith('!giphy '):
-            search_terms = ' '.join(message['message'].split(' ')[1:])
+        if message.command == '!giphy' and message.args:
+            search_terms = ' '.join(message.args)
 
             self.log.debug('Searching giphy.com for: {}'.format(search_terms))
 
@@ -19,9 +19,9 @@ class GiphySearch(WarMachinePlugin):
                    'q={}&api_key=dc6zaTOxFJmzC&limit=1'.format(
                        search_terms.replace(' ', '%20')))
 
-            # TODO: This blocks
             req = urllib.request.Request(url)
-            data = urllib.request.urlopen(req).read().decode('utf-8')
+            data = await self.run_blocking(
+                lambda: urllib.request.urlopen(req).read().decode('utf-8'))
 
             data = json.loads(data)
             self.log.debug(data)
@@ -0,0 +1,58 @@
+from datetime import datetime
+
+from .base import WarMachinePlugin
+
+
+class HistorySearch(WarMachinePlugin):
+    """
+    Answers questions about what was said in a channel from the bot's in
+    memory history. The ``[history]`` section of the config must be enabled.
+
+    Commands:
+        In a channel:
+            !last [number of messages]
+            !search <words>
+            !said <user> <words>
+    """
+    MAX_RESULTS = 20
+
+    async def recv_msg(self, connection, message):
+        channel = message.channel
+        if not channel or not message.command or self.history is None:
+            return
+
+        cmd = message.command
+        parts = message.args
+
+        if cmd == '!last':
+            try:
+                n = int(parts[0]) if parts else 5
+            except ValueError:
+                n = 5
+            # Skip the !last command itself
+            results = self.history.last(
+                connection, channel, min(n, self.MAX_RESULTS) + 1)[1:]
+
+        elif cmd == '!search' and parts:
+            results = self.history.search(
+                connection, channel, ' '.join(parts), limit=self.MAX_RESULTS+1)
+            results = [r for r in results
+                       if not r['message'].startswith('!search')]
+
+        elif cmd == '!said' and parts:
+            results = self.history.search(
+                connection, channel, ' '.join(parts[1:]), sender=parts[0],
+                limit=self.MAX_RESULTS)
+
+        else:
+            return
+
+        if not results:
+            await connection.say('Nothing found', channel)
+            return
+
+        lines = ['[{}] <{}> {}'.format(
+            datetime.fromtimestamp(r['ts']).strftime('%H:%M'), r['sender'],
+            r['message']) for r in reversed(results[:self.MAX_RESULTS])]
+
+        await connection.say('\n'.join(lines), channel)
@@ -0,0 +1,398 @@
+import asyncio
+from collections import Counter
+from datetime import datetime
+import glob
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+from .base import WarMachinePlugin
+from ..connections.base import Connection
+
+__class_name__ = 'ProfilerPlugin'
+
+
+def frame_owner(frame):
+    """
+    Returns:
+        tuple: (plugin name, connection name) of the innermost plugin and
+            connection methods on the stack. Either may be None.
+    """
+    plugin = connection = None
+    while frame is not None and not (plugin and connection):
+        obj = frame.f_locals.get('self')
+        if obj is not None:
+            if plugin is None and isinstance(obj, WarMachinePlugin):
+                plugin = obj.__class__.__name__
+            elif connection is None and isinstance(obj, Connection):
+                connection = getattr(obj, 'section_name',
+                                     obj.__class__.__name__)
+        frame = frame.f_back
+    return plugin, connection
+
+
+def sample_thread(thread_id, seconds, interval):
+    """
+    Sample the stack of ``thread_id`` every ``interval`` seconds. This blocks
+    for ``seconds`` and is meant to run on another thread.
+
+    Returns:
+        dict: sample counts by ``function``, ``plugin`` and ``connection``
+            and the ``total`` number of samples. Samples where the thread was
+            waiting for I/O are counted as ``idle``
+    """
+    functions = Counter()
+    plugins = Counter()
+    connections = Counter()
+    idle = total = 0
+
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        time.sleep(interval)
+
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            break
+        total += 1
+
+        code = frame.f_code
+        if code.co_name in ('select', 'poll', 'epoll', 'kqueue') and \
+           'selectors' in code.co_filename:
+            idle += 1
+            continue
+
+        functions['{}:{} {}'.format(
+            code.co_filename, frame.f_lineno, code.co_name)] += 1
+
+        plugin, connection = frame_owner(frame)
+        plugins[plugin or '<none>'] += 1
+        connections[connection or '<none>'] += 1
+
+        del frame
+
+    return {
+        'total': total,
+        'idle': idle,
+        'functions': functions,
+        'plugins': plugins,
+        'connections': connections,
+    }
+
+
+def module_owner(traceback):
+    """
+    Attribute an allocation to the plugin or connection module that made it.
+    The innermost warmachine frame is used, so memory allocated by the
+    standard library on behalf of a plugin (e.g. ``json.loads``) is counted
+    against the plugin.
+    """
+    frames = list(traceback)
+    if sys.version_info >= (3, 7):
+        # frames are oldest first
+        frames.reverse()
+
+    for frame in frames:
+        parts = frame.filename.replace(os.sep, '/').split('/')
+        if 'warmachine' not in parts[:-1]:
+            continue
+        for kind in ('addons', 'connections', 'utils'):
+            if kind in parts[:-1]:
+                return '{}.{}'.format(kind, os.path.splitext(parts[-1])[0])
+        return 'warmachine'
+    return '<other>'
+
+
+class ProfilerPlugin(WarMachinePlugin):
+    """
+    Profile the running bot without restarting it. Reports are written to the
+    config directory.
+
+    Commands:
+        Direct Message (admins only):
+            !profile-cpu [seconds]
+            !profile-mem [seconds]
+            !profile-mem-stop
+            !profile-mem-diff <snapshot> <snapshot>
+            !profile-list
+            !profile-stats
+
+    Admins are Slack user ids or IRC nicks. Anyone can use an IRC nick that
+    isn't registered, so IRC admins should have nicks NickServ enforces.
+
+    ``SIGUSR1`` starts a CPU profile and ``SIGUSR2`` a memory profile for the
+    default number of seconds.
+    """
+    MAX_SECONDS = 600
+    TOP = 15
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.admins = [a.strip() for a in self.options.get(
+            'admins', '').split(',') if a.strip()]
+        self.seconds = int(self.options.get('seconds', 30))
+        self.interval = float(self.options.get('interval', 0.005))
+        # frames kept for each allocation when tracing memory
+        self.frames = int(self.options.get('frames', 10))
+        # Snapshot later memory profiles are compared to. Tracing keeps
+        # running between profiles so long lived allocations show up.
+        self.baseline = None
+        self.baseline_name = None
+        if self.options.get('trace_memory', 'false') == 'true' and \
+           not tracemalloc.is_tracing():
+            # from the start, so memory allocated while the bot starts up is
+            # traced too
+            tracemalloc.start(self.frames)
+
+        self.output_dir = self.config_dir or os.getcwd()
+        self.running = set()  # 'cpu' and/or 'mem' while profiling
+
+        try:
+            self._loop.add_signal_handler(
+                signal.SIGUSR1, self.on_signal, 'cpu')
+            self._loop.add_signal_handler(
+                signal.SIGUSR2, self.on_signal, 'mem')
+        except (NotImplementedError, AttributeError, RuntimeError):
+            self.log.debug('Profiling signals are not available')
+
+    def on_signal(self, kind):
+        self.log.info('Starting {} profile for {}s from a signal'.format(
+            kind, self.seconds))
+        if kind == 'cpu':
+            coro = self.profile_cpu(self.seconds)
+        else:
+            coro = self.profile_mem(self.seconds)
+        self._loop.create_task(coro)
+
+    async def recv_msg(self, connection, message):
+        cmd = message.command
+        if not cmd or not cmd.startswith('!profile') or not message.is_dm:
+            return
+
+        user = message.sender
+        # Matched on the id since Slack display names aren't unique and can
+        # be changed. On IRC the id is the nick.
+        if message.sender_id not in self.admins:
+            self.log.warning('{} ({}) is not allowed to use {}'.format(
+                user, message.sender_id, cmd))
+            return
+
+        parts = message.args
+
+        if cmd in ('!profile-cpu', '!profile-mem'):
+            try:
+                seconds = int(parts[0]) if parts else self.seconds
+            except ValueError:
+                await connection.say('Usage: {} [seconds]'.format(cmd), user)
+                return
+            seconds = max(1, min(seconds, self.MAX_SECONDS))
+
+            await connection.say('Profiling for {}s'.format(seconds), user)
+            if cmd == '!profile-cpu':
+                report = await self.profile_cpu(seconds)
+            else:
+                report = await self.profile_mem(seconds)
+            await connection.say(report, user)
+
+        elif cmd == '!profile-mem-stop':
+            await connection.say(self.stop_mem(), user)
+
+        elif cmd == '!profile-mem-diff' and len(parts) == 2:
+            try:
+                report = await self.run_blocking(self.diff_snapshots, *parts)
+            except (OSError, ValueError) as e:
+                report = 'Unable to compare snapshots: {}'.format(e)
+            await connection.say(report, user)
+
+        elif cmd == '!profile-stats':
+            await connection.say(self.format_stats(), user)
+
+        elif cmd == '!profile-list':
+            files = sorted(os.path.basename(f) for f in glob.glob(
+                os.path.join(self.output_dir, 'profile-*')))
+            await connection.say('\n'.join(files) or 'No profiles', user)
+
+    def _path(self, kind, ext):
+        return os.path.join(self.output_dir, 'profile-{}-{}.{}'.format(
+            kind, datetime.now().strftime('%Y%m%d-%H%M%S'), ext))
+
+    def _write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    async def profile_cpu(self, seconds):
+        """
+        Sample the event loop thread's stack for ``seconds`` and write a
+        report.
+
+        Returns:
+            str: a short summary of the report
+        """
+        if 'cpu' in self.running:
+            return 'A CPU profile is already running'
+        self.running.add('cpu')
+
+        try:
+            # called on the event loop's thread
+            result = await self.run_blocking(
+                sample_thread, threading.get_ident(), seconds, self.interval)
+        finally:
+            self.running.discard('cpu')
+
+        total = result['total'] or 1
+        busy = total - result['idle']
+
+        lines = ['CPU profile: {} samples over {}s, {:.1f}% busy'.format(
+            result['total'], seconds, 100.0 * busy / total)]
+        for title in ('plugins', 'connections', 'functions'):
+            lines.append('')
+            lines.append('By {}:'.format(title[:-1]))
+            for name, count in result[title].most_common(self.TOP):
+                lines.append('{:6.1f}%  {}'.format(100.0 * count / total,
+                                                    name))
+        report = '\n'.join(lines)
+
+        path = self._path('cpu', 'txt')
+        await self.run_blocking(self._write, path, report)
+        self.log.info('CPU profile written to {}'.format(path))
+
+        # the summary leaves out the function list
+        summary = report.split('\nBy function:')[0]
+        return '{}\nFull report: {}'.format(summary.strip(),
+                                            os.path.basename(path))
+
+    async def profile_mem(self, seconds):
+        """
+        Save a snapshot of the memory allocated since tracing started and
+        write a report of where it was allocated and how it grew since the
+        baseline.
+
+        If memory isn't being traced yet, tracing starts and the snapshot is
+        taken ``seconds`` later. Tracing then keeps running until
+        :meth:`stop_mem`. The first snapshot is the baseline the later ones
+        are compared to.
+
+        Returns:
+            str: a short summary of the report
+        """
+        if 'mem' in self.running:
+            return 'A memory profile is already running'
+        self.running.add('mem')
+
+        try:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                await asyncio.sleep(seconds)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            self.running.discard('mem')
+
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+
+        path = self._path('mem', 'snapshot')
+        await self.run_blocking(snapshot.dump, path)
+
+        owners = Counter()
+        for stat in snapshot.statistics('traceback'):
+            owners[module_owner(stat.traceback)] += stat.size
+
+        lines = ['Memory held since tracing started: {:.1f} KiB'.format(
+            sum(owners.values()) / 1024)]
+
+        growth = None
+        if self.baseline is None:
+            self.baseline = snapshot
+            self.baseline_name = os.path.basename(path)
+            lines.append('This is the baseline for later snapshots')
+        else:
+            growth = snapshot.compare_to(self.baseline, 'lineno')
+            lines.append('Growth since {}: {:+.1f} KiB'.format(
+                self.baseline_name, sum(s.size_diff for s in growth) / 1024))
+
+        lines.extend(['', 'By module:'])
+        for name, size in owners.most_common(self.TOP):
+            lines.append('{:10.1f} KiB  {}'.format(size / 1024, name))
+        lines.extend(['', 'By line:'])
+        for stat in snapshot.statistics('lineno')[:self.TOP]:
+            lines.append(str(stat))
+        if growth:
+            lines.extend(['', 'Growth by line:'])
+            lines.extend(str(s) for s in growth[:self.TOP])
+        report = '\n'.join(lines)
+
+        await self.run_blocking(self._write, path[:-len('snapshot')] + 'txt',
+                                report)
+        self.log.info('Memory snapshot written to {}'.format(path))
+
+        summary = report.split('\nBy line:')[0]
+        return '{}\nSnapshot: {}'.format(summary.strip(),
+                                         os.path.basename(path))
+
+    def stop_mem(self):
+        """
+        Stop tracing memory and forget the baseline
+
+        Returns:
+            str: what was done
+        """
+        self.baseline = None
+        self.baseline_name = None
+        if not tracemalloc.is_tracing():
+            return 'Memory is not being traced'
+        tracemalloc.stop()
+        return 'Stopped tracing memory'
+
+    def format_stats(self):
+        """
+        Returns:
+            str: the bot's inbound queue, rate limit and executor statistics
+        """
+        if self.bot_stats is None:
+            return 'Statistics are not available'
+
+        stats = self.bot_stats()
+        lines = []
+        for title, key in (('Inbound queues', 'queues'),
+                           ('Executors', 'executors')):
+            lines.append('{}:'.format(title))
+            for name, values in sorted(stats[key].items()):
+                lines.append('  {}: {}'.format(name, values))
+        lines.append('Rate limits: {}'.format(
+            stats['ratelimit'] or 'disabled'))
+        return '\n'.join(lines)
+
+    def diff_snapshots(self, old, new):
+        """
+        Compare two memory snapshots saved by :meth:`profile_mem`.
+
+        Args:
+            old (str): file name of the earlier snapshot
+            new (str): file name of the later snapshot
+
+        Returns:
+            str: the lines with the largest growth
+        """
+        snapshots = []
+        for name in (old, new):
+            # only files in the output directory may be read
+            path = os.path.join(self.output_dir, os.path.basename(name))
+            snapshots.append(tracemalloc.Snapshot.load(path))
+
+        stats = snapshots[1].compare_to(snapshots[0], 'lineno')
+
+        lines = ['Memory growth from {} to {}: {:+.1f} KiB'.format(
+            os.path.basename(old), os.path.basename(new),
+            sum(s.size_diff for s in stats) / 1024)]
+        lines.extend(str(s) for s in stats[:self.TOP])
+        report = '\n'.join(lines)
+
+        path = self._path('mem-diff', 'txt')
+        self._write(path, report)
+
+        return report
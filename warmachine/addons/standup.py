@@ -1,11 +1,16 @@
 import asyncio
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import functools
 import json
 import os
 from pprint import pformat
+import random
 
 from .base import WarMachinePlugin
+from ..utils.profiling import startup_profiler
+from ..utils.standup_archive import StandupArchive
+from ..utils.standup_state import StandupState
 
 
 class StandUpPlugin(WarMachinePlugin):
@@ -16,12 +21,18 @@ class StandUpPlugin(WarMachinePlugin):
         In a channel:
             !standup-add <24 hr time to kick off>
             !standup-remove
+            !standup-digest <seconds to collect replies for | off>
+            !standup-report [user] [days]
         Direct Message:
             !standup-ignore [users]
             !standup-schedules
             !standup-waiting_replies
     """
     SETTINGS_FILENAME = 'standup_schedules.json'
+    LAST_RUN_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+    ARCHIVE_DIRNAME = 'standup_archive'
+    REPORT_DAYS = 30
+    REPORT_MAX_LINES = 25
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -30,14 +41,50 @@ class StandUpPlugin(WarMachinePlugin):
         #     'time24': Original 24h time to schedule,
         #     'datetime': datetime object of when the next schedule will run,
         #     'ignoring': list of users to ignore when priv messaging,
+        #     'digest': seconds to collect replies for before posting them
+        #               together. 0 posts each reply on its own,
+        #     'connection_id': id of the connection the channel is on,
+        #     'last_run': datetime the last standup started or None,
         # }
         self.standup_schedules = {}
+        # Standups missed by at most this many seconds, e.g. while a standby
+        # instance took over, are run when the schedules are loaded
+        self.catch_up = int(self.options.get('catch_up', 15*60))
+
+        # Standups due within ``kickoff_merge`` seconds of each other on a
+        # connection are started together, so users in several of the
+        # channels are asked once. The questions are spread over
+        # ``kickoff_window`` seconds and at most ``kickoff_concurrency``
+        # channel member lists are fetched at once.
+        self.kickoff_merge = float(self.options.get('kickoff_merge', 1))
+        self.kickoff_window = float(self.options.get('kickoff_window', 60))
+        self.kickoff_concurrency = int(self.options.get(
+            'kickoff_concurrency', 4))
+        # connection id -> {
+        #     'channels': OrderedDict of the channels to start,
+        #     'handle': TimerHandle for starting them,
+        # }
+        self._kickoffs = {}
 
-        # 'DM_CHANNEL': {
-        #     'user': 'UID',
-        #     'for_channels': ['CHID',],
+        # 'CHANNEL': {
+        #     'replies': OrderedDict of user -> standup message,
+        #     'flush_f': TimerHandle for posting the collected replies,
+        #     'message_id': id of the digest message once it has been posted,
+        #     'posting': True while the digest message is being posted,
         # }
-        self.users_awaiting_reply = {}
+        self.digests = {}
+        self.default_digest = int(self.options.get('digest_window', 0))
+
+        # Users asked for their standup and their replies, indexed by user and
+        # channel. Replies are kept for 16 hours so later standups can reuse
+        # them, and channels stop waiting 8 hours after their standup starts.
+        self.users_awaiting_reply = StandupState(
+            reply_ttl=16*(60*60), channel_ttl=8*(60*60))
+
+        # 'CHANNEL': datetime the channel's last standup started
+        self.standup_started = {}
+        # connection id -> StandupArchive of every question and reply
+        self.archives = {}
         self.log.info('Loaded standup plugin')
 
         self.settings_file = os.path.join(
@@ -49,9 +96,46 @@ class StandUpPlugin(WarMachinePlugin):
             with open(self.settings_file, 'w') as f:
                 f.write('{}')
 
+    def now(self):
+        """
+        The current time. Everything in the plugin that needs the date or
+        time of day uses this so it can be run against a virtual clock.
+
+        Returns:
+            datetime: the current local time
+        """
+        return datetime.now()
+
     def on_connect(self, connection):
         self.load_schedule(connection)
 
+    def on_disconnect(self, connection):
+        """
+        Stop the standups scheduled for ``connection`` and forget the users
+        its channels were waiting on, cancelling their questions and pesters.
+        The saved schedules are kept so they are restored if the connection
+        comes back.
+        """
+        kickoff = self._kickoffs.pop(connection.id, None)
+        if kickoff:
+            kickoff['handle'].cancel()
+
+        channels = []
+        for channel in list(self.standup_schedules):
+            schedule = self.standup_schedules[channel]
+            if schedule.get('connection_id') == connection.id:
+                schedule['future'].cancel()
+                del self.standup_schedules[channel]
+                self.reset_digest(channel)
+                channels.append(channel)
+
+        # Their question and pester timers would message through the closed
+        # connection
+        forgotten = self.users_awaiting_reply.forget_channels(channels)
+        if forgotten:
+            self.log.debug('Forgot %s users waited on by %s', len(forgotten),
+                           connection.id)
+
     async def recv_msg(self, connection, message):
         """
         When the connection receives a message this method is called. We parse
@@ -59,54 +143,35 @@ class StandUpPlugin(WarMachinePlugin):
 
         Args:
             connection (Connection): the warmachine connection object
-            message (dict): the warmachine formatted message
+            message (Message): the warmachine formatted message
         """
-        if not message['message'].startswith('!standup') \
-           and not message['channel'] \
-           and message['sender'] in self.users_awaiting_reply:
-            self.log.debug("Probable standup reply recvd from {}: {}".format(
-                message['sender'], message['message']))
+        if not (message.command or '').startswith('!standup') \
+           and message.is_dm \
+           and message.sender in self.users_awaiting_reply:
+            self.log.debug('Probable standup reply recvd from %s: %s',
+                           message['sender'], message['message'])
 
             user_nick = message['sender']
-
-            data = self.users_awaiting_reply[user_nick]
-
-            for_channels = data['for_channels']
-
-            if 'pester_task' in data and data['pester_task']:
-                self.log.debug('Stopping pester for {}'.format(user_nick))
-                data['pester_task'].cancel()
-                data['pester_task'] = None
-
-            announce_message = '*@{}*: {}'.format(
-                user_nick,
-                message['message']
-            )
-
-            self.users_awaiting_reply[user_nick]['standup_msg'] = \
-                message['message']
-
-            f = self._loop.call_later(
-                16*(60*60),  # 16 hours
-                self.clear_old_standup_message_schedule_func, user_nick
-            )
-
-            self.users_awaiting_reply[user_nick]['clear_standup_msg_f'] = f
-
-            for i in range(0, len(for_channels)):
-                c = self.users_awaiting_reply[user_nick]['for_channels'].pop()
-                await connection.say(announce_message, c)
-
-            del data
-            # del self.users_awaiting_reply[user_nick]
+            # The reply is posted back on the same connection, so keep the
+            # connection's markup. Slack mentions stay links and its escaping
+            # is left intact.
+            standup_msg = message.raw_text
+
+            # Stops pestering the user and remembers the reply for later
+            # standups today
+            for_channels = self.users_awaiting_reply.set_reply(
+                user_nick, standup_msg)
+
+            for c in for_channels:
+                await self.announce(connection, c, user_nick, standup_msg)
             return
 
         # Otherwise parse for the commands:
 
-        cmd = message['message'].split(' ')[0]
-        parts = message['message'].split(' ')[1:]
-        channel = message['channel']
-        user_nick = message['sender']
+        cmd = message.command
+        parts = message.args
+        channel = message.channel
+        user_nick = message.sender
 
         # ======================================================================
         # !standup-add <24h time>
@@ -138,6 +203,70 @@ class StandUpPlugin(WarMachinePlugin):
                 self.save_schedule(connection)
                 self.log.info('Removed standup for channel {}'.format(channel))
 
+        # ======================================================================
+        # !standup-digest <seconds>
+        # !standup-digest off
+        #
+        # Collect replies for the given number of seconds and post them as a
+        # single message that is updated as late replies arrive.
+        # ======================================================================
+        elif cmd == '!standup-digest' and channel \
+             and channel in self.standup_schedules:  # noqa - indent level
+            if parts:
+                try:
+                    window = 0 if parts[0] == 'off' else int(parts[0])
+                except ValueError:
+                    await connection.say(
+                        'Usage: !standup-digest <seconds|off>', channel)
+                    return
+
+                self.standup_schedules[channel]['digest'] = window
+                self.save_schedule(connection)
+
+            window = self.standup_schedules[channel]['digest']
+            if window:
+                await connection.say(
+                    'Standup replies are collected for {}s and posted '
+                    'together'.format(window), channel)
+            else:
+                await connection.say('Standup replies are posted as they '
+                                     'arrive', channel)
+
+        # ======================================================================
+        # !standup-report [days]
+        # !standup-report <user> [days]
+        #
+        # Report how many standups were replied to, how long replies took and
+        # who is on a streak in this channel, or for one user in every
+        # channel.
+        # ======================================================================
+        elif cmd == '!standup-report' and channel:
+            user = None
+            if parts and not parts[0].isdigit():
+                user = parts.pop(0)
+            try:
+                days = int(parts[0]) if parts else self.REPORT_DAYS
+            except ValueError:
+                await connection.say('Usage: !standup-report [user] [days]',
+                                     channel)
+                return
+            days = max(1, min(days, 3650))
+
+            archive = self.get_archive(connection)
+            today = self.now().date()
+            # reading a long archive would stall the loop
+            if user:
+                report = await self.run_blocking(
+                    archive.user_report, user, days, today)
+                title = 'Standups for {}'.format(user)
+            else:
+                report = await self.run_blocking(
+                    archive.channel_report, channel, days, today)
+                title = 'Standups in {}'.format(channel)
+
+            await connection.say(self.format_report(
+                '{}, last {} days'.format(title, days), report), channel)
+
         # ======================================================================
         # !standup-ignore
         # !standup-ignore <space seperated list of users to ignore>
@@ -211,7 +340,7 @@ class StandUpPlugin(WarMachinePlugin):
             await connection.say(
                 'Current Loop Time: {}'.format(self._loop.time()), user_nick)
             await connection.say(
-                'Current Time: {}'.format(datetime.now()), user_nick)
+                'Current Time: {}'.format(self.now()), user_nick)
             await connection.say(pformat(self.standup_schedules), user_nick)
 
         # ======================================================================
@@ -226,9 +355,9 @@ class StandUpPlugin(WarMachinePlugin):
             await connection.say('Waiting for Replies From', user_nick)
             await connection.say('------------------------', user_nick)
             await connection.say(
-                pformat(self.users_awaiting_reply), user_nick)
+                pformat(self.users_awaiting_reply.as_dict()), user_nick)
 
-    def schedule_standup(self, connection, channel, time24h):
+    def schedule_standup(self, connection, channel, time24h, after=None):
         """
         Schedules a standup by creating a Task to be run in the future. This
         populates ``self.standup_schedules[channel]`` with the following keys:
@@ -243,11 +372,16 @@ class StandUpPlugin(WarMachinePlugin):
             connection (:class:`Connection`): the connection
             channel (str): channel name to schedule standup for
             time24h (str): The 24 hour time to start the standup at
+            after (datetime): schedule the first standup after this time.
+                Defaults to now
         """
-        next_standup = self.get_next_standup_secs(time24h)
+        now = self.now()
+        next_standup = self.get_next_standup_secs(
+            time24h, max(now, after) if after else now)
 
-        standup_td = next_standup - datetime.now()
-        next_standup_secs = standup_td.seconds
+        # total_seconds, not seconds, which drops the days when the next
+        # standup is after a weekend
+        next_standup_secs = (next_standup - now).total_seconds()
 
         f = self._loop.call_later(
             next_standup_secs, functools.partial(
@@ -266,6 +400,9 @@ class StandUpPlugin(WarMachinePlugin):
                 'datetime': next_standup,
                 'time24h': time24h,
                 'ignoring': [],
+                'digest': self.default_digest,
+                'connection_id': connection.id,
+                'last_run': None,
             }
 
         self.log.info('New schedule added to channel {} for {}'.format(
@@ -275,10 +412,19 @@ class StandUpPlugin(WarMachinePlugin):
         """
         Non-async function used to schedule the standup for a channel.
 
-        See :meth:`start_standup`
+        See :meth:`queue_kickoff`
         """
         self.log.info('Executing standup for channel {}'.format(channel))
-        asyncio.ensure_future(self.start_standup(connection, channel))
+
+        # Schedule the next one. The timer may fire a moment early, so make
+        # sure it's after the standup that is running now.
+        schedule = self.standup_schedules.get(channel)
+        if schedule:
+            self.schedule_standup(connection, channel, schedule['time24h'],
+                                  after=schedule['datetime'])
+            self.save_last_run(connection, schedule)
+
+        self.queue_kickoff(connection, channel)
 
     def pester_schedule_func(self, connection, user, channel, pester,
                              pester_count=0):
@@ -292,54 +438,150 @@ class StandUpPlugin(WarMachinePlugin):
         asyncio.ensure_future(self.standup_priv_msg(
             connection, user, channel, pester, pester_count))
 
-    def clear_old_standup_message_schedule_func(self, user):
+    def queue_kickoff(self, connection, channel):
+        """
+        Start ``channel``'s standup along with the other standups on the
+        connection due in the next ``kickoff_merge`` seconds.
+
+        See :meth:`start_standups`
         """
-        This function is scheduled to remove old standup messages so that the
-        user is asked for updates on the next standup.
+        kickoff = self._kickoffs.get(connection.id)
+        if kickoff is None:
+            kickoff = self._kickoffs[connection.id] = {
+                'channels': OrderedDict(),
+                'handle': self._loop.call_later(
+                    self.kickoff_merge, functools.partial(
+                        self.kickoff_schedule_func, connection)),
+            }
+        kickoff['channels'][channel] = True
+
+    def kickoff_schedule_func(self, connection):
+        """
+        Non-async function used to start the queued standups.
+
+        See :meth:`start_standups`
         """
-        self.log.info('Clearing old standup message for {}'.format(user))
-        del self.users_awaiting_reply[user]['clear_standup_msg_f']
-        del self.users_awaiting_reply[user]['standup_msg']
+        kickoff = self._kickoffs.pop(connection.id, None)
+        if kickoff:
+            asyncio.ensure_future(self.start_standups(
+                connection, list(kickoff['channels'])))
 
     async def start_standup(self, connection, channel):
         """
-        Notify the channel that the standup is about to begin, then loop
-        through all the users in the channel asking them report their standup.
+        Start the standup for a single channel. See :meth:`start_standups`
         """
-        users = connection.get_users_by_channel(channel)
-        self.log.debug('Users found in {}: {}'.format(channel, users))
-        if not users:
-            self.log.error('Unable to get_users_by_channel for channel '
-                           '{}. Skipping standup.'.format(channel))
-            return
-        await connection.say('@channel Time for standup', channel)
-
-        for u in users:
-            if u == connection.nick or \
-               u in self.standup_schedules[channel]['ignoring']:
-                # try:
-                #     users.remove(u)
-                # except ValueError:
-                #     pass
+        await self.start_standups(connection, [channel])
+
+    async def start_standups(self, connection, channels):
+        """
+        Notify the channels that their standups are about to begin, then ask
+        the users in them to report their standup. Users in more than one of
+        the channels are asked once, for all of them, and the questions are
+        spread over ``kickoff_window`` seconds.
+        """
+        lookups = asyncio.Semaphore(self.kickoff_concurrency)
+
+        async def get_users(channel):
+            async with lookups:
+                return await connection.get_users_by_channel(channel)
+
+        results = await asyncio.gather(*[get_users(c) for c in channels],
+                                       return_exceptions=True)
+
+        # user -> the first channel they are asked for
+        to_ask = OrderedDict()
+
+        for channel, users in zip(channels, results):
+            if isinstance(users, Exception):
+                self.log.error('Error getting the users in {}: {!r}'.format(
+                    channel, users))
+                users = None
+            self.log.debug('Users found in {}: {}'.format(channel, users))
+            if not users:
+                self.log.error('Unable to get_users_by_channel for channel '
+                               '{}. Skipping standup.'.format(channel))
                 continue
 
-            if u in self.users_awaiting_reply and \
-               'standup_msg' in self.users_awaiting_reply[u]:
-                await connection.say('*@{}*: {}'.format(
-                    u, self.users_awaiting_reply[u]['standup_msg']), channel)
-            else:
-                await self.standup_priv_msg(connection, u, channel)
+            schedule = self.standup_schedules.get(channel)
+            if schedule is None:
+                # removed while the users were looked up
+                continue
+
+            await connection.say('@channel Time for standup', channel)
+
+            # Start a new digest message for today's standup
+            self.reset_digest(channel)
+            self.standup_started[channel] = self.now()
+
+            for u in users:
+                if u == connection.nick or u in schedule['ignoring']:
+                    continue
 
-        # schedule a function to run in 12 hours to clear out this channel from
-        # self.users_awaiting_reply for all `users`.
-        # This is assuming that after 12 hours, nobody cares about the report
-        # from people who never reported earlier. It will prevent flooding
-        # "tomorrow's" response to channels whose standup is scheduled for
-        # later.
-        self._loop.call_later(8*(60*60),  # 8 hours
-                              self.clean_channel_from_waiting_replies, channel,
-                              users)
+                self.archive_asked(connection, channel, u)
 
+                reply = self.users_awaiting_reply.reply(u)
+                if reply is not None:
+                    await self.announce(connection, channel, u, reply)
+                    continue
+
+                self.users_awaiting_reply.wait_for(u, channel)
+                to_ask.setdefault(u, channel)
+
+            # Stop waiting on this channel's users after 8 hours. This is
+            # assuming that after that, nobody cares about the report from
+            # people who never reported earlier. It will prevent flooding
+            # "tomorrow's" response to channels whose standup is scheduled for
+            # later.
+            self.users_awaiting_reply.start_channel(channel)
+
+        self.schedule_questions(connection, to_ask)
+
+    def schedule_questions(self, connection, to_ask):
+        """
+        Schedule asking each user for their standup at a random time within
+        ``kickoff_window`` seconds. The window is split into a slot per user
+        so the questions are sent at an even rate.
+
+        Args:
+            connection (:class:`Connection`): the connection
+            to_ask (dict): user -> channel to ask them for. The question
+                lists every channel waiting on them
+        """
+        users = list(to_ask.items())
+        random.shuffle(users)
+
+        for i, (user, channel) in enumerate(users):
+            record = self.users_awaiting_reply.get(user)
+            # They are already being bothered about an earlier standup. The
+            # next pester lists these channels too.
+            if record is None or record.pester:
+                continue
+
+            delay = 0
+            if self.kickoff_window > 0:
+                delay = self.kickoff_window * (i + random.random()) / \
+                    len(users)
+
+            # Stored as the pester so a reply in the meantime cancels it
+            record.pester = self._loop.call_later(
+                delay, functools.partial(
+                    self.question_schedule_func, connection, user, channel))
+
+    def question_schedule_func(self, connection, user, channel):
+        """
+        Non-async function used to ask a user for their standup.
+
+        See :meth:`standup_priv_msg`
+        """
+        record = self.users_awaiting_reply.get(user)
+        if record is None:
+            return
+        record.pester = None
+        if record.channels:
+            # the channel may have stopped waiting since
+            channel = next(iter(record.channels))
+            asyncio.ensure_future(self.standup_priv_msg(
+                connection, user, channel))
 
     async def standup_priv_msg(self, connection, user, channel, pester=600,
                                pester_count=0):
@@ -358,33 +600,26 @@ class StandUpPlugin(WarMachinePlugin):
         """
         self.log.debug('Messaging user: {}'.format(user))
 
-        if user in self.users_awaiting_reply:
-            if 'standup_msg' in self.users_awaiting_reply[user]:
-                await connection.say('*@{}*: {}'.format(
-                    user, self.users_awaiting_reply[user]['standup_msg']
-                ), channel)
-
-                self.users_awaiting_reply[user]['pester_task'].cancel()
-                self.users_awaiting_reply[user]['pester_task'] = None
+        reply = self.users_awaiting_reply.reply(user)
+        if reply is not None:
+            await self.announce(connection, channel, user, reply)
+            return
 
+        if pester_count:
+            record = self.users_awaiting_reply.get(user)
+            # Every channel stopped waiting for them
+            if record is None or not record.channels:
                 return
-            # Don't readd an existing channel
-            if channel not in self.users_awaiting_reply[user]['for_channels']:
-                self.users_awaiting_reply[user]['for_channels'].append(channel)
         else:
             self.log.debug('Waiting user {} for a reply '.format(user))
-            self.users_awaiting_reply[user] = {
-                'for_channels': [channel, ],
-            }
+            record = self.users_awaiting_reply.wait_for(user, channel)
 
-        # They are already being bothered about it. It won't help to bother them
-        # for a different thing
-        if pester_count == 0 and \
-           'pester_task' in self.users_awaiting_reply[user] and \
-           self.users_awaiting_reply[user]['pester_task']:
-            return
+            # They are already being bothered about it. It won't help to
+            # bother them for a different thing
+            if record.pester:
+                return
 
-        for_channels = self.users_awaiting_reply[user]['for_channels']
+        for_channels = list(record.channels)
         await connection.say('What did you do yesterday? What will you '
                              'do today? do you have any blockers? '
                              '(standup for:{})'.format(
@@ -393,26 +628,199 @@ class StandUpPlugin(WarMachinePlugin):
         if pester > 0 and pester_count <= 2:
             self.log.info('Scheduling pester for {} {}m from now'.format(
                 user, pester/60))
-            f = self._loop.call_later(
+            record.pester = self._loop.call_later(
                 pester, functools.partial(
                     self.pester_schedule_func, connection, user, channel,
                     pester, pester_count+1))
-            self.users_awaiting_reply[user]['pester_task'] = f
+        else:
+            record.pester = None
+
+    async def announce(self, connection, channel, user, standup_msg):
+        """
+        Post ``user``'s standup message to ``channel``. If the channel uses a
+        digest the message is added to it instead.
+
+        Args:
+            connection (:class:`Connection`): the connection
+            channel (str): channel to post to
+            user (str): the user the standup message is from
+            standup_msg (str): the user's standup message
+        """
+        self.archive_reply(connection, channel, user, standup_msg)
+
+        schedule = self.standup_schedules.get(channel, {})
+        window = schedule.get('digest', 0)
+
+        if not window:
+            await connection.say('*@{}*: {}'.format(user, standup_msg),
+                                 channel)
+            return
+
+        digest = self.digests.setdefault(channel, {
+            'replies': OrderedDict(),
+            'flush_f': None,
+            'message_id': None,
+            'posting': False,
+        })
+        digest['replies'][user] = standup_msg
+
+        if not digest['flush_f']:
+            # Once the digest has been posted, late replies are added to it
+            # without waiting for a full window
+            delay = window if not digest['message_id'] else min(window, 5)
+            digest['flush_f'] = self._loop.call_later(
+                delay, self.digest_schedule_func, connection, channel)
+
+    def get_archive(self, connection):
+        """
+        Returns:
+            :class:`StandupArchive`: the standup archive for ``connection``
+        """
+        if connection.id not in self.archives:
+            self.archives[connection.id] = StandupArchive(os.path.join(
+                self.config_dir, self.ARCHIVE_DIRNAME, connection.id))
+        return self.archives[connection.id]
+
+    def archive_asked(self, connection, channel, user):
+        """
+        Record that ``user`` was asked for today's standup in ``channel``
+        """
+        started = self.standup_started[channel]
+        try:
+            self.get_archive(connection).asked(
+                started.date(), started.timestamp(), channel, user)
+        except OSError:
+            self.log.exception('Unable to archive standup question')
+
+    def archive_reply(self, connection, channel, user, standup_msg):
+        """
+        Record ``user``'s reply to the standup in ``channel``. Replies given
+        before the standup started, for an earlier standup, count as
+        immediate.
+        """
+        now = self.now()
+        started = self.standup_started.get(channel, now)
+        try:
+            self.get_archive(connection).replied(
+                started.date(), now.timestamp(), channel, user, standup_msg,
+                max(0.0, (now - started).total_seconds()))
+        except OSError:
+            self.log.exception('Unable to archive standup reply')
+
+    @classmethod
+    def format_duration(cls, seconds):
+        if seconds is None:
+            return '-'
+        if seconds < 60:
+            return '{:.0f}s'.format(seconds)
+        if seconds < 60 * 60:
+            return '{:.0f}m'.format(seconds / 60)
+        return '{:.1f}h'.format(seconds / (60 * 60))
+
+    def format_report(self, title, report):
+        """
+        Format a report from :class:`StandupArchive` for chat
+        """
+        if not report or not report['asked']:
+            return '{}: no standups'.format(title)
+
+        lines = [title, '{} standups, {}/{} replied ({:.0f}%), median reply '
+                 'after {} (p90 {})'.format(
+                     report['standups'], report['replied'], report['asked'],
+                     100.0 * report['replied'] / report['asked'],
+                     self.format_duration(report['latency_median']),
+                     self.format_duration(report['latency_p90']))]
+
+        groups = report['groups']
+        for g in groups[:self.REPORT_MAX_LINES]:
+            lines.append('{}: {}/{} ({:.0f}%), streak {} (best {}), '
+                         'avg reply after {}'.format(
+                             g['name'], g['replied'], g['asked'],
+                             100.0 * g['replied'] / g['asked'], g['streak'],
+                             g['best_streak'],
+                             self.format_duration(g['latency_avg'])))
+        if len(groups) > self.REPORT_MAX_LINES:
+            lines.append('and {} more'.format(
+                len(groups) - self.REPORT_MAX_LINES))
+
+        return '\n'.join(lines)
+
+    def digest_schedule_func(self, connection, channel):
+        """
+        Non-async function used to schedule posting a digest.
+
+        See :meth:`post_digest`
+        """
+        asyncio.ensure_future(self.post_digest(connection, channel))
+
+    async def post_digest(self, connection, channel):
+        """
+        Post the standup replies collected for ``channel`` as one message, or
+        update the message if it was already posted.
+        """
+        digest = self.digests.get(channel)
+        if not digest:
+            return
+
+        if digest.get('posting'):
+            # Wait for the first post to get its id so we don't post twice
+            digest['flush_f'] = self._loop.call_later(
+                1, self.digest_schedule_func, connection, channel)
+            return
+        digest['flush_f'] = None
+
+        text = '\n'.join(['*Standup*'] + [
+            '*@{}*: {}'.format(u, m) for u, m in digest['replies'].items()])
+
+        if digest['message_id']:
+            try:
+                await connection.edit(digest['message_id'], text, channel)
+                return
+            except NotImplementedError:
+                # Can't update it in place. Post the whole digest again
+                pass
+            except Exception:
+                self.log.exception('Unable to update standup digest for '
+                                   '{}'.format(channel))
+                return
+
+        digest['posting'] = True
+        try:
+            reply = await connection.say(text, channel)
+            if isinstance(reply, asyncio.Future):
+                reply = await reply
+        finally:
+            digest['posting'] = False
+
+        if reply and reply.get('ok', False):
+            digest['message_id'] = reply['ts']
+
+    def reset_digest(self, channel):
+        """
+        Forget the collected replies for ``channel`` so the next reply starts a
+        new digest message.
+        """
+        digest = self.digests.pop(channel, None)
+        if digest and digest['flush_f']:
+            digest['flush_f'].cancel()
 
     @classmethod
-    def get_next_standup_secs(cls, time24h):
+    def get_next_standup_secs(cls, time24h, now=None):
         """
         calculate the number of seconds until the next standup time
 
         Args:
             time24h (str): The 24 hour version of the time that the standup
             should run on Mon-Fri
+            now (datetime): the time to find the next standup after. Defaults
+                to now
 
         Returns:
             datetime: Datetime object representing the next datetime the
                 standup will begin
         """
-        now = datetime.now()
+        if now is None:
+            now = datetime.now()
 
         standup_hour, standup_minute = (int(s) for s in time24h.split(':'))
 
@@ -421,7 +829,7 @@ class StandUpPlugin(WarMachinePlugin):
 
         # If we've already past the time for today, schedule it for that time
         # on the next weekday
-        if now > next_standup or now.isoweekday() > 4:
+        if now >= next_standup or now.isoweekday() > 5:
             # if it's friday(5), wait 72 hours
             if now.isoweekday() == 5:
                 hours = 72
@@ -438,57 +846,93 @@ class StandUpPlugin(WarMachinePlugin):
 
         return next_standup
 
-    def clean_channel_from_waiting_replies(self, channel, users):
+    @classmethod
+    def get_previous_standup(cls, time24h, now):
         """
-        This clears ``channel`` from the list of interested channels for a
-        user's stand up, so that when the next stand up comes and they answer,
-        the other channels won't recieve information they are most likely not
-        interested in anymore
-
-        Args:
-            channel (str): The channel to clear out
-            users (list): List of users to check for
+        Returns:
+            datetime: the most recent time at or before ``now`` that a standup
+                at ``time24h`` on Mon-Fri was due
+        """
+        standup_hour, standup_minute = (int(s) for s in time24h.split(':'))
+        previous = now.replace(hour=standup_hour, minute=standup_minute,
+                               second=0, microsecond=0)
+        if previous > now:
+            previous -= timedelta(days=1)
+        while previous.isoweekday() > 5:
+            previous -= timedelta(days=1)
+        return previous
+
+    def catch_up_standup(self, connection, channel):
+        """
+        Run ``channel``'s standup now if it was due in the last ``catch_up``
+        seconds and hasn't run, e.g. because the bot was down or a standby
+        instance was taking over.
         """
-        for u in users:
-            if u in self.users_awaiting_reply:
-                self.log.info('Clearing channel {} from list of waiting '
-                              'channels for user {}'.format(channel, u))
+        schedule = self.standup_schedules[channel]
+        if not self.catch_up or not schedule.get('last_run'):
+            return
 
-                try:
-                    self.users_awaiting_reply[u]['for_channels'].remove(channel)
-                except ValueError as e:
-                   pass
-
-                # if that was the last channel, kill any pester tasks
-                if not self.users_awaiting_reply[u]['for_channels'] and \
-                   self.users_awaiting_reply[u]['pester_task']:
-                    self.log.info('No more interested channels for {}. '
-                                  'Cancelling pester.'.format(u))
-                    self.users_awaiting_reply[u]['pester_task'].cancel()
-                    del self.users_awaiting_reply[u]['pester_task']
+        now = self.now()
+        due = self.get_previous_standup(schedule['time24h'], now)
+        if schedule['last_run'] >= due or \
+           (now - due).total_seconds() > self.catch_up:
+            return
+
+        self.log.info('Running the standup for {} missed at {}'.format(
+            channel, due))
+        self.save_last_run(connection, schedule, now)
+        self.queue_kickoff(connection, channel)
 
     def save_schedule(self, connection):
         """
         Save all channel schedules to a file.
         """
-        keys_to_save = ['time24h', 'ignoring']
+        keys_to_save = ['time24h', 'ignoring', 'digest']
         data = {}
-        for channel in self.standup_schedules:
+        for channel, schedule in self.standup_schedules.items():
+            if schedule.get('connection_id', connection.id) != connection.id:
+                continue
             data[channel] = {}
             for key in keys_to_save:
-                data[channel][key] = self.standup_schedules[channel][key]
-
-        data = {connection.id: data}
-        with open(self.settings_file, 'w') as f:
-            f.write(json.dumps(data))
+                data[channel][key] = schedule[key]
+            if schedule.get('last_run'):
+                data[channel]['last_run'] = schedule['last_run'].strftime(
+                    self.LAST_RUN_FORMAT)
+
+        # Keep the schedules of the other connections
+        try:
+            with open(self.settings_file, 'r') as f:
+                saved = json.loads(f.read())
+        except (OSError, ValueError):
+            saved = {}
+        saved[connection.id] = data
+
+        # Replaced in one step so an instance taking over after a crash never
+        # reads half a file
+        tmp_file = self.settings_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(json.dumps(saved))
+        os.replace(tmp_file, self.settings_file)
 
         self.log.info('Schedules saved to disk')
 
+    def save_last_run(self, connection, schedule, when=None):
+        """
+        Record that a standup is starting and save the schedules at once, so
+        an instance taking over after a crash knows it ran.
+        """
+        schedule['last_run'] = when or self.now()
+        try:
+            self.save_schedule(connection)
+        except OSError as e:
+            self.log.error('Unable to save the schedules: {}'.format(e))
+
     def load_schedule(self, connection):
         """
         Load the channel schedules from a file.
         """
-        with open(self.settings_file, 'r') as f:
+        with startup_profiler.measure('snapshot standup_schedules'), \
+                open(self.settings_file, 'r') as f:
             try:
                 data = json.loads(f.read())
             except Exception as e:
@@ -508,3 +952,18 @@ class StandUpPlugin(WarMachinePlugin):
                     data[connection.id][channel]['ignoring']
             except KeyError:
                 pass
+
+            try:
+                self.standup_schedules[channel]['digest'] = \
+                    data[connection.id][channel]['digest']
+            except KeyError:
+                pass
+
+            try:
+                self.standup_schedules[channel]['last_run'] = \
+                    datetime.strptime(data[connection.id][channel]['last_run'],
+                                      self.LAST_RUN_FORMAT)
+            except (KeyError, ValueError):
+                pass
+
+            self.catch_up_standup(connection, channel)
@@ -1,5 +1,11 @@
 import configparser
 
+#: Plugins loaded when the config does not have a ``[plugins]`` section
+DEFAULT_PLUGINS = [
+    'warmachine.addons.giphy.GiphySearch',
+    'warmachine.addons.standup.StandUpPlugin',
+]
+
 
 class Config(configparser.ConfigParser):
     def __init__(self, config_path=None):
@@ -18,3 +24,60 @@ class Config(configparser.ConfigParser):
         d = dict(self.items(section))
         d['section_name'] = section
         return d
+
+    def get_list(self, section, option, fallback=None):
+        """
+        Read a comma or newline separated option as a list.
+
+        Args:
+            section (str): config section to look in
+            option (str): option name to read
+            fallback (list): returned when the option is not defined
+
+        Returns:
+            list: the non-empty values of the option
+        """
+        if not self.has_option(section, option):
+            return fallback
+
+        value = self.get(section, option)
+        return [v.strip() for v in value.replace('\n', ',').split(',')
+                if v.strip()]
+
+    def plugins(self, section=None):
+        """
+        Returns the class paths of the plugins to load. A connection section
+        may define its own ``plugins`` option to override the list given in
+        the ``[plugins]`` section.
+
+        Args:
+            section (str): connection section name or None for the bot wide
+                list
+
+        Returns:
+            list: class paths of the plugins to load
+        """
+        plugins = self.get_list('plugins', 'load', fallback=DEFAULT_PLUGINS)
+
+        if section:
+            plugins = self.get_list(section, 'plugins', fallback=plugins)
+
+        return plugins
+
+    def plugin_options(self, class_path):
+        """
+        Returns the options defined in the ``[plugin:<ClassName>]`` section
+        for a plugin.
+
+        Args:
+            class_path (str): full class path of the plugin
+
+        Returns:
+            dict: plugin options. Empty if there is no section for the plugin
+        """
+        section = 'plugin:{}'.format(class_path.rsplit('.', 1)[-1])
+
+        if not self.has_section(section):
+            return {}
+
+        return self.options_as_dict(section)
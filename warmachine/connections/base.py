@@ -1,3 +1,7 @@
+import asyncio
+import collections
+import logging
+
 INITALIZED = 'Initalized'
 CONNECTED = 'Connected'
 CONNECTING = 'Connecting'
@@ -6,6 +10,14 @@ CONNECTING = 'Connecting'
 class Connection(object):
     def __init__(self):
         self.config_dir = None
+        # options from this connection's config section
+        self.options = {}
+        # read started by read_batch that didn't finish within max_wait. It
+        # is finished by the next call instead of being cancelled, so nothing
+        # read from the server is lost.
+        self._pending_read = None
+        # messages read by read_batch waiting for __anext__
+        self._batch = collections.deque()
 
     def connect(self, *args, **kwargs):
         """
@@ -15,21 +27,128 @@ class Connection(object):
         raise NotImplementedError('{} must implement `connect` method'.format(
             self.__class__.__name__))
 
+    def disconnect(self):
+        """
+        Async method called when the connection is removed from the bot. It
+        should close the connection without reconnecting.
+        """
+        raise NotImplementedError('{} must implement `disconnect` '
+                                  'method'.format(self.__class__.__name__))
+
     def read(self):
         """
-        Dictionary of data in the following format:
-        {
-          'sender': 'username/id',
-          'channel': 'channel name' or None,
-          'message': 'actual message',
-        }
+        Read the next message from the server.
 
         Returns:
-            dict: Data from the connection that the bot should consider.
+            :class:`warmachine.connections.message.Message`: Data from the
+                connection that the bot should consider, or None
         """
         raise NotImplementedError('{} must implement `read` method'.format(
             self.__class__.__name__))
 
+    def pending(self):
+        """
+        Number of frames already received from the server that :meth:`read`
+        can return without waiting. Connections that buffer what they receive
+        override this so :meth:`read_batch` can drain the buffer.
+
+        Returns:
+            int: number of buffered frames
+        """
+        return 0
+
+    async def read_batch(self, max_n=100, max_wait=0):
+        """
+        Wait for a message, then keep reading the messages already received
+        from the server, up to ``max_n``. Frames that aren't messages for the
+        plugins, such as acknowledgements and pings, are handled and left out.
+
+        Args:
+            max_n (int): most messages to return
+            max_wait (float): seconds to keep waiting for more messages once
+                the buffer is empty. 0 returns as soon as it is
+
+        Returns:
+            list: :class:`warmachine.connections.message.Message` objects.
+                Never empty
+        """
+        loop = asyncio.get_event_loop()
+        batch = []
+        deadline = None
+        # reads in a row that returned nothing while the batch was empty
+        misses = 0
+
+        if self._pending_read is not None:
+            task, self._pending_read = self._pending_read, None
+            try:
+                message = await task
+            except Exception:
+                self._log_read_error()
+                message = None
+            if message:
+                batch.append(message)
+
+        while len(batch) < max_n:
+            if not batch or self.pending():
+                message = await self._read_safe()
+            elif max_wait > 0:
+                if deadline is None:
+                    deadline = loop.time() + max_wait
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                task = asyncio.ensure_future(self._read_safe())
+                done, _ = await asyncio.wait([task], timeout=timeout)
+                if not done:
+                    self._pending_read = task
+                    break
+                message = task.result()
+            else:
+                break
+
+            if message:
+                batch.append(message)
+            elif not batch:
+                # A read may return at once without a message, e.g. while the
+                # connection is down. Yield so it can't starve the rest of the
+                # loop, and back off once nothing is buffered.
+                misses += 1
+                await asyncio.sleep(
+                    0.1 if misses >= 10 and not self.pending() else 0)
+
+        return batch
+
+    async def _read_safe(self):
+        """
+        :meth:`read`, logging and skipping a frame that can't be handled
+        instead of losing the rest of the batch
+        """
+        try:
+            return await self.read()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._log_read_error()
+
+    def _log_read_error(self):
+        logging.getLogger(self.__class__.__name__).exception(
+            'Error reading from the connection')
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """
+        Iterate over the messages from the connection::
+
+            async for message in connection:
+                ...
+        """
+        if not self._batch:
+            self._batch.extend(await self.read_batch())
+        return self._batch.popleft()
+
     def id(self):
         """
         Unique ID for this connection. Since there can be more than one
@@ -49,3 +168,41 @@ class Connection(object):
         """
         raise NotImplementedError('{} must implement `say` method'.format(
             self.__class__.__name__))
+
+    def edit(self, message_id, message, destination):
+        """
+        Async method that replaces the text of a message that was already sent.
+        Connections that can't edit messages raise ``NotImplementedError``.
+
+        Args:
+            message_id (str): id of the message to edit as returned by the
+                server when it was sent
+            message (str): the new text
+            destination (str): the channel the message was sent to
+        """
+        raise NotImplementedError('{} must implement `edit` method'.format(
+            self.__class__.__name__))
+
+    async def builtin_command(self, message):
+        """
+        Handle the connection's own commands, e.g. ``!whois``. Called for
+        every message after rate limiting, before the plugins see it.
+
+        Returns:
+            bool: True if ``message`` was handled and should not be passed to
+                the plugins
+        """
+        return False
+
+    def user_record(self, user_id):
+        """
+        Returns the connection's information about a user. Used by
+        :attr:`warmachine.connections.message.Message.user`.
+
+        Args:
+            user_id (str): the connection's id for the user
+
+        Returns:
+            dict: information about the user or None
+        """
+        return None
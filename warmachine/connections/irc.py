@@ -1,27 +1,55 @@
 import asyncio
+import collections
 import logging
+import ssl
 
-from .base import Connection, INITALIZED
+from .base import Connection, INITALIZED, CONNECTED, CONNECTING
+from .message import Message
 from ..utils.decorators import memoize
+from ..utils.ratelimit import TokenBucket, parse_limit
+
+#: Define irc as a config section prefix
+__config_prefix__ = 'irc'
 
 
 class AioIRC(Connection):
-    def __init__(self, host, port):
-        super().__init__()
+    def __init__(self, options, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.options = options
+
         self._loop = asyncio.get_event_loop()
         self.log = logging.getLogger(self.__class__.__name__)
 
         self.status = INITALIZED
 
-        self.transport = None
-        self.protocol = None
         self.reader = None
         self.writer = None
-
-        self.host = host
-        self.port = port
-        self.nick = 'warmachin49'
-        self.user = 'WarMachine'
+        # complete lines received and not read yet, and the start of the next
+        # line
+        self._lines = collections.deque()
+        self._partial = b''
+
+        self.section_name = options.get('section_name', 'irc')
+        self.host = options.get('server', 'irc.freenode.org')
+        self.port = int(options.get('port', 6697))
+        self.use_ssl = options.get('ssl', 'true') == 'true'
+        self.nick = options.get('nick', 'warmachine')
+        self.user = self.nick
+        self.name = options.get('name', 'War Machine')
+        self.password = options.get('password', '')
+
+        # Lines sent to the server, written as <lines>/<seconds>. Servers
+        # disconnect clients that send faster than they allow.
+        limit = parse_limit(options.get('send_limit', '5/10'))
+        self._send_bucket = None
+        if limit:
+            self._send_bucket = TokenBucket(limit[0], limit[1],
+                                            self._loop.time())
+        self._send_lock = asyncio.Lock()
+
+        # channels to join once connected
+        self.channels = [c.strip() for c in options.get('channels', '').split(
+            ',') if c.strip()]
 
         self.server_info = {
             'host': ''
@@ -29,40 +57,175 @@ class AioIRC(Connection):
 
     async def connect(self):
         self.log.info('Connecting to {}:{}'.format(self.host, self.port))
+        self.status = CONNECTING
 
-        self.reader, self.writer = await asyncio.open_connection(
-            self.host, self.port)
+        self._lines.clear()
+        self._partial = b''
 
-        self.writer.write('NICK {} r\n'.format(self.nick).encode())
-        self.writer.write('USER {} 8 * :War Machine\r\n'.format(
-            self.user).encode())
+        try:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port,
+                ssl=ssl.create_default_context() if self.use_ssl else None)
+        except OSError:
+            self.log.exception('Error connecting to {}'.format(self.host))
+            return
 
-        self.status = CONNECTED
+        if self.password:
+            self._write('PASS {}'.format(self.password))
+        self._write('NICK {}'.format(self.nick))
+        self._write('USER {} 8 * :{}'.format(self.user, self.name))
 
         return True
 
-    @asyncio.coroutine
-    def read(self):
-        if self.reader.at_eof():
-            raise Exception('eof')
-
-        if self.reader:
-            message = yield from self.reader.readline()
-
-            # if not self.server_info['host']:
-            #     self.server_info['host'] = message.split(' ')[0].replace(':', '')
-
-            # if message.startswith('PING'):
-            #     yield from self.send_pong()
-            #     return
-
-            return message.decode().strip()
+    async def reconnect(self):
+        """
+        Reconnect immediately, backing off if the server can't be reached.
+        """
+        delay = 1
+        while not await self.connect():
+            self.log.error('Trying to reconnect in {}s...'.format(delay))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+
+    async def disconnect(self):
+        self.status = INITALIZED
+        if self._pending_read:
+            self._pending_read.cancel()
+            self._pending_read = None
+        if self.writer:
+            self._write('QUIT :Bye')
+            self.writer.close()
+            self.writer = None
+            self.reader = None
+
+    def _write(self, line):
+        self.writer.write('{}\r\n'.format(line).encode())
+
+    async def read(self):
+        if not self._lines:
+            if not self.reader:
+                if self.status != INITALIZED:
+                    # the last connect failed
+                    await self.reconnect()
+                return
+
+            # Read whatever has arrived so the lines received together can be
+            # returned without waiting on the socket again
+            try:
+                data = await self.reader.read(64 * 1024)
+            except OSError as e:
+                self.log.error('Error reading from {}: {}'.format(
+                    self.host, e))
+                data = b''
+            if not data:
+                self.log.error('Connection to {} closed'.format(self.host))
+                await self.reconnect()
+                return
+
+            lines = (self._partial + data).split(b'\n')
+            self._partial = lines.pop()
+            if len(self._partial) > 64 * 1024:
+                self.log.warning('Dropping overlong line from {}'.format(
+                    self.host))
+                self._partial = b''
+            self._lines.extend(lines)
+            if not self._lines:
+                return
+
+        line = self._lines.popleft()
+        return self.process_line(line.decode('utf-8', 'replace').rstrip('\r'))
+
+    def pending(self):
+        return len(self._lines)
+
+    @classmethod
+    def parse_line(cls, line):
+        """
+        Split a line from the server into its parts
+
+        Returns:
+            tuple: (prefix, command, list of params)
+        """
+        prefix = ''
+        if line.startswith(':'):
+            prefix, _, line = line[1:].partition(' ')
+
+        if ' :' in line:
+            line, _, trailing = line.partition(' :')
+            params = line.split()
+            params.append(trailing)
+        else:
+            params = line.split()
+
+        command = params.pop(0) if params else ''
+        return prefix, command.upper(), params
+
+    def process_line(self, line):
+        """
+        Handle a line from the server.
+
+        Returns:
+            :class:`warmachine.connections.message.Message`: if the line is a
+                message the plugins should see, otherwise None
+        """
+        prefix, command, params = self.parse_line(line)
+
+        if command == 'PING':
+            self._write('PONG :{}'.format(params[0] if params else ''))
+
+        elif command == '001':
+            # Welcome, registration is complete
+            self.server_info['host'] = prefix
+            self.status = CONNECTED
+            self.log.info('Connected to {}'.format(self.host))
+            for c in self.channels:
+                self._write('JOIN {}'.format(c))
+
+        elif command == '433':
+            # Nickname in use
+            self.nick += '_'
+            self._write('NICK {}'.format(self.nick))
+
+        elif command == 'PRIVMSG' and len(params) == 2:
+            nick = prefix.split('!', 1)[0]
+            target, text = params
+            channel = target if target[:1] in '#&' else None
+
+            return Message(nick, channel, text, sender_id=nick,
+                           connection=self, raw=line)
+
+    async def say(self, message, destination):
+        """
+        Say something in a channel or to a user. Each line of ``message`` is
+        sent as its own PRIVMSG, paced to ``send_limit``.
+        """
+        async with self._send_lock:
+            for line in str(message).split('\n'):
+                await self._wait_to_send()
+                if self.writer is None:
+                    return
+                self._write('PRIVMSG {} :{}'.format(destination, line))
+            await self.writer.drain()
+
+    async def _wait_to_send(self):
+        bucket = self._send_bucket
+        if bucket is None:
+            return
+
+        bucket.refill(self._loop.time())
+        if bucket.tokens < 1:
+            await asyncio.sleep(bucket.wait_time())
+            bucket.refill(self._loop.time())
+        bucket.tokens -= 1
 
     async def send_pong(self):
         msg = 'PONG :{}'.format(self.server_info['host'])
-        return self.writer.write(msg)
+        return self._write(msg)
 
     @property
     @memoize
     def id(self):
         from hashlib import md5
+
+        value = '{}-{}'.format(self.host, self.nick)
+        return md5(value.encode()).hexdigest()
@@ -0,0 +1,234 @@
+class Entity(object):
+    """
+    A user mention, channel reference or link found in a message. ``start``
+    and ``end`` locate the entity in the message's normalized text.
+    """
+    __slots__ = ('type', 'id', 'name', 'start', 'end')
+
+    USER = 'user'
+    CHANNEL = 'channel'
+    #: a mention of a group of users, e.g. a Slack user group
+    GROUP = 'group'
+    #: ``@here``, ``@channel`` or ``@everyone`` and other special markup
+    SPECIAL = 'special'
+    LINK = 'link'
+
+    def __init__(self, type, id, name, start=0, end=0):
+        """
+        Args:
+            type (str): one of the type constants
+            id (str): the server's id for the user, channel or group, or the
+                url of a link
+            name (str): nickname, channel name without the ``#`` or link
+                label
+            start (int): offset of the entity in the normalized text
+            end (int): offset of the end of the entity
+        """
+        self.type = type
+        self.id = id
+        self.name = name
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['type'], data['id'], data['name'], data['start'],
+                   data['end'])
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __eq__(self, other):
+        if not isinstance(other, Entity):
+            return NotImplemented
+        return self.as_dict() == other.as_dict()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Entity({})'.format(', '.join(
+            '{}={!r}'.format(k, getattr(self, k)) for k in self.__slots__))
+
+
+class Message(object):
+    """
+    A message received on a connection and passed to the plugins.
+
+    The command and its arguments are parsed once, the first time either is
+    used, so plugins don't have to split the text themselves. For backwards
+    compatibility a message also behaves like the dictionary connections used
+    to return::
+
+        {
+            'sender': 'sender nickname',
+            'channel': '#channel_name or None for private messages',
+            'message': 'The message that was received',
+            'is_bot': True if the sender is a bot,
+        }
+    """
+    __slots__ = ('sender', 'channel', 'message', 'is_bot', 'sender_id',
+                 'connection', 'raw', 'raw_text', 'entities', '_command',
+                 '_args', '_user', '_extra')
+
+    #: Keys available when the message is used like a dictionary
+    KEYS = ('sender', 'channel', 'message', 'is_bot')
+
+    _UNSET = object()
+
+    def __init__(self, sender, channel, message, is_bot=False, sender_id=None,
+                 connection=None, raw=None, entities=None, raw_text=None):
+        """
+        Args:
+            sender (str): sender nickname
+            channel (str): ``#channel`` or None for private messages
+            message (str): the text of the message
+            is_bot (bool): True if the sender is a bot
+            sender_id (str): the connection's id for the sender. Defaults to
+                ``sender``
+            connection (Connection): the connection the message was received
+                on. Used to look up :attr:`user`
+            raw: the event as received from the server
+            entities (list): the :class:`Entity` objects in ``message``
+            raw_text (str): the text before the connection's markup was
+                replaced. Defaults to ``message``
+        """
+        self.sender = sender
+        self.channel = channel
+        self.message = message
+        self.is_bot = is_bot
+        self.sender_id = sender_id if sender_id is not None else sender
+        self.connection = connection
+        self.raw = raw
+        self.entities = entities or []
+        self.raw_text = raw_text if raw_text is not None else message
+
+        self._command = self._UNSET
+        self._args = None
+        self._user = self._UNSET
+        self._extra = None
+
+    @classmethod
+    def from_dict(cls, data, connection=None):
+        """
+        Create a message from the dictionary format connections used to
+        return. Unknown keys are kept.
+
+        Returns:
+            Message: the message
+        """
+        msg = cls(data.get('sender'), data.get('channel'), data.get('message'),
+                  is_bot=data.get('is_bot', False), connection=connection)
+        for k, v in data.items():
+            if k not in cls.KEYS:
+                msg[k] = v
+        return msg
+
+    def _parse(self):
+        if self.message and self.message.startswith('!'):
+            parts = self.message.split()
+            self._command = parts[0]
+            self._args = parts[1:]
+        else:
+            self._command = None
+            self._args = []
+
+    @property
+    def command(self):
+        """
+        The ``!command`` the message starts with or None
+        """
+        if self._command is self._UNSET:
+            self._parse()
+        return self._command
+
+    @property
+    def args(self):
+        """
+        list: The words following :attr:`command`
+        """
+        if self._command is self._UNSET:
+            self._parse()
+        return self._args
+
+    @property
+    def is_dm(self):
+        """
+        True if this is a private message to the bot
+        """
+        return not self.channel
+
+    @property
+    def user(self):
+        """
+        The connection's record for the sender, looked up the first time it is
+        used. None if the connection doesn't have one.
+        """
+        if self._user is self._UNSET:
+            self._user = None
+            if self.connection is not None:
+                self._user = self.connection.user_record(self.sender_id)
+        return self._user
+
+    # dictionary compatibility
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            return getattr(self, key)
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.KEYS:
+            setattr(self, key, value)
+            if key == 'message':
+                self._command = self._UNSET
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __contains__(self, key):
+        return key in self.KEYS or bool(self._extra and key in self._extra)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.KEYS) + list(self._extra or [])
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def as_dict(self):
+        """
+        Returns:
+            dict: the message as a dictionary
+        """
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            other = other.as_dict()
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.as_dict())
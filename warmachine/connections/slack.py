@@ -1,7 +1,12 @@
 import asyncio
+import collections
+import functools
+import http.client
 import json
 import logging
+import os
 from pprint import pformat
+import re
 import time
 from urllib.parse import urlencode
 import urllib.request
@@ -9,20 +14,52 @@ import urllib.request
 import websockets
 
 from .base import Connection, INITALIZED, CONNECTED, CONNECTING
+from .message import Entity, Message
 from ..utils.decorators import memoize
+from ..utils.files import FileStore, SharedFile
+from ..utils.http import HTTPError
+from ..utils.profiling import startup_profiler
 
 #: Define slack as a config section prefix
 __config_prefix__ = 'slack'
 
+#: Slack's markup for mentions, channels, special mentions and links, e.g.
+#: ``<@U123|jason>``, ``<#C123|general>``, ``<!here>``, ``<http://...|label>``
+SLACK_ENTITY_RE = re.compile(r'<([@#!]?)([^>|]+)(?:\|([^>]*))?>')
+
+
+def unescape(text):
+    """
+    Undo Slack's escaping of ``&``, ``<`` and ``>``
+    """
+    if '&' not in text:
+        return text
+    return text.replace('&lt;', '<').replace('&gt;', '>').replace(
+        '&amp;', '&')
+
+
+class SlackError(Exception):
+    """
+    Error returned by slack
+    """
+
+
+#: Errors that make a lookup fail instead of escaping from the read path:
+#: slack's errors and network errors and timeouts talking to the web api
+LOOKUP_ERRORS = (SlackError, HTTPError, http.client.HTTPException, OSError,
+                 ValueError, asyncio.TimeoutError)
+
 
 class SlackWS(Connection):
     def __init__(self, options, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.options = options
 
         self._loop = asyncio.get_event_loop()
         self.log = logging.getLogger(self.__class__.__name__)
         self.host = None
         self.token = options['token']
+        self.section_name = options.get('section_name', 'slack')
 
         self._info = None
         self.reconnect_url = ''
@@ -31,18 +68,91 @@ class SlackWS(Connection):
         self.channel_name_to_id = {}  # slack channel/group name mapped to id
         self.user_map = {}     # user info keyed by their slack id
         self.user_nick_to_id = {}  # slack user id mapped to the (nick)name
+        self.dm_ids = {}  # slack user id mapped to the id of our DM with them
+        # True once every open DM is in ``dm_ids``, so a missing user really
+        # has no DM yet
+        self._dms_loaded = False
+        # Number of DMs that may be opened with the web api at once
+        self._dm_open_limit = asyncio.Semaphore(
+            int(options.get('dm_open_concurrency', 4)))
+        # Number of users that may be looked up with users.info at once
+        self._user_lookup_limit = asyncio.Semaphore(
+            int(options.get('user_lookup_concurrency', 8)))
+
+        # With lazy lookups the connection is opened with rtm.connect, which
+        # doesn't return the team's users and channels. Records are fetched
+        # the first time they are referenced instead.
+        self.lazy_lookups = options.get('lazy_lookups', 'false') == 'true'
+        # Fill the user cache with users.list in the background after
+        # connecting
+        self.warm_users = options.get('warm_users', 'false') == 'true'
+        self._warm_task = None
+        # (api method, key) -> task for lookups in progress. Concurrent
+        # lookups of the same record share the request.
+        self._lookups = {}
+
+        # Shared files are downloaded for the plugins subscribed to them, in
+        # chunks to a store under the config dir. Sizes are in MB.
+        self.file_max_size = int(float(
+            options.get('file_max_size', 50)) * 1024 * 1024)
+        self.file_downloads = int(options.get('file_downloads', 2))
+        self.file_cache_size = int(float(
+            options.get('file_cache_size', 1024)) * 1024 * 1024)
+        self._file_store = None
+        self._file_subscribers = []
+        # file ids already passed to the subscribers, oldest first. Slack
+        # sends both file_shared and file_public for a public file.
+        self._files_seen = collections.OrderedDict()
 
         self.my_id = '000'
 
         self.ws = None
+        # events received from slack waiting for read(). Filled by the pump
+        # task so read_batch can drain everything already received.
+        self._events = asyncio.Queue(maxsize=int(
+            options.get('event_queue_size', 1000)))
+        # messages received while the queue was full. Messages from users
+        # are never dropped, they wait here instead.
+        self._overflow = collections.deque()
+        self._pump_task = None
+        # other events dropped because the queue was full
+        self.events_dropped = 0
         # used to give messages an id. slack requirement
         self._internal_msgid = 0
+        # Messages waiting for slack to acknowledge them. Keyed by message id,
+        # in the order they were sent. Values are dicts with the ``frame``,
+        # the ``future`` resolved with slack's reply, whether it was ``sent``,
+        # the wall clock time it was ``sent_at`` and the ``timer`` for giving
+        # up on the acknowledgement.
+        self._unacked = collections.OrderedDict()
+        # Messages sent on a connection that dropped before slack acknowledged
+        # them. They may have been posted, so they are looked for in the
+        # channel's history before being sent again.
+        self._unconfirmed = collections.OrderedDict()
+        # Number of messages that may be waiting for an acknowledgement before
+        # say() waits
+        self.send_window = int(options.get('send_window', 10))
+        self._send_window = asyncio.Semaphore(self.send_window)
+        # Seconds to wait for an acknowledgement before failing the message
+        # and freeing its place in the window
+        self.ack_timeout = float(options.get('ack_timeout', 30))
         # used to give each ping a unique id
         self._internal_pingid = 0
 
         # track's lag
         self.lag_in_ms = 0
 
+        # Liveness tracking. A ping is only sent after ``ping_interval``
+        # seconds without receiving anything, so busy connections rarely ping.
+        # The connection is considered dead once ``ping_max_missed`` pings go
+        # unanswered or a pong takes longer than ``ping_max_lag_ms``.
+        self.ping_interval = float(options.get('ping_interval', 4))
+        self.ping_max_missed = int(options.get('ping_max_missed', 3))
+        self.ping_max_lag_ms = float(options.get('ping_max_lag_ms', 10000))
+        self._pings = {}  # ping id -> loop time it was sent
+        self._ping_handle = None
+        self.last_recv = 0
+
         self.status = INITALIZED
 
     @property
@@ -53,98 +163,444 @@ class SlackWS(Connection):
 
     async def connect(self):
         try:
-            self.host = self.authenticate()
+            with startup_profiler.measure('authenticate {}'.format(
+                    self.section_name)):
+                self.host = self.authenticate()
         except Exception:
             self.log.exception('Error authenticating to slack')
             return
-        self.STATUS = CONNECTING
+        self.status = CONNECTING
         self.log.info('Connecting to {}'.format(self.host))
-        self.ws = await websockets.connect(self.host)
+        try:
+            self.ws = await websockets.connect(self.host)
+        except Exception:
+            self.log.exception('Error connecting to slack')
+            return
+
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.ensure_future(self._pump())
+
+        self.start_warm_users()
 
         return True
 
+    def start_warm_users(self):
+        """
+        Start filling the user cache in the background if ``warm_users`` is
+        enabled
+        """
+        if not self.warm_users or (self._warm_task and
+                                   not self._warm_task.done()):
+            return
+        self._warm_task = asyncio.ensure_future(self._warm_users())
+
+    async def _warm_users(self):
+        try:
+            await self.load_users()
+        except Exception:
+            self.log.exception('Error warming the user cache')
+        else:
+            self.log.info('Cached {} users'.format(len(self.user_map)))
+
     def on_hello(self, msg):
         self.log.info('Connected to Slack')
-        self.STATUS = CONNECTED
         self.start_ping()
+        # Marks the connection as CONNECTED once the backlog is sent
+        asyncio.ensure_future(self.resend_unacked())
+
+    async def disconnect(self):
+        """
+        Close the connection without reconnecting
+        """
+        self.stop_ping()
+        self.status = INITALIZED
+
+        if self._warm_task:
+            self._warm_task.cancel()
+            self._warm_task = None
+
+        if self._file_store:
+            self._file_store.close()
+            self._file_store = None
+
+        if self._pump_task:
+            self._pump_task.cancel()
+            self._pump_task = None
+
+        if self._pending_read:
+            self._pending_read.cancel()
+            self._pending_read = None
 
-    async def read(self):
         if self.ws:
+            await self.ws.close()
+            self.ws = None
+
+        # Nobody is going to acknowledge these now
+        for p in list(self._unacked.values()) + \
+                list(self._unconfirmed.values()):
+            self._finish(p)
+        self._unacked.clear()
+        self._unconfirmed.clear()
+
+    async def reconnect(self):
+        """
+        Reconnect immediately, backing off if slack can't be reached.
+        """
+        self.stop_ping()
+        self.status = CONNECTING
+
+        # The acknowledgements of messages already sent won't come on the new
+        # connection
+        for msg_id, p in list(self._unacked.items()):
+            if p['sent']:
+                if p['timer']:
+                    p['timer'].cancel()
+                    p['timer'] = None
+                self._unconfirmed[msg_id] = self._unacked.pop(msg_id)
+
+        delay = 1
+        while not await self.connect():
+            self.log.error('Trying to reconnect in {}s...'.format(delay))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+
+    async def _pump(self):
+        """
+        Receive frames from the websocket as soon as they arrive, reconnecting
+        when it closes. Acknowledgements and pongs are handled here,
+        everything else is queued for :meth:`read`.
+
+        The socket is never left unread while the queue is full, or acks and
+        pongs would stop arriving and say() would wait on plugins that are
+        waiting on the queue. See :meth:`queue_event`.
+        """
+        while self.ws:
             try:
-                message = json.loads(await self.ws.recv())
+                frame = await self.ws.recv()
+            except asyncio.CancelledError:
+                raise
             except websockets.ConnectionClosed as e:
                 self.log.error('{}'.format(e))
-                while not await self.connect():
-                    self.error('Trying to reconnect...')
-                    await asyncio.sleep(300)
-                return
+                await self.reconnect()
+                continue
+            except Exception:
+                # Nothing else reads the socket, so the pump must outlive
+                # whatever went wrong with it
+                self.log.exception('Error receiving from slack')
+                await self.reconnect()
+                continue
 
-            # Slack is acknowledging a message was sent. Do nothing
-            if 'reply_to' in message and 'type' not in message:
-                # {'ok': True,
-                #  'reply_to': 1,
-                #  'text': "['!whois', 'synic']",
-                #  'ts': '1469743355.000150'}
-                return
+            try:
+                self._pump_frame(frame)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception('Error handling frame {!r}'.format(frame))
+
+    def _pump_frame(self, frame):
+        """
+        Handle a frame received by :meth:`_pump`
+        """
+        message = json.loads(frame)
+
+        # Anything received proves the connection is alive
+        self.last_recv = self._loop.time()
+        self._pings.clear()
+
+        # Slack is acknowledging a message was sent
+        if 'reply_to' in message and 'type' not in message:
+            # {'ok': True,
+            #  'reply_to': 1,
+            #  'text': "['!whois', 'synic']",
+            #  'ts': '1469743355.000150'}
+            self.on_ack(message)
+            return
+
+        # handled here so the lag is measured when the pong arrives
+        if message.get('type') == 'pong':
+            self.on_pong(message)
+            return
 
-            # Sometimes there isn't a type in the message we receive
-            if 'type' not in message:
-                self.log.error('Received typeless message: {}'.format(message))
+        self.queue_event(message)
+
+    def queue_event(self, event):
+        """
+        Queue an event for :meth:`read` without waiting. When the queue is
+        full, messages wait in an overflow list so none are lost, and it's up
+        to the bot's inbound queue policy what happens to them. Other events
+        are dropped.
+        """
+        if not self._overflow:
+            try:
+                self._events.put_nowait(event)
                 return
+            except asyncio.QueueFull:
+                pass
+
+        if event.get('type') == 'message':
+            self._overflow.append(event)
+            return
+
+        try:
+            self._events.put_nowait(event)
+        except asyncio.QueueFull:
+            self.events_dropped += 1
+            if self.events_dropped == 1 or self.events_dropped % 100 == 0:
+                self.log.warning('Event queue full, %s events dropped so far',
+                                 self.events_dropped)
+
+    def pending(self):
+        return self._events.qsize() + len(self._overflow)
 
-            if message['type'] == 'message' and 'subtype' not in message:
-                # Handle text messages from users
-                return await self.process_message(message)
+    async def read(self):
+        if self._events.empty() and self._overflow:
+            event = self._overflow.popleft()
+        else:
+            event = await self._events.get()
+        return await self.handle_event(event)
+
+    async def handle_event(self, message):
+        """
+        Route an event from slack. Text messages from users are returned for
+        the plugins, other events are passed to the matching ``on_<type>``
+        method.
+
+        Returns:
+            :class:`warmachine.connections.message.Message`: or None
+        """
+        # Sometimes there isn't a type in the message we receive
+        if 'type' not in message:
+            self.log.error('Received typeless message: {}'.format(message))
+            return
+
+        if message['type'] == 'message' and 'subtype' not in message:
+            # Handle text messages from users
+            return await self.process_message(message)
+        else:
+            if 'subtype' in message:
+                # This is a message with a subtype and should be processed
+                # differently
+                msgtype = '{}_{}'.format(
+                    message['type'], message['subtype'])
             else:
-                if 'subtype' in message:
-                    # This is a message with a subtype and should be processed
-                    # differently
-                    msgtype = '{}_{}'.format(
-                        message['type'], message['subtype'])
-                else:
-                    # This is a non-message event from slack.
-                    # https://api.slack.com/events
-                    msgtype = message['type']
-
-                # Look for on_{type} methods to pass the dictionary to for
-                # additional processing
-                func_name = 'on_{}'.format(msgtype)
-                if hasattr(self, func_name):
-                    getattr(self, func_name)(message)
-                else:
-                    self.log.debug('{} does not exist for message: {}'.format(
-                        func_name, message))
+                # This is a non-message event from slack.
+                # https://api.slack.com/events
+                msgtype = message['type']
+
+            # Look for on_{type} methods to pass the dictionary to for
+            # additional processing
+            func_name = 'on_{}'.format(msgtype)
+            if hasattr(self, func_name):
+                getattr(self, func_name)(message)
+            else:
+                self.log.debug('%s does not exist for message: %s',
+                               func_name, message)
 
-    async def say(self, message, destination):
+    async def say(self, message, destination, wait=False):
         """
         Say something in the provided channel or IM by id
+
+        Messages are pipelined: this returns once the message is sent, unless
+        ``send_window`` messages are already waiting to be acknowledged.
+        Messages slack hasn't acknowledged when the connection drops are sent
+        again after reconnecting.
+
+        Args:
+            message (str): the message to send
+            destination (str): ``#channel`` or user nickname
+            wait (bool): wait for slack to acknowledge the message
+
+        Returns:
+            :class:`asyncio.Future`: resolved with slack's reply once the
+                message is acknowledged or rejected. If ``wait`` is True the
+                reply itself is returned. None if the message can't be sent
         """
         # If the destination is a user, figure out the DM channel id
         if destination and destination.startswith('#'):
-            destination = self.channel_name_to_id[destination.replace('#', '')]
+            destination = await self.get_channel_id(destination)
         else:
-            _user = self.user_nick_to_id[destination]
+            _user = await self.get_user_id(destination)
+            user = await self.get_user(_user) if _user else None
+            if not user:
+                self.log.error('Unknown user {}'.format(destination))
+                return
 
-            if '#' not in destination and 'is_bot' not in self.user_map[_user]:
+            if 'is_bot' not in user:
                 self.log.error('is_bot property not found for user {}'.format(
                     destination))
 
             # slack doesn't allow bots to message other bots
-            if '#' not in destination and (self.user_map[_user]['deleted'] or
-                                           self.user_map[_user]['is_bot']):
+            if user.get('deleted') or user.get('is_bot'):
                 return
 
-            destination = self.get_dm_id_by_user(_user)
+            destination = await self.get_dm_id_by_user(_user)
+            if not destination:
+                return
 
-        self._internal_msgid += 1
         message = {
-            'id': self._internal_msgid,
             'type': 'message',
             'channel': destination,
             'text': str(message)
         }
-        self.log.debug("Saying {}".format(message))
-        await self._send(json.dumps(message))
+
+        future = await self.send_frame(message)
+        if wait:
+            return await future
+        return future
+
+    async def send_frame(self, frame):
+        """
+        Give ``frame`` an id and send it, tracking it until slack acknowledges
+        it.
+
+        Returns:
+            :class:`asyncio.Future`: resolved with slack's reply
+        """
+        await self._send_window.acquire()
+
+        future = self._loop.create_future()
+
+        self._internal_msgid += 1
+        frame['id'] = self._internal_msgid
+        pending = {'frame': frame, 'future': future, 'sent': False,
+                   'sent_at': None, 'timer': None}
+        self._unacked[frame['id']] = pending
+
+        # Until we are connected the message waits for resend_unacked
+        if self.status == CONNECTED:
+            await self._send_pending(pending)
+
+        return future
+
+    async def _send_pending(self, pending):
+        self.log.debug('Saying %s', pending['frame'])
+        try:
+            await self._send(json.dumps(pending['frame']))
+        except websockets.ConnectionClosed:
+            # Sent again once we reconnect
+            return
+
+        pending['sent'] = True
+        pending['sent_at'] = time.time()
+        pending['timer'] = self._loop.call_later(
+            self.ack_timeout, self._ack_timed_out, pending['frame']['id'])
+
+    def _finish(self, pending, reply=None):
+        """
+        Stop tracking a message, freeing its place in the send window, and
+        resolve its future with ``reply``. The future is cancelled if there is
+        no reply.
+        """
+        if pending['timer']:
+            pending['timer'].cancel()
+            pending['timer'] = None
+
+        self._send_window.release()
+
+        if not pending['future'].done():
+            if reply is None:
+                pending['future'].cancel()
+            else:
+                pending['future'].set_result(reply)
+
+    def on_ack(self, msg):
+        """
+        Resolve the future of the message slack is replying to
+        """
+        pending = self._unacked.pop(msg['reply_to'], None)
+        if not pending:
+            return
+
+        if not msg.get('ok', False):
+            self.log.error('Slack rejected message {}: {}'.format(
+                pending['frame'], msg.get('error')))
+
+        self._finish(pending, msg)
+
+    def _ack_timed_out(self, msg_id):
+        pending = self._unacked.pop(msg_id, None)
+        if not pending:
+            return
+
+        pending['timer'] = None
+        self.log.error('No acknowledgement for message {} after {}s'.format(
+            msg_id, self.ack_timeout))
+        self._finish(pending, {'ok': False, 'reply_to': msg_id,
+                               'error': 'ack_timeout'})
+
+    async def resend_unacked(self):
+        """
+        Send messages that were queued while disconnected, and those sent
+        before the connection dropped that didn't reach slack, then mark the
+        connection as connected. Ids keep increasing across connections so
+        the original ids are reused.
+        """
+        if self._unconfirmed:
+            await self.confirm_unacked()
+
+        while True:
+            unsent = [p for p in self._unacked.values() if not p['sent']]
+            if not unsent:
+                break
+
+            self.log.info('Sending {} unacknowledged messages'.format(
+                len(unsent)))
+            for p in unsent:
+                await self._send_pending(p)
+                if not p['sent']:
+                    # Disconnected again
+                    return
+
+        self.status = CONNECTED
+
+    async def confirm_unacked(self):
+        """
+        Look for the messages in ``_unconfirmed`` in their channel's history.
+        Slack doesn't de-duplicate messages, so only the ones that aren't
+        there are queued to be sent again. If the history can't be read the
+        messages fail rather than risk posting them twice.
+        """
+        unconfirmed, self._unconfirmed = \
+            self._unconfirmed, collections.OrderedDict()
+
+        by_channel = collections.OrderedDict()
+        for p in unconfirmed.values():
+            by_channel.setdefault(p['frame']['channel'], []).append(p)
+
+        for channel, pending in by_channel.items():
+            # allow for the difference between our clock and slack's
+            oldest = min(p['sent_at'] for p in pending) - 60
+            try:
+                r = await self.api('conversations.history', channel=channel,
+                                   oldest='{:.6f}'.format(oldest), limit=200)
+            except LOOKUP_ERRORS as e:
+                self.log.error('Unable to check whether {} messages reached '
+                               '{}: {!r}'.format(len(pending), channel, e))
+                for p in pending:
+                    self._finish(p, {'ok': False,
+                                     'reply_to': p['frame']['id'],
+                                     'error': 'unconfirmed'})
+                continue
+
+            # our messages, oldest first
+            posted = [m for m in reversed(r.get('messages', []))
+                      if m.get('user') == self.my_id]
+            for p in pending:
+                text = unescape(p['frame']['text'])
+                match = next((m for m in posted
+                              if unescape(m.get('text', '')) == text), None)
+                if match is not None:
+                    posted.remove(match)
+                    self._finish(p, {'ok': True,
+                                     'reply_to': p['frame']['id'],
+                                     'ts': match['ts'],
+                                     'text': match.get('text')})
+                else:
+                    p['sent'] = False
+                    self._unacked[p['frame']['id']] = p
+
+        # keep the order they were said in
+        self._unacked = collections.OrderedDict(sorted(self._unacked.items()))
 
     async def _send(self, message):
         """
@@ -152,28 +608,84 @@ class SlackWS(Connection):
         """
         await self.ws.send(message)
 
-    def authenticate(self):
+    async def edit(self, message_id, message, destination):
         """
-        Populate ``self._info``
+        Replace the text of a message the bot sent.
+
+        Args:
+            message_id (str): the ``ts`` slack replied with when the message
+                was sent
+            message (str): the new text
+            destination (str): ``#channel`` the message was sent to
 
         Returns:
-            str: websocket url to connect to
+            dict: slack's response
         """
-        url = 'https://slack.com/api/rtm.start?{}'.format(
-            urlencode(
-                {'token':
-                 self.token}))
-        self.log.debug('Connecting to {}'.format(url))
-        req = urllib.request.Request(url)
+        if destination.startswith('#'):
+            destination = await self.get_channel_id(destination)
+
+        return await self.api('chat.update', channel=destination,
+                              ts=message_id, text=str(message))
+
+    async def api(self, method, **params):
+        """
+        Call a web api method without blocking the event loop.
 
+        Args:
+            method (str): api method, e.g. ``chat.update``
+            **params: arguments for the method
+
+        Returns:
+            dict: slack's response
+
+        Raises:
+            SlackError: if slack returns an error
+        """
+        r = await self._loop.run_in_executor(
+            None, functools.partial(self.api_call, method, **params))
+
+        if not r.get('ok', False):
+            raise SlackError('{}: {}'.format(method, r.get('error',
+                                                           'Unknown Error')))
+        return r
+
+    def api_call(self, method, **params):
+        """
+        Call a slack web api method. This blocks.
+
+        Args:
+            method (str): api method, e.g. ``chat.update``
+            **params: arguments for the method
+
+        Returns:
+            dict: slack's response
+        """
+        params['token'] = self.token
+        url = 'https://slack.com/api/{}?{}'.format(method, urlencode(params))
+
+        req = urllib.request.Request(url)
         r = urllib.request.urlopen(req).read().decode('utf-8')
-        self._info = json.loads(r)
+
+        return json.loads(r)
+
+    def authenticate(self):
+        """
+        Populate ``self._info``. With ``lazy_lookups`` the smaller
+        ``rtm.connect`` handshake is used, which only returns the bot's own
+        information.
+
+        Returns:
+            str: websocket url to connect to
+        """
+        method = 'rtm.connect' if self.lazy_lookups else 'rtm.start'
+        self.log.debug('Connecting with {}'.format(method))
+        self._info = self.api_call(method)
 
         if not self._info.get('ok', True):
             raise Exception('Slack Error: {}'.format(
                 self._info.get('error', 'Unknown Error')))
 
-        # Slack returns a huge json struct with a bunch of information
+        # rtm.start returns a huge json struct with a bunch of information
         self.process_connect_info(self._info)
 
         self.log.debug('Got websocket url: {}'.format(self._info.get('url')))
@@ -196,56 +708,294 @@ class SlackWS(Connection):
 
         # Map users
         for u in self._info.get('users', []):
-            self.user_map[u['id']] = u
-            self.user_nick_to_id[u['name']] = u['id']
+            self.cache_user(u)
 
         # Map IM
-        for i in self._info.get('ims', []):
-            self.channel_map[i['id']] = i
+        if 'ims' in self._info:
+            for i in self._info['ims']:
+                self.cache_channel(i)
+            self._dms_loaded = True
 
         # Map Channels
         for c in self._info.get('channels', []):
-            self.channel_map[c['id']] = c
-            self.channel_name_to_id[c['name']] = c['id']
+            self.cache_channel(c)
 
         for g in self._info.get('groups', []):
-            self.channel_map[g['id']] = g
-            self.channel_name_to_id[g['name']] = g['id']
+            self.cache_channel(g)
+
+    def cache_user(self, user):
+        self.user_map[user['id']] = user
+        self.user_nick_to_id[user['name']] = user['id']
+
+    def cache_channel(self, channel):
+        self.channel_map[channel['id']] = channel
+        if channel.get('is_im') and 'user' in channel:
+            self.dm_ids[channel['user']] = channel['id']
+        elif 'name' in channel:
+            self.channel_name_to_id[channel['name']] = channel['id']
+
+    async def _merged(self, key, func, *args, **kwargs):
+        """
+        Run ``func`` unless a call with the same ``key`` is already in
+        progress, in which case wait for its result instead.
+
+        Returns:
+            the result of ``func`` or None if slack returned an error or slack
+                couldn't be reached
+        """
+        task = self._lookups.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._lookups[key] = task
+            task.add_done_callback(lambda t: self._lookups.pop(key, None))
+
+        try:
+            # shielded so one caller giving up doesn't cancel the request for
+            # the others
+            return await asyncio.shield(task)
+        except LOOKUP_ERRORS as e:
+            self.log.error('Lookup of {} failed: {!r}'.format(key, e))
+
+    async def get_user(self, user_id):
+        """
+        Return a user's record, fetching it with ``users.info`` the first time
+        it is needed.
+
+        Args:
+            user_id (str): slack user id
+
+        Returns:
+            dict: the user or None if slack doesn't know them
+        """
+        user = self.user_map.get(user_id)
+        if user is None:
+            r = await self._merged(('users.info', user_id), self.api,
+                                   'users.info', user=user_id)
+            if r:
+                user = r['user']
+                self.cache_user(user)
+        return user
+
+    async def get_user_id(self, nick):
+        """
+        Return the id of the user with the nickname ``nick``. Nicknames are
+        only known for users seen before, so this waits for the user cache to
+        be warmed if that is in progress.
+
+        Returns:
+            str: slack user id or None
+        """
+        if nick not in self.user_nick_to_id and self._warm_task and \
+           not self._warm_task.done():
+            await asyncio.shield(self._warm_task)
+        return self.user_nick_to_id.get(nick)
+
+    async def get_channel(self, channel_id):
+        """
+        Return a channel's record, fetching it with ``conversations.info`` the
+        first time it is needed.
+
+        Returns:
+            dict: the channel or None
+        """
+        channel = self.channel_map.get(channel_id)
+        if channel is None:
+            r = await self._merged(('conversations.info', channel_id),
+                                   self.api, 'conversations.info',
+                                   channel=channel_id)
+            if r:
+                channel = r['channel']
+                self.cache_channel(channel)
+        return channel
+
+    async def get_channel_id(self, name):
+        """
+        Return the id of ``#name``. Unknown names are looked up among the
+        channels the bot is a member of.
+
+        Raises:
+            KeyError: if the bot isn't in the channel
+        """
+        name = name.replace('#', '')
+        if name not in self.channel_name_to_id:
+            await self._merged(('users.conversations', None),
+                               self.load_channels)
+        return self.channel_name_to_id[name]
+
+    async def load_users(self):
+        """
+        Cache every user on the team with ``users.list``
+        """
+        cursor = None
+        while True:
+            params = {'limit': 200}
+            if cursor:
+                params['cursor'] = cursor
+            r = await self.api('users.list', **params)
+
+            for u in r.get('members', []):
+                self.cache_user(u)
+
+            cursor = r.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+
+    async def load_channels(self):
+        """
+        Cache the channels the bot is a member of
+        """
+        cursor = None
+        while True:
+            params = {'limit': 200,
+                      'types': 'public_channel,private_channel,im'}
+            if cursor:
+                params['cursor'] = cursor
+            r = await self.api('users.conversations', **params)
+
+            for c in r.get('channels', []):
+                self.cache_channel(c)
+
+            cursor = r.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+
+        self._dms_loaded = True
+
+    async def load_dms(self):
+        """
+        Cache the bot's open DMs
+        """
+        cursor = None
+        while True:
+            params = {'limit': 200, 'types': 'im'}
+            if cursor:
+                params['cursor'] = cursor
+            r = await self.api('users.conversations', **params)
+
+            for c in r.get('channels', []):
+                self.cache_channel(c)
+
+            cursor = r.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+
+        self._dms_loaded = True
+
+    async def tokenize(self, text):
+        """
+        Replace Slack's markup in ``text`` with plain text in one pass. User
+        and channel ids are resolved to names.
+
+        Returns:
+            tuple: (normalized text, list of :class:`Entity`)
+        """
+        if '<' not in text and '&' not in text:
+            return text, []
+
+        parts = []
+        entities = []
+        length = 0
+        pos = 0
+        for m in SLACK_ENTITY_RE.finditer(text):
+            plain = unescape(text[pos:m.start()])
+            parts.append(plain)
+            length += len(plain)
+            pos = m.end()
+
+            entity, shown = await self._entity(*m.groups())
+            entity.start = length
+            length += len(shown)
+            entity.end = length
+            parts.append(shown)
+            entities.append(entity)
+
+        parts.append(unescape(text[pos:]))
+        return ''.join(parts), entities
+
+    async def _entity(self, kind, value, label):
+        """
+        Returns:
+            tuple: (:class:`Entity`, the text shown for it)
+        """
+        label = unescape(label) if label else None
+
+        if kind == '@':
+            if not label:
+                user = await self.get_user(value)
+                label = user['name'] if user else value
+            return Entity(Entity.USER, value, label), '@' + label
+
+        if kind == '#':
+            if not label:
+                channel = await self.get_channel(value)
+                label = channel['name'] if channel else value
+            return Entity(Entity.CHANNEL, value, label), '#' + label
+
+        if kind == '!':
+            name, _, group_id = value.partition('^')
+            if name == 'subteam':
+                label = (label or group_id).lstrip('@')
+                return Entity(Entity.GROUP, group_id, label), '@' + label
+            if name in ('here', 'channel', 'everyone'):
+                return Entity(Entity.SPECIAL, name, name), '@' + name
+            # dates and anything new have a fallback label
+            return Entity(Entity.SPECIAL, value, label or name), label or name
+
+        url = unescape(value)
+        if not label or url.endswith(label) or url.endswith(label + '/'):
+            # slack labels links with the url without the scheme
+            shown = url.split('mailto:', 1)[-1]
+        else:
+            shown = '{} ({})'.format(label, url)
+        return Entity(Entity.LINK, url, label or shown), shown
 
     async def process_message(self, msg):
         if 'text' not in msg:
             self.log.error('key "text" not found in message: {}'.format(msg))
+            return
 
         # Map the slack ids to usernames and channels/groups names
-        user_nickname = self.user_map[msg['user']]['name']
+        user = await self.get_user(msg['user'])
+        if user is None:
+            return
+        user_nickname = user['name']
+        is_bot = user.get('is_bot', False)
         if msg['channel'].startswith('D'):
             # This is a private message
             channel = None
+            self.dm_ids.setdefault(msg['user'], msg['channel'])
         else:
             try:
-                channel = '#{}'.format(self.channel_map[msg['channel']]['name'])
-            except KeyError:
+                channel = '#{}'.format(
+                    (await self.get_channel(msg['channel']))['name'])
+            except (KeyError, TypeError):
                 channel = None
 
-        retval = {
-            'sender': user_nickname,
-            'channel': channel,
-            'message': msg['text']
-        }
+        # Plugins get the text with mentions and links already resolved
+        text, entities = await self.tokenize(msg['text'])
+
+        return Message(user_nickname, channel, text, is_bot=is_bot,
+                       sender_id=msg['user'], connection=self, raw=msg,
+                       entities=entities, raw_text=msg['text'])
 
-        _sender = retval['channel'] if retval['channel'] else retval['sender']
+    async def builtin_command(self, message):
+        _sender = message.channel if message.channel else message.sender
         # Built-in !whois command. Return information about a particular user.
-        if retval['message'].startswith('!whois'):
-            nicknames = retval['message'].split(' ')[1:]
-            for n in nicknames:
-                await self.say(pformat(self.user_map[self.user_nick_to_id[n]]),
-                               _sender)
-            return
-        elif msg['text'].startswith('!slack-lag'):
+        if message.command == '!whois':
+            for n in message.args:
+                user_id = await self.get_user_id(n.lstrip('@'))
+                if user_id:
+                    await self.say(pformat(await self.get_user(user_id)),
+                                   _sender)
+            return True
+        elif message.command == '!slack-lag':
             await self.say('{}ms'.format(self.lag_in_ms), _sender)
-            return
+            return True
+
+        return False
 
-        return retval
+    def user_record(self, user_id):
+        return self.user_map.get(user_id)
 
     def on_user_change(self, msg):
         """
@@ -257,17 +1007,20 @@ class SlackWS(Connection):
         """
         user_info = msg['user']
 
-        self.user_map[user_info['id']] = user_info
+        # Only users that have been looked up are cached
+        if self.lazy_lookups and user_info['id'] not in self.user_map:
+            return
 
         # Update the nick mapping if the user changed their nickname
         try:
-            old_nick = self.user_map[user_info['id']]['nick']
-        except KeyError as e:
+            old_nick = self.user_map[user_info['id']]['name']
+        except KeyError:
             old_nick = None
 
-        if old_nick and old_nick != user_info['nick']:
-            del self.user_nick_to_id[old_nick]
-            self.user_nick_to_id[user_info['nick']] = user_info['id']
+        if old_nick and old_nick != user_info['name']:
+            self.user_nick_to_id.pop(old_nick, None)
+
+        self.cache_user(user_info)
 
     def on_reconnect_url(self, msg):
         """
@@ -281,94 +1034,236 @@ class SlackWS(Connection):
         """
         updates user's presence in ``self.user_map``
         """
-        try::
-            self.log.debug('updated_presence: {} ({}) was: {} is_now: {}'.format(
-                msg['user'], self.user_map[msg['user']]['name'],
+        try:
+            self.log.debug(
+                'updated_presence: %s (%s) was: %s is_now: %s', msg['user'],
+                self.user_map[msg['user']]['name'],
                 self.user_map[msg['user']].get('presence', '<undefined>'),
-                msg['presence']
-            ))
+                msg['presence'])
             self.user_map[msg['user']]['presence'] = msg['presence']
         except KeyError:
             pass
 
-    @memoize  # the dm id should never change
-    def get_dm_id_by_user(self, user_id):
+    async def get_dm_id_by_user(self, user_id):
         """
         Return the channel id for a direct message to a specific user.
 
+        DMs are looked up in ``dm_ids``, which is filled from the connect info
+        and kept current by the ``im_*`` events. The first miss loads every
+        open DM with one ``users.conversations`` call, after which only users
+        the bot has never talked to need ``conversations.open``. Opens of the
+        same user at the same time share one request.
+
         Args:
             user_id (str): slack user id
 
         Return:
             str: DM channel id for the provided user.  None on error
         """
-        url = 'https://slack.com/api/im.open?{}'.format(urlencode({
-            'token': self.token,
-            'user': user_id,
-        }))
+        if user_id in self.dm_ids:
+            return self.dm_ids[user_id]
 
-        req = urllib.request.Request(url)
-        r = urllib.request.urlopen(req).read().decode('utf-8')
+        if not self._dms_loaded:
+            await self._merged(('users.conversations', 'im'), self.load_dms)
+            if user_id in self.dm_ids:
+                return self.dm_ids[user_id]
 
-        data = json.loads(r)
+        r = await self._merged(('conversations.open', user_id),
+                               self._open_dm, user_id)
+        if r:
+            return r['channel']['id']
 
-        if not data['ok']:
-            self.log.error(data)
-            return
+    async def _open_dm(self, user_id):
+        async with self._dm_open_limit:
+            # it may have been opened while waiting
+            if user_id in self.dm_ids:
+                return {'channel': {'id': self.dm_ids[user_id]}}
 
-        return data['channel']['id']
+            self.log.debug('Opening a DM with {}'.format(user_id))
+            r = await self.api('conversations.open', users=user_id)
 
-    def get_users_by_channel(self, channel):
-        channel = self.channel_name_to_id[channel.replace('#', '')]
+        self.dm_ids[user_id] = r['channel']['id']
+        return r
 
-        if channel.startswith('G'):
-            key = 'group'
-        elif channel.startswith('C'):
-            key = 'channel'
-        else:
+    def on_im_created(self, msg):
+        """
+        A DM was opened with the bot for the first time
+
+        https://api.slack.com/events/im_created
+        """
+        channel = msg['channel']
+        channel.setdefault('is_im', True)
+        channel.setdefault('user', msg.get('user'))
+        self.cache_channel(channel)
+
+    def on_im_open(self, msg):
+        """
+        A closed DM was opened again
+
+        https://api.slack.com/events/im_open
+        """
+        self.dm_ids[msg['user']] = msg['channel']
+
+    def on_im_close(self, msg):
+        """
+        A DM was closed. It is opened again the next time the bot sends to it.
+
+        https://api.slack.com/events/im_close
+        """
+        if self.dm_ids.get(msg['user']) == msg['channel']:
+            del self.dm_ids[msg['user']]
+
+    async def get_users_by_channel(self, channel):
+        """
+        Return the nicknames of the members of ``#channel``. Members not
+        already cached are looked up ``user_lookup_concurrency`` at a time,
+        or with ``users.list`` when there are more than a page of them.
+        """
+        try:
+            channel = await self.get_channel_id(channel)
+        except KeyError:
             return
 
-        url = 'https://slack.com/api/{}s.info?{}'.format(
-            key, urlencode({
-                'token': self.token,
-                'channel': channel,
-            }))
+        self.log.debug('Gathering list of users for channel %s', channel)
 
-        self.log.debug('Gathering list of users for channel {} from: '
-                       '{}'.format(channel, url))
-        req = urllib.request.Request(url)
-        r = json.loads(urllib.request.urlopen(req).read().decode('utf-8'))
+        member_ids = []
+        cursor = None
+        while True:
+            params = {'channel': channel, 'limit': 200}
+            if cursor:
+                params['cursor'] = cursor
+            try:
+                r = await self.api('conversations.members', **params)
+            except SlackError as e:
+                self.log.error(e)
+                return
+
+            member_ids.extend(r.get('members', []))
 
-        users = []
-        for u_id in r[key]['members']:
-            users.append(self.user_map[u_id]['name'])
+            cursor = r.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
 
-        return users
+        missing = [u for u in member_ids if u not in self.user_map]
+        if len(missing) > 200:
+            # fewer calls than looking each of them up
+            await self._merged(('users.list', None), self.load_users)
+
+        users = await asyncio.gather(*[self._get_member(u)
+                                       for u in member_ids])
+        return [u['name'] for u in users if u]
+
+    async def _get_member(self, user_id, retries=3):
+        """
+        :meth:`get_user` for a channel member. A failed lookup, e.g. while
+        rate limited, is tried again so the member isn't left out.
+        """
+        user = self.user_map.get(user_id)
+        delay = 1
+        for attempt in range(retries):
+            if user is not None:
+                break
+            if attempt:
+                await asyncio.sleep(delay)
+                delay *= 2
+            async with self._user_lookup_limit:
+                user = await self.get_user(user_id)
+
+        if user is None:
+            self.log.warning('Unable to look up channel member {}'.format(
+                user_id))
+        return user
 
     def start_ping(self, *args, **kwargs):
         """
-        Starts the ping schedule to help keep the connection open.
+        Starts the ping schedule to help keep the connection open and detect
+        when it has died.
+        """
+        self.stop_ping()
+        self.last_recv = self._loop.time()
+        self._ping_handle = self._loop.call_later(
+            self.ping_interval, self.check_liveness)
+
+    def stop_ping(self):
+        if self._ping_handle:
+            self._ping_handle.cancel()
+            self._ping_handle = None
+        self._pings.clear()
+
+    def check_liveness(self):
+        """
+        Declare the connection dead if too many pings went unanswered,
+        otherwise ping slack if nothing has been received for a while.
+        """
+        self._ping_handle = None
+        now = self._loop.time()
+
+        if len(self._pings) >= self.ping_max_missed:
+            self.declare_dead('{} pings went unanswered'.format(
+                len(self._pings)))
+            return
+
+        if self._pings:
+            oldest = (now - min(self._pings.values())) * 1000
+            if oldest > self.ping_max_lag_ms:
+                self.declare_dead('no pong for {:.0f}ms'.format(oldest))
+                return
+
+        idle = now - self.last_recv
+        if idle >= self.ping_interval:
+            asyncio.ensure_future(self.do_ping())
+            delay = self.ping_interval
+        else:
+            # Traffic is flowing, check again once it has been quiet for a
+            # full interval
+            delay = self.ping_interval - idle
+
+        self._ping_handle = self._loop.call_later(delay, self.check_liveness)
+
+    def declare_dead(self, reason):
+        """
+        Drop the connection so :meth:`read` reconnects straight away instead
+        of waiting for the socket to time out.
         """
-        asyncio.ensure_future(self.do_ping())
+        self.log.error('Slack connection is dead: {}. Reconnecting'.format(
+            reason))
+        self.stop_ping()
+        self.status = CONNECTING
+
+        if self.ws:
+            # Abort rather than close. A half-open socket would never complete
+            # the closing handshake.
+            transport = getattr(self.ws, 'transport', None)
+            if transport:
+                transport.abort()
+            asyncio.ensure_future(self.ws.close())
 
     async def do_ping(self):
         """
         Send a ping to Slack
         """
         self._internal_pingid += 1
+        self._pings[self._internal_pingid] = self._loop.time()
         msg = json.dumps({
             'id': self._internal_pingid,
             'type': 'ping',
             'time': time.time() * 1000,
         })
-        await self._send(msg)
-        self._loop.call_later(4, self.start_ping)
+        try:
+            await self._send(msg)
+        except websockets.ConnectionClosed:
+            # read() will notice and reconnect
+            pass
 
     def on_pong(self, msg):
         now = time.time() * 1000
 
+        self._pings.pop(msg.get('reply_to'), None)
         self.lag_in_ms = now - msg['time']
 
+        if self.lag_in_ms > self.ping_max_lag_ms:
+            self.declare_dead('lag is {:.0f}ms'.format(self.lag_in_ms))
+
     async def on_group_join(self, channel):
         """
         The group_joined event is sent to all connections for a user when that
@@ -473,16 +1368,106 @@ class SlackWS(Connection):
         """
         When someone shares a file
         """
+        self.file_event(msg)
 
     def on_file_public(self, msg):
         """
         When someone shares a file publically
         """
+        self.file_event(msg)
+
+    def subscribe_files(self, callback):
+        """
+        Call ``callback`` with a
+        :class:`warmachine.utils.files.SharedFile` for every file shared on
+        this connection. The file is only downloaded if a subscriber reads
+        it::
+
+            async def on_file(connection, shared_file):
+                async for chunk in shared_file.chunks():
+                    ...
+
+            connection.subscribe_files(on_file)
+
+        Args:
+            callback (coroutine function): called with the connection and the
+                file
+        """
+        if callback not in self._file_subscribers:
+            self._file_subscribers.append(callback)
+
+    def unsubscribe_files(self, callback):
+        if callback in self._file_subscribers:
+            self._file_subscribers.remove(callback)
+
+    @property
+    def file_store(self):
+        """
+        :class:`warmachine.utils.files.FileStore`: where shared files are
+            downloaded to. Created the first time a file is shared
+        """
+        if self._file_store is None:
+            directory = os.path.join(self.config_dir or os.getcwd(), 'files',
+                                     self.id)
+            self._file_store = FileStore(
+                directory, max_size=self.file_max_size,
+                max_downloads=self.file_downloads,
+                cache_size=self.file_cache_size)
+        return self._file_store
+
+    def file_event(self, msg):
+        file_id = msg.get('file_id') or msg.get('file', {}).get('id')
+        if not file_id or not self._file_subscribers:
+            return
+
+        if file_id in self._files_seen:
+            return
+        self._files_seen[file_id] = True
+        if len(self._files_seen) > 1000:
+            self._files_seen.popitem(last=False)
+
+        asyncio.ensure_future(self.share_file(file_id))
+
+    async def share_file(self, file_id):
+        """
+        Look up a shared file and pass it to the subscribers
+        """
+        try:
+            info = (await self.api('files.info', file=file_id))['file']
+        except Exception:
+            self.log.exception('Error looking up file {}'.format(file_id))
+            return
+
+        url = info.get('url_private_download') or info.get('url_private')
+        if not url:
+            self.log.debug('File {} can not be downloaded'.format(file_id))
+            return
+        if info.get('size', 0) > self.file_max_size:
+            self.log.info('Ignoring file {} {}: {} bytes is over the {} byte '
+                          'limit'.format(file_id, info.get('name'),
+                                         info['size'], self.file_max_size))
+            return
+
+        shared_file = SharedFile(
+            self.file_store, info, url,
+            headers={'Authorization': 'Bearer {}'.format(self.token)})
+
+        subscribers = list(self._file_subscribers)
+        results = await asyncio.gather(
+            *[callback(self, shared_file) for callback in subscribers],
+            return_exceptions=True)
+        for callback, result in zip(subscribers, results):
+            if isinstance(result, Exception):
+                self.log.error('Error passing file {} to {}: {!r}'.format(
+                    file_id, getattr(callback, '__qualname__', callback),
+                    result))
 
     def on_channel_joined(self, msg):
         """
         When joining an public channel
         """
+        self.cache_channel(msg['channel'])
+
         # {'type': 'channel_joined',
         #  'channel': {
         #      'members': ['U0286NL58', 'U1U05AF5J'],
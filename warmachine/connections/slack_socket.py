@@ -0,0 +1,356 @@
+import asyncio
+import collections
+import json
+
+import websockets
+
+from .base import INITALIZED, CONNECTED, CONNECTING
+from .slack import SlackWS, SlackError
+from ..utils.http import HTTPError, HTTPPool, RequestNotSent
+from ..utils.profiling import startup_profiler
+
+#: Define slack-socket as a config section prefix
+__config_prefix__ = 'slack-socket'
+
+
+class SlackSocketMode(SlackWS):
+    """
+    Slack connection using Socket Mode instead of the RTM api.
+
+    Events arrive over one or more websockets opened with
+    ``apps.connections.open`` using the app level token. Each event envelope
+    is acknowledged on the socket it came from. Messages are sent with the web
+    api using the bot token.
+
+    Slack may deliver an event on more than one socket, so recently seen event
+    ids are remembered and duplicates dropped.
+    """
+    def __init__(self, options, *args, **kwargs):
+        super().__init__(options, *args, **kwargs)
+
+        self.app_token = options['app_token']
+        self.api_url = options.get('api_url', 'https://slack.com/api/')
+        if not self.api_url.endswith('/'):
+            self.api_url += '/'
+
+        # number of sockets to keep open
+        self.num_sockets = int(options.get('sockets', 2))
+        # seconds to wait collecting acks before sending them
+        self.ack_interval = float(options.get('ack_interval', 0.05))
+
+        self.http = HTTPPool(size=int(options.get('http_pool_size', 4)))
+
+        # open sockets -> reader task
+        self.sockets = {}
+        # socket -> list of envelope ids waiting to be acknowledged
+        self._acks = {}
+        self._ack_handle = None
+
+        self._seen_ids = set()
+        self._seen_order = collections.deque()
+        self._seen_max = 1000
+
+        self._closing = False
+
+    async def api(self, method, token=None, **params):
+        """
+        Call a web api method.
+
+        Args:
+            method (str): api method, e.g. ``chat.postMessage``
+            token (str): token to use. Defaults to the bot token
+            **params: arguments for the method
+
+        Returns:
+            dict: slack's response
+
+        Raises:
+            SlackError: if slack returns an error
+        """
+        headers = {'Authorization': 'Bearer {}'.format(token or self.token)}
+        r = await self.http.post_form(self.api_url + method, params,
+                                      headers=headers)
+
+        if not r.get('ok', False):
+            raise SlackError('{}: {}'.format(method, r.get('error',
+                                                           'Unknown Error')))
+        return r
+
+    async def connect(self):
+        self._closing = False
+        self.status = CONNECTING
+
+        try:
+            with startup_profiler.measure('authenticate {}'.format(
+                    self.section_name)):
+                await self.authenticate()
+        except Exception:
+            self.log.exception('Error authenticating to slack')
+            return
+
+        try:
+            for _ in range(self.num_sockets - len(self.sockets)):
+                await self.open_socket()
+        except Exception:
+            self.log.exception('Error opening socket mode connection')
+            return
+
+        self.start_warm_users()
+
+        self.status = CONNECTED
+        return True
+
+    async def authenticate(self):
+        """
+        Find out who the bot is and which channels it is in.
+        """
+        info = await self.api('auth.test')
+        self.my_id = info.get('user_id', '000')
+        self.nick = info.get('user', None)
+
+        # With lazy lookups users are fetched as they are referenced and
+        # channel names the first time one is used
+        if not self.lazy_lookups:
+            await self.load_users()
+            await self.load_channels()
+
+    async def open_socket(self):
+        """
+        Open a new socket and start reading events from it.
+
+        Returns:
+            the new websocket
+        """
+        r = await self.api('apps.connections.open', token=self.app_token)
+
+        self.log.info('Opening socket mode connection')
+        ws = await websockets.connect(r['url'])
+
+        self.sockets[ws] = asyncio.ensure_future(self._read_socket(ws))
+        self._acks[ws] = []
+
+        return ws
+
+    async def _close_socket(self, ws):
+        task = self.sockets.pop(ws, None)
+        self._flush_acks(ws)
+        self._acks.pop(ws, None)
+
+        if task:
+            task.cancel()
+
+        await ws.close()
+
+    async def _read_socket(self, ws):
+        """
+        Read envelopes from a socket until it closes, then replace it.
+        """
+        try:
+            while True:
+                try:
+                    frame = await ws.recv()
+                except websockets.ConnectionClosed as e:
+                    self.log.error('Socket mode connection closed: {}'.format(
+                        e))
+                    break
+
+                try:
+                    self._handle_envelope(ws, json.loads(frame))
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.log.exception('Error handling envelope {!r}'.format(
+                        frame))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.log.exception('Error reading from socket mode connection')
+            asyncio.ensure_future(ws.close())
+        finally:
+            # Always forgotten, or a dead socket would count as open and
+            # never be replaced
+            self.sockets.pop(ws, None)
+            self._acks.pop(ws, None)
+
+        if not self._closing and len(self.sockets) < self.num_sockets:
+            await self._replace_socket()
+
+    def _handle_envelope(self, ws, envelope):
+        self.last_recv = self._loop.time()
+
+        if 'envelope_id' in envelope:
+            self.ack(ws, envelope['envelope_id'])
+
+        etype = envelope.get('type')
+        if etype == 'hello':
+            self.log.info('Connected to Slack (socket mode, {} '
+                          'sockets)'.format(len(self.sockets)))
+
+        elif etype == 'disconnect':
+            # Slack is about to close this socket. Open its replacement first
+            # so no events are missed.
+            self.log.info('Rotating socket: {}'.format(
+                envelope.get('reason')))
+            if not self._closing:
+                asyncio.ensure_future(self._rotate(ws))
+
+        elif etype == 'events_api':
+            event_id = envelope.get('payload', {}).get('event_id')
+            if not self._seen(event_id):
+                self.queue_event(envelope['payload']['event'])
+
+        else:
+            self.log.debug('Ignoring socket mode envelope: %s', envelope)
+
+    async def _rotate(self, ws):
+        try:
+            await self.open_socket()
+        except Exception:
+            self.log.exception('Unable to open replacement socket')
+        await self._close_socket(ws)
+
+    async def _replace_socket(self):
+        delay = 1
+        while not self._closing:
+            try:
+                await self.open_socket()
+                return
+            except Exception:
+                self.log.exception('Unable to reopen socket. Trying again in '
+                                   '{}s'.format(delay))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 300)
+
+    def _seen(self, event_id):
+        """
+        Returns:
+            bool: True if the event was already received
+        """
+        if not event_id:
+            return False
+        if event_id in self._seen_ids:
+            return True
+
+        self._seen_ids.add(event_id)
+        self._seen_order.append(event_id)
+        if len(self._seen_order) > self._seen_max:
+            self._seen_ids.discard(self._seen_order.popleft())
+        return False
+
+    def ack(self, ws, envelope_id):
+        """
+        Queue an acknowledgement. Acks are collected for ``ack_interval``
+        seconds and written to their sockets together.
+        """
+        if ws not in self._acks:
+            return
+
+        self._acks[ws].append(envelope_id)
+        if not self._ack_handle:
+            self._ack_handle = self._loop.call_later(
+                self.ack_interval, self._flush_all_acks)
+
+    def _flush_all_acks(self):
+        self._ack_handle = None
+        for ws in list(self._acks):
+            self._flush_acks(ws)
+
+    def _flush_acks(self, ws):
+        ids = self._acks.get(ws)
+        if not ids:
+            return
+        self._acks[ws] = []
+
+        frames = [json.dumps({'envelope_id': i}) for i in ids]
+        asyncio.ensure_future(self._send_acks(ws, frames))
+
+    async def _send_acks(self, ws, frames):
+        try:
+            for f in frames:
+                await ws.send(f)
+        except websockets.ConnectionClosed:
+            # Slack resends unacknowledged events
+            self.log.warning('Unable to acknowledge {} events'.format(
+                len(frames)))
+
+    async def send_frame(self, frame):
+        """
+        Send a message with ``chat.postMessage``.
+
+        Returns:
+            :class:`asyncio.Future`: resolved with slack's response
+        """
+        await self._send_window.acquire()
+
+        future = self._loop.create_future()
+        self.log.debug('Saying %s', frame)
+
+        task = asyncio.ensure_future(self._post(frame, future))
+        task.add_done_callback(lambda t: self._send_window.release())
+
+        return future
+
+    async def _post(self, frame, future, retries=3):
+        for attempt in range(retries):
+            try:
+                r = await self.http.post_form(
+                    self.api_url + 'chat.postMessage',
+                    {'channel': frame['channel'], 'text': frame['text']},
+                    headers={'Authorization': 'Bearer {}'.format(self.token)})
+            except RequestNotSent as e:
+                self.log.error('Error sending message: {}'.format(e))
+                await asyncio.sleep(2 ** attempt)
+                continue
+            except HTTPError as e:
+                if e.status == 429:
+                    # rate limited, so it wasn't posted
+                    await asyncio.sleep(2 ** attempt)
+                    continue
+                self.log.error('Error sending message: {}'.format(e))
+                break
+            except Exception as e:
+                # Slack may have posted it, so sending it again could post
+                # it twice
+                self.log.error('Error sending message, not retrying: '
+                               '{!r}'.format(e))
+                break
+
+            if not r.get('ok', False):
+                self.log.error('Slack rejected message {}: {}'.format(
+                    frame, r.get('error')))
+
+            if not future.done():
+                future.set_result(r)
+            return
+
+        if not future.done():
+            future.set_result({'ok': False, 'error': 'send_failed'})
+
+    async def edit(self, message_id, message, destination):
+        if destination.startswith('#'):
+            destination = await self.get_channel_id(destination)
+
+        return await self.api('chat.update', channel=destination,
+                              ts=message_id, text=str(message))
+
+    async def disconnect(self):
+        self._closing = True
+        self.status = INITALIZED
+
+        if self._warm_task:
+            self._warm_task.cancel()
+            self._warm_task = None
+
+        if self._pending_read:
+            self._pending_read.cancel()
+            self._pending_read = None
+
+        for ws in list(self.sockets):
+            await self._close_socket(ws)
+
+        self.http.close()
+
+    def start_ping(self, *args, **kwargs):
+        """
+        The websockets library pings the sockets itself
+        """
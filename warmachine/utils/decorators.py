@@ -1,4 +1,3 @@
-from collections import Hashable
 import functools
 from hashlib import sha1 as hash_
 import logging
@@ -25,12 +24,14 @@ class memoize(object):
 
         h = self._hash(str(args) + str(kwargs))
         if h in self.cache:
-            self.log.debug('Using cached value for {}({}, {})'.format(
-                self.func.__name__, ', '.join(str(a) for a in args),
-                ','.join('{}={} '.format(k, v) for k, v in kwargs.items())))
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug('Using cached value for {}({}, {})'.format(
+                    self.func.__name__, ', '.join(str(a) for a in args),
+                    ','.join('{}={} '.format(k, v)
+                             for k, v in kwargs.items())))
             return self.cache[h]
         else:
-            self.log.debug('Caching value')
+            self.log.debug('Caching value for %s', self.func.__name__)
             value = self.func(*args, **kwargs)
             self.cache[h] = value
 
@@ -0,0 +1,248 @@
+import asyncio
+import collections
+import logging
+
+#: Wait for room in the queue, pausing the connection's reader
+BLOCK = 'block'
+#: Drop the oldest queued message to make room
+DROP_OLDEST = 'drop-oldest'
+#: Drop the oldest queued message from a bot, falling back to
+#: :data:`DROP_OLDEST` when there isn't one
+DROP_BOTS = 'drop-bots'
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_BOTS)
+
+
+def is_bot_message(message):
+    """
+    Default test for bot chatter used by the :data:`DROP_BOTS` policy.
+    """
+    return bool(message.get('is_bot', False))
+
+
+class ChannelDispatcher(object):
+    """
+    Bounded inbound message queue for a connection.
+
+    Messages are queued per channel and handed to ``handler`` by a fixed number
+    of workers. Only one worker processes a channel at a time so messages for
+    a channel are handled in the order they were received, while different
+    channels are handled concurrently. Private messages are queued per sender.
+    """
+    def __init__(self, handler, maxsize=1000, workers=8, policy=BLOCK,
+                 is_low_priority=is_bot_message, name=''):
+        """
+        Args:
+            handler (coroutine function): called with each message
+            maxsize (int): the maximum number of queued messages
+            workers (int): the number of channels processed concurrently
+            policy (str): what to do when the queue is full. One of
+                :data:`POLICIES`
+            is_low_priority (callable): returns True for messages the
+                :data:`DROP_BOTS` policy should drop first
+            name (str): name used when logging
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy {}. Use one of: {}'.format(
+                policy, ', '.join(POLICIES)))
+
+        self._loop = asyncio.get_event_loop()
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.handler = handler
+        self.maxsize = maxsize
+        self.workers = workers
+        self.policy = policy
+        self.is_low_priority = is_low_priority
+        self.name = name
+
+        # channel key -> deque of (sequence number, message)
+        self._queues = {}
+        # channel keys with queued messages and no worker processing them
+        self._ready = asyncio.Queue()
+        self._seq = 0
+
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+        self._worker_tasks = []
+
+        # monitoring
+        self.depth = 0
+        self.high_water = 0
+        self.dropped = 0
+        self.processed = 0
+        self.active = 0
+
+    def start(self):
+        """
+        Start the workers
+        """
+        if self._worker_tasks:
+            return
+
+        for _ in range(self.workers):
+            self._worker_tasks.append(asyncio.ensure_future(self._work()))
+
+    def stop(self):
+        """
+        Stop the workers. Queued messages are kept and handled once the
+        workers are started again. Messages being handled are cancelled.
+        """
+        for t in self._worker_tasks:
+            t.cancel()
+        self._worker_tasks = []
+
+    async def join(self):
+        """
+        Wait until every queued message has been processed
+        """
+        while self.depth or self.active:
+            await asyncio.sleep(0.05)
+
+    @classmethod
+    def channel_key(cls, message):
+        """
+        Returns the key messages are ordered by
+        """
+        if message.get('channel'):
+            return message['channel']
+        return (None, message.get('sender'))
+
+    async def put(self, message):
+        """
+        Queue ``message``, applying the overflow policy if the queue is full.
+        """
+        while self.depth >= self.maxsize:
+            if self.policy == BLOCK:
+                self._not_full.clear()
+                await self._not_full.wait()
+                continue
+
+            if not self._drop(message):
+                # The incoming message is the one to drop
+                self._count_drop()
+                return
+
+        key = self.channel_key(message)
+        self._seq += 1
+
+        if key not in self._queues:
+            self._queues[key] = collections.deque()
+            self._ready.put_nowait(key)
+
+        self._queues[key].append((self._seq, message))
+
+        self.depth += 1
+        if self.depth > self.high_water:
+            self.high_water = self.depth
+
+    def _drop(self, incoming):
+        """
+        Drop a queued message according to the overflow policy.
+
+        Returns:
+            bool: False if ``incoming`` should be dropped instead
+        """
+        oldest = None
+        if self.policy == DROP_BOTS:
+            oldest = self._oldest(self.is_low_priority)
+
+            if not oldest and self.is_low_priority(incoming):
+                return False
+
+        if not oldest:
+            oldest = self._oldest()
+
+        if not oldest:
+            return False
+
+        # An emptied channel queue is left for its worker to clean up so the
+        # channel can't be scheduled twice.
+        key, entry = oldest
+        self._queues[key].remove(entry)
+        self.depth -= 1
+        self._count_drop()
+
+        return True
+
+    def _oldest(self, match=None):
+        """
+        Find the oldest queued message, optionally only considering messages
+        ``match`` returns True for.
+
+        Returns:
+            tuple: (channel key, queue entry) or None
+        """
+        oldest = None
+        for key, queue in self._queues.items():
+            for entry in queue:
+                if match is None or match(entry[1]):
+                    if oldest is None or entry[0] < oldest[1][0]:
+                        oldest = (key, entry)
+                    break
+
+        return oldest
+
+    def _count_drop(self):
+        self.dropped += 1
+        # Don't flood the log during a burst
+        if self.dropped == 1 or self.dropped % 100 == 0:
+            self.log.warning('{}: inbound queue full ({} messages), {} '
+                             'dropped so far'.format(
+                                 self.name, self.maxsize, self.dropped))
+
+    async def _work(self):
+        while True:
+            key = await self._ready.get()
+            try:
+                await self._work_channel(key)
+            finally:
+                # Runs when the worker is cancelled too, so a channel with
+                # queued messages isn't orphaned by :meth:`stop`
+                if self._queues.get(key):
+                    # Go to the back of the line so busy channels don't
+                    # starve the others
+                    self._ready.put_nowait(key)
+                else:
+                    self._queues.pop(key, None)
+
+    async def _work_channel(self, key):
+        """
+        Handle the next message queued for the channel ``key``
+        """
+        queue = self._queues[key]
+        if not queue:
+            # Everything queued for this channel was dropped
+            return
+
+        _, message = queue.popleft()
+        self.depth -= 1
+        self._not_full.set()
+
+        self.active += 1
+        try:
+            await self.handler(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.log.exception('Error handling message {}'.format(message))
+        finally:
+            self.active -= 1
+            self.processed += 1
+
+    def stats(self):
+        """
+        Returns:
+            dict: queue depth and counters for monitoring
+        """
+        return {
+            'depth': self.depth,
+            'maxsize': self.maxsize,
+            'high_water': self.high_water,
+            'channels': len(self._queues),
+            'active': self.active,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'policy': self.policy,
+        }
@@ -0,0 +1,209 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import functools
+import logging
+import time
+
+
+def _timed_call(func, args, kwargs):
+    """
+    Runs in the pool. Returns when the call actually started so the time spent
+    waiting in the pool's queue can be measured.
+    """
+    started = time.monotonic()
+    return started, func(*args, **kwargs)
+
+
+class ExecutorPool(object):
+    """
+    Bounded thread and process pools owned by the bot and shared by all
+    plugins. Each plugin gets its own :class:`PluginExecutor` with a quota on
+    how much of the pools it may use at once.
+    """
+    _default = None
+
+    def __init__(self, thread_workers=8, process_workers=2):
+        """
+        Args:
+            thread_workers (int): size of the thread pool used for blocking
+                calls
+            process_workers (int): size of the process pool used for CPU heavy
+                calls
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+
+        self.thread_pool = ThreadPoolExecutor(max_workers=thread_workers)
+        # Created the first time a plugin needs it
+        self._process_pool = None
+
+        # plugin name -> PluginExecutor
+        self.plugin_executors = {}
+
+    @classmethod
+    def default(cls):
+        """
+        Returns:
+            ExecutorPool: pool used by plugins created outside of the bot
+        """
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    @property
+    def process_pool(self):
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(
+                max_workers=self.process_workers)
+        return self._process_pool
+
+    def for_plugin(self, name, max_blocking=4, max_cpu=1):
+        """
+        Create the executor a plugin uses to access the pools.
+
+        Args:
+            name (str): plugin name used for metrics
+            max_blocking (int): the number of blocking calls the plugin may
+                run at the same time
+            max_cpu (int): the number of CPU heavy calls the plugin may run at
+                the same time
+
+        Returns:
+            PluginExecutor: the plugin's executor
+        """
+        executor = PluginExecutor(self, name, max_blocking, max_cpu)
+        self.plugin_executors[name] = executor
+        return executor
+
+    def stats(self):
+        """
+        Returns:
+            dict: per plugin metrics keyed by the plugin name
+        """
+        return {name: e.stats() for name, e in self.plugin_executors.items()}
+
+    def shutdown(self, wait=False):
+        for e in list(self.plugin_executors.values()):
+            e.cancel_all()
+
+        self.thread_pool.shutdown(wait=wait)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=wait)
+
+
+class PluginExecutor(object):
+    """
+    A plugin's handle on the :class:`ExecutorPool`. Enforces the plugin's
+    concurrency quotas, tracks its calls so they can be cancelled when the
+    plugin is unloaded and records how long calls wait and run.
+    """
+    def __init__(self, pool, name, max_blocking, max_cpu):
+        self._loop = asyncio.get_event_loop()
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.pool = pool
+        self.name = name
+        self.closed = False
+
+        self._semaphores = {
+            'blocking': asyncio.Semaphore(max_blocking),
+            'cpu': asyncio.Semaphore(max_cpu),
+        }
+        self._futures = set()
+
+        self.metrics = {}
+        for kind in self._semaphores:
+            self.metrics[kind] = {
+                'calls': 0,
+                'errors': 0,
+                'running': 0,
+                'queue_wait': 0.0,
+                'max_queue_wait': 0.0,
+                'run_time': 0.0,
+                'max_run_time': 0.0,
+            }
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """
+        Run ``func(*args, **kwargs)`` in the thread pool.
+
+        Returns:
+            the return value of ``func``
+        """
+        return await self._run('blocking', self.pool.thread_pool, func, args,
+                               kwargs)
+
+    async def run_cpu(self, func, *args, **kwargs):
+        """
+        Run ``func(*args, **kwargs)`` in the process pool. ``func`` and its
+        arguments must be picklable.
+
+        Returns:
+            the return value of ``func``
+        """
+        return await self._run('cpu', self.pool.process_pool, func, args,
+                               kwargs)
+
+    async def _run(self, kind, executor, func, args, kwargs):
+        if self.closed:
+            raise asyncio.CancelledError()
+
+        metrics = self.metrics[kind]
+        queued = time.monotonic()
+
+        async with self._semaphores[kind]:
+            # The plugin may have been unloaded while we were waiting
+            if self.closed:
+                raise asyncio.CancelledError()
+
+            f = self._loop.run_in_executor(
+                executor, functools.partial(_timed_call, func, args, kwargs))
+            self._futures.add(f)
+
+            metrics['running'] += 1
+            try:
+                started, result = await f
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                metrics['errors'] += 1
+                raise
+            else:
+                finished = time.monotonic()
+                self._record(metrics, started - queued, finished - started)
+            finally:
+                metrics['running'] -= 1
+                metrics['calls'] += 1
+                self._futures.discard(f)
+
+        return result
+
+    def _record(self, metrics, queue_wait, run_time):
+        metrics['queue_wait'] += queue_wait
+        metrics['run_time'] += run_time
+        metrics['max_queue_wait'] = max(metrics['max_queue_wait'], queue_wait)
+        metrics['max_run_time'] = max(metrics['max_run_time'], run_time)
+
+    def cancel_all(self):
+        """
+        Cancel all calls made by the plugin and refuse new ones. Calls that
+        haven't started are removed from the pool's queue. Calls already
+        running can't be interrupted but their results are discarded.
+        """
+        self.closed = True
+
+        for f in list(self._futures):
+            f.cancel()
+
+        self.pool.plugin_executors.pop(self.name, None)
+
+        self.log.info('Cancelled pending calls for {}'.format(self.name))
+
+    def stats(self):
+        """
+        Returns:
+            dict: copies of the metrics for blocking and cpu calls
+        """
+        return {kind: dict(m) for kind, m in self.metrics.items()}
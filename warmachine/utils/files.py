@@ -0,0 +1,343 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import tempfile
+from urllib.parse import urljoin, urlsplit
+
+from .http import HTTPError, HTTPPool
+
+#: Statuses the store follows to the file's real location
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 3
+#: Number of keys remembered, so a key seen again skips the download
+MAX_KEYS = 1000
+
+
+class FileTooLarge(Exception):
+    """
+    The file is bigger than the store allows
+    """
+
+
+class StoredFile(object):
+    """
+    A downloaded file in the store, named after the sha256 of its contents.
+    """
+    __slots__ = ('path', 'sha256', 'size')
+
+    def __init__(self, path, sha256, size):
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+
+    def chunks(self, chunk_size=64*1024):
+        """
+        Returns:
+            :class:`FileReader`: async iterator over the contents
+        """
+        return FileReader(self.path, chunk_size)
+
+
+class FileReader(object):
+    """
+    Reads a file in chunks on the default executor. The file is opened on the
+    first read, so it stays readable even if the store evicts it afterwards.
+    """
+    def __init__(self, path, chunk_size=64*1024, opener=None):
+        """
+        Args:
+            path (str): file to read
+            chunk_size (int): bytes read at a time
+            opener (coroutine function): returns the path to read instead of
+                ``path``, e.g. once a download finishes
+        """
+        self._loop = asyncio.get_event_loop()
+        self.path = path
+        self.chunk_size = chunk_size
+        self._opener = opener
+        self._f = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._f is None:
+            if self._opener is not None:
+                self.path = await self._opener()
+            self._f = open(self.path, 'rb')
+
+        chunk = await self._loop.run_in_executor(None, self._f.read,
+                                                 self.chunk_size)
+        if not chunk:
+            self.close()
+            raise StopAsyncIteration
+        return chunk
+
+    def close(self):
+        if self._f is not None and not self._f.closed:
+            self._f.close()
+
+
+class FileStore(object):
+    """
+    Downloads files to disk in chunks, so a file never has to fit in memory.
+
+    Files are stored under the sha256 of their contents, so the same content
+    shared twice is kept once. Downloads of the same key at the same time
+    share one request and at most ``max_downloads`` run at once. Once the
+    files take more than ``cache_size`` bytes the least recently fetched are
+    removed.
+    """
+    def __init__(self, directory, max_size=50*1024*1024, max_downloads=2,
+                 cache_size=1024*1024*1024, chunk_size=64*1024):
+        """
+        Args:
+            directory (str): where files are stored
+            max_size (int): largest file in bytes that will be downloaded
+            max_downloads (int): number of downloads run at once
+            cache_size (int): bytes of files to keep
+            chunk_size (int): bytes read from the network at a time
+        """
+        self._loop = asyncio.get_event_loop()
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.directory = directory
+        self.max_size = max_size
+        self.cache_size = cache_size
+        self.chunk_size = chunk_size
+
+        # the pool size limits the concurrent downloads. It is separate from
+        # any pool used for api calls so downloads can't starve them.
+        self.http = HTTPPool(size=max_downloads)
+
+        # sha256 -> size, least recently used first
+        self._files = OrderedDict()
+        self.size = 0
+        # key, e.g. the server's file id -> sha256, least recently used first
+        self._keys = OrderedDict()
+        # key -> task downloading it
+        self._downloads = {}
+
+        # monitoring
+        self.downloads = 0
+        self.duplicates = 0
+        self.hits = 0
+        self.too_large = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """
+        Index the files already stored and remove partial downloads
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('tmp'):
+                os.unlink(path)
+            elif len(name) == 64:
+                st = os.stat(path)
+                entries.append((st.st_mtime, name, st.st_size))
+
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self.size += size
+
+    def path(self, sha256):
+        return os.path.join(self.directory, sha256)
+
+    def get(self, key):
+        """
+        Returns:
+            :class:`StoredFile`: the file stored for ``key`` or None
+        """
+        sha256 = self._keys.get(key)
+        if sha256 is None or sha256 not in self._files:
+            return None
+        self._keys.move_to_end(key)
+        self._files.move_to_end(sha256)
+        return StoredFile(self.path(sha256), sha256, self._files[sha256])
+
+    async def fetch(self, key, url, headers=None, size=None):
+        """
+        Return the file for ``key``, downloading it from ``url`` if it isn't
+        stored yet.
+
+        Args:
+            key (str): identifies the file, e.g. the server's file id
+            url (str): where to download it from
+            headers (dict): request headers, e.g. authorization
+            size (int): the expected size, if known
+
+        Returns:
+            :class:`StoredFile`: the stored file
+
+        Raises:
+            FileTooLarge: if the file is bigger than ``max_size``
+            HTTPError: if the download fails
+        """
+        stored = self.get(key)
+        if stored is not None:
+            self.hits += 1
+            return stored
+
+        if size is not None and size > self.max_size:
+            self.too_large += 1
+            raise FileTooLarge('{} is {} bytes'.format(key, size))
+
+        task = self._downloads.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._download(key, url, headers))
+            self._downloads[key] = task
+            task.add_done_callback(lambda t: self._downloads.pop(key, None))
+
+        # shielded so a reader giving up doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    async def _download(self, key, url, headers):
+        headers = dict(headers or {})
+        host = urlsplit(url).hostname
+
+        for _ in range(MAX_REDIRECTS + 1):
+            resp = await self.http.stream('GET', url, headers=headers,
+                                          chunk_size=self.chunk_size)
+            if resp.status not in REDIRECTS:
+                break
+            resp.close()
+
+            location = resp.headers.get('Location') or \
+                resp.headers.get('location')
+            if not location:
+                raise HTTPError(resp.status, 'Redirect without a Location')
+            # may be relative to the url that was redirected
+            url = urljoin(url, location)
+            if urlsplit(url).hostname != host:
+                # don't hand credentials to another host
+                headers.pop('Authorization', None)
+        else:
+            raise HTTPError(resp.status, 'Too many redirects')
+
+        fd, tmp_path = tempfile.mkstemp(prefix='tmp', dir=self.directory)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                length = resp.content_length
+                if length is not None and length > self.max_size:
+                    self.too_large += 1
+                    raise FileTooLarge('{} is {} bytes'.format(key, length))
+
+                async for chunk in resp:
+                    size += len(chunk)
+                    if size > self.max_size:
+                        self.too_large += 1
+                        raise FileTooLarge('{} is over {} bytes'.format(
+                            key, self.max_size))
+                    # hashing and writing a chunk would stall the loop
+                    await self._loop.run_in_executor(
+                        None, self._write_chunk, f, digest, chunk)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        finally:
+            resp.close()
+
+        sha256 = digest.hexdigest()
+        self.downloads += 1
+        if sha256 in self._files:
+            self.duplicates += 1
+            os.unlink(tmp_path)
+            self._files.move_to_end(sha256)
+        else:
+            os.rename(tmp_path, self.path(sha256))
+            self._files[sha256] = size
+            self.size += size
+            self._evict()
+
+        self._keys[key] = sha256
+        self._keys.move_to_end(key)
+        if len(self._keys) > MAX_KEYS:
+            self._keys.popitem(last=False)
+        return StoredFile(self.path(sha256), sha256, size)
+
+    @staticmethod
+    def _write_chunk(f, digest, chunk):
+        digest.update(chunk)
+        f.write(chunk)
+
+    def _evict(self):
+        while self.size > self.cache_size and len(self._files) > 1:
+            sha256, size = self._files.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(self.path(sha256))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            'files': len(self._files),
+            'bytes': self.size,
+            'downloads': self.downloads,
+            'duplicates': self.duplicates,
+            'hits': self.hits,
+            'too_large': self.too_large,
+            'downloading': len(self._downloads),
+        }
+
+    def close(self):
+        self.http.close()
+
+
+class SharedFile(object):
+    """
+    A file shared on a connection, passed to the plugins subscribed to files.
+    The contents are downloaded the first time a subscriber reads them, once
+    for all subscribers.
+    """
+    def __init__(self, store, info, url, headers=None):
+        """
+        Args:
+            store (FileStore): the store to download to
+            info (dict): the server's information about the file
+            url (str): where to download it from
+            headers (dict): request headers for the download
+        """
+        self.store = store
+        self.info = info
+        self.id = info.get('id')
+        self.name = info.get('name')
+        self.size = info.get('size')
+        self.mimetype = info.get('mimetype')
+        self.user = info.get('user')
+        self._url = url
+        self._headers = headers
+
+    async def download(self):
+        """
+        Returns:
+            :class:`StoredFile`: the file on disk
+
+        Raises:
+            FileTooLarge: if the file is bigger than the store allows
+        """
+        return await self.store.fetch(self.id, self._url, self._headers,
+                                      self.size)
+
+    def chunks(self, chunk_size=64*1024):
+        """
+        Read the contents as an async iterator of bytes::
+
+            async for chunk in shared_file.chunks():
+                ...
+        """
+        async def opener():
+            return (await self.download()).path
+        return FileReader(None, chunk_size, opener=opener)
+
+    def __repr__(self):
+        return '<SharedFile {} {} ({} bytes)>'.format(self.id, self.name,
+                                                       self.size)
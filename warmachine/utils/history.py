@@ -0,0 +1,263 @@
+from array import array
+from collections import deque, OrderedDict
+import re
+import time
+
+#: Splits messages into the terms that are indexed
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def terms(text):
+    """
+    Returns:
+        set: the lowercase terms in ``text``
+    """
+    return set(t.lower() for t in TERM_RE.findall(text))
+
+
+class ChannelHistory(object):
+    """
+    Fixed capacity ring buffer of the messages said in one channel with an
+    inverted index of the terms in them.
+
+    Every message gets a sequence number. The message with sequence number
+    ``seq`` is stored in slot ``seq % capacity`` and the index maps each term
+    to the sequence numbers of the messages containing it, oldest first, so
+    evicting the oldest message only has to pop the front of its terms'
+    posting lists.
+    """
+    __slots__ = ('capacity', 'times', 'senders', 'texts', 'first_seq',
+                 'next_seq', 'index')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+
+        self.times = array('d', [0.0]) * capacity
+        self.senders = array('I', [0]) * capacity
+        self.texts = [None] * capacity
+
+        self.first_seq = 0  # oldest message still stored
+        self.next_seq = 0
+
+        # term -> deque of sequence numbers
+        self.index = {}
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    def append(self, ts, sender, text):
+        """
+        Add a message, evicting the oldest one if the buffer is full.
+
+        Args:
+            ts (float): time the message was received
+            sender (int): interned sender id
+            text (str): the message
+        """
+        if len(self) == self.capacity:
+            self.evict()
+
+        seq = self.next_seq
+        slot = seq % self.capacity
+
+        self.times[slot] = ts
+        self.senders[slot] = sender
+        self.texts[slot] = text
+
+        for t in terms(text):
+            if t not in self.index:
+                self.index[t] = deque()
+            self.index[t].append(seq)
+
+        self.next_seq += 1
+
+    def evict(self):
+        """
+        Remove the oldest message
+        """
+        if not len(self):
+            return
+
+        seq = self.first_seq
+        slot = seq % self.capacity
+
+        for t in terms(self.texts[slot]):
+            postings = self.index.get(t)
+            if postings and postings[0] == seq:
+                postings.popleft()
+                if not postings:
+                    del self.index[t]
+
+        self.texts[slot] = None
+        self.first_seq += 1
+
+    def get(self, seq):
+        """
+        Returns:
+            tuple: (time, sender id, text) of the message ``seq``
+        """
+        slot = seq % self.capacity
+        return self.times[slot], self.senders[slot], self.texts[slot]
+
+    def last(self, n):
+        """
+        Returns:
+            list: the ``n`` newest messages as (time, sender id, text), newest
+                first
+        """
+        start = max(self.first_seq, self.next_seq - n)
+        return [self.get(seq)
+                for seq in range(self.next_seq - 1, start - 1, -1)]
+
+    def search(self, query_terms, sender=None, limit=10):
+        """
+        Find messages containing all of ``query_terms``.
+
+        Args:
+            query_terms (set): lowercase terms that must all be in the message
+            sender (int): only match messages from this sender id
+            limit (int): maximum number of results
+
+        Returns:
+            list: matching messages as (time, sender id, text), newest first
+        """
+        if query_terms:
+            postings = [self.index.get(t) for t in query_terms]
+            if not all(postings):
+                return []
+            # Walk the rarest term's postings and check the others
+            candidates = reversed(min(postings, key=len))
+        else:
+            candidates = range(self.next_seq - 1, self.first_seq - 1, -1)
+
+        results = []
+        for seq in candidates:
+            msg = self.get(seq)
+            if sender is not None and msg[1] != sender:
+                continue
+            if len(query_terms) > 1 and not query_terms <= terms(msg[2]):
+                continue
+
+            results.append(msg)
+            if len(results) >= limit:
+                break
+
+        return results
+
+
+class HistoryStore(object):
+    """
+    In memory history of the messages said in every channel the bot is in.
+    Private messages are not stored.
+
+    Each channel keeps at most ``per_channel`` messages. When more than
+    ``total`` messages are stored the oldest messages of the channel that has
+    been quiet the longest are evicted first.
+    """
+    def __init__(self, per_channel=1000, total=100000):
+        self.per_channel = per_channel
+        self.total = total
+        self.size = 0
+
+        # (connection id, channel) -> ChannelHistory, least recently used
+        # first
+        self.channels = OrderedDict()
+
+        # interned sender names
+        self._sender_ids = {}
+        self._senders = []
+
+    def _intern(self, sender):
+        if sender not in self._sender_ids:
+            self._sender_ids[sender] = len(self._senders)
+            self._senders.append(sender)
+        return self._sender_ids[sender]
+
+    def add(self, connection, message):
+        """
+        Store ``message`` received on ``connection``.
+        """
+        if not message.get('channel'):
+            return
+
+        key = (connection.id, message['channel'])
+
+        history = self.channels.get(key)
+        if history is None:
+            history = self.channels[key] = ChannelHistory(self.per_channel)
+        else:
+            self.channels.move_to_end(key)
+
+        before = len(history)
+        history.append(time.time(), self._intern(message['sender']),
+                       message['message'])
+        self.size += len(history) - before
+
+        while self.size > self.total:
+            self._evict_global()
+
+    def _evict_global(self):
+        key, history = next(iter(self.channels.items()))
+
+        history.evict()
+        self.size -= 1
+
+        if not len(history):
+            del self.channels[key]
+
+    def _format(self, messages):
+        return [{
+            'ts': ts,
+            'sender': self._senders[sender],
+            'message': text,
+        } for ts, sender, text in messages]
+
+    def last(self, connection, channel, n=10):
+        """
+        Returns:
+            list: the ``n`` newest messages said in ``channel``, newest first.
+                Messages are dicts with the ``ts``, ``sender`` and ``message``
+                keys
+        """
+        history = self.channels.get((connection.id, channel))
+        if not history:
+            return []
+        return self._format(history.last(n))
+
+    def search(self, connection, channel, query, sender=None, limit=10):
+        """
+        Find the messages in ``channel`` containing every word in ``query``.
+
+        Args:
+            connection (Connection): the connection the channel is on
+            channel (str): the channel to search
+            query (str): words to search for
+            sender (str): only return messages from this user
+            limit (int): maximum number of results
+
+        Returns:
+            list: matching messages, newest first. See :meth:`last`
+        """
+        history = self.channels.get((connection.id, channel))
+        if not history:
+            return []
+
+        sender_id = None
+        if sender is not None:
+            if sender not in self._sender_ids:
+                return []
+            sender_id = self._sender_ids[sender]
+
+        return self._format(history.search(terms(query), sender_id, limit))
+
+    def stats(self):
+        """
+        Returns:
+            dict: number of stored messages, channels, senders and terms
+        """
+        return {
+            'messages': self.size,
+            'channels': len(self.channels),
+            'senders': len(self._senders),
+            'terms': sum(len(h.index) for h in self.channels.values()),
+        }
@@ -0,0 +1,335 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import json
+import logging
+import select
+from urllib.parse import urlencode, urlsplit
+
+#: Methods that are safe to send again if the response is lost
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+
+
+class HTTPError(Exception):
+    def __init__(self, status, reason, body=b''):
+        super().__init__('HTTP {} {}'.format(status, reason))
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+class RequestNotSent(Exception):
+    """
+    The request couldn't be written to the server, so it is safe to send it
+    again
+    """
+
+
+class StreamResponse(object):
+    """
+    Response whose body is read in chunks. Holds one of the pool's request
+    slots until it is closed, so it should be used with ``async with``::
+
+        async with await pool.stream('GET', url) as resp:
+            async for chunk in resp:
+                ...
+    """
+    def __init__(self, pool, key, conn, resp, chunk_size):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self.chunk_size = chunk_size
+
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = dict(resp.getheaders())
+        self.closed = False
+
+    @property
+    def content_length(self):
+        """
+        int: the Content-Length header or None
+        """
+        for k, v in self.headers.items():
+            if k.lower() == 'content-length':
+                try:
+                    return int(v)
+                except ValueError:
+                    return None
+
+    async def read_chunk(self):
+        """
+        Returns:
+            bytes: up to ``chunk_size`` bytes of the body. Empty at the end
+        """
+        if self.closed:
+            return b''
+        try:
+            chunk = await self._pool._loop.run_in_executor(
+                self._pool._executor, self._resp.read, self.chunk_size)
+        except Exception:
+            self.close()
+            raise
+        if not chunk:
+            self.close()
+        return chunk
+
+    def close(self):
+        """
+        Give the connection back to the pool. A connection whose body wasn't
+        read to the end can't be reused and is closed.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self._resp.isclosed():
+            self._pool._checkin(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._pool._semaphore.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read_chunk()
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+
+class HTTPPool(object):
+    """
+    Pool of keep-alive HTTP(S) connections. Connections to a host are reused
+    between requests instead of doing a new TCP and TLS handshake every time.
+
+    ``http.client`` blocks, so requests run on the pool's own threads. At most
+    ``size`` requests run at once.
+    """
+    def __init__(self, size=4, timeout=30):
+        """
+        Args:
+            size (int): maximum number of concurrent requests and idle
+                connections kept per host
+            timeout (int): socket timeout in seconds
+        """
+        self._loop = asyncio.get_event_loop()
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.size = size
+        self.timeout = timeout
+
+        self._executor = ThreadPoolExecutor(max_workers=size)
+        self._semaphore = asyncio.Semaphore(size)
+
+        # (scheme, host, port) -> list of idle connections. Only touched from
+        # the event loop thread.
+        self._idle = {}
+
+    def _checkout(self, key):
+        idle = self._idle.get(key)
+        while idle:
+            conn = idle.pop()
+            if not self._is_stale(conn):
+                return conn
+            conn.close()
+
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port,
+                                               timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _checkin(self, key, conn):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.size:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    @classmethod
+    def _is_stale(cls, conn):
+        """
+        Returns:
+            bool: True if the server closed the idle connection. Nothing is
+                expected on an idle connection, so being readable means it
+                was closed.
+        """
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    @classmethod
+    def _key(cls, url):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+        return (parts.scheme, parts.hostname, parts.port), path
+
+    @classmethod
+    def _send(cls, conn, method, path, body, headers):
+        """
+        Runs on a pool thread. Write the request and return the response once
+        its headers are read.
+
+        A request that can't be written is tried once more on a fresh
+        connection. Once it is written it is only sent again for idempotent
+        methods, since the server may have acted on it.
+
+        Raises:
+            RequestNotSent: if the request couldn't be written
+        """
+        for attempt in range(2):
+            try:
+                conn.request(method, path, body=body, headers=headers)
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if attempt:
+                    raise RequestNotSent(e) from e
+                continue
+
+            try:
+                return conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if attempt or method not in IDEMPOTENT_METHODS:
+                    raise
+
+    @classmethod
+    def _do_request(cls, conn, method, path, body, headers):
+        """
+        Runs on a pool thread
+        """
+        resp = cls._send(conn, method, path, body, headers)
+        data = resp.read()
+        return resp.status, resp.reason, dict(resp.getheaders()), data
+
+    async def request(self, method, url, body=None, headers=None):
+        """
+        Make an HTTP request.
+
+        Args:
+            method (str): HTTP method
+            url (str): full url including the query string
+            body (bytes): request body
+            headers (dict): request headers
+
+        Returns:
+            tuple: (status, headers dict, body bytes)
+
+        Raises:
+            HTTPError: if the response status is 400 or above
+            RequestNotSent: if the request couldn't be written. Other
+                exceptions mean the server may have received it
+        """
+        key, path = self._key(url)
+
+        async with self._semaphore:
+            conn = self._checkout(key)
+            try:
+                status, reason, resp_headers, data = \
+                    await self._loop.run_in_executor(
+                        self._executor, self._do_request, conn, method, path,
+                        body, headers or {})
+            except Exception:
+                conn.close()
+                raise
+
+            self._checkin(key, conn)
+
+        if status >= 400:
+            raise HTTPError(status, reason, data)
+
+        return status, resp_headers, data
+
+    async def stream(self, method, url, body=None, headers=None,
+                     chunk_size=64*1024):
+        """
+        Make an HTTP request without reading the response body, so large
+        responses can be processed in chunks instead of held in memory.
+
+        Args:
+            method (str): HTTP method
+            url (str): full url including the query string
+            body (bytes): request body
+            headers (dict): request headers
+            chunk_size (int): bytes read at a time
+
+        Returns:
+            :class:`StreamResponse`: the response. It must be closed
+
+        Raises:
+            HTTPError: if the response status is 400 or above
+        """
+        key, path = self._key(url)
+
+        await self._semaphore.acquire()
+        conn = self._checkout(key)
+        try:
+            resp = await self._loop.run_in_executor(
+                self._executor, self._send, conn, method, path, body,
+                headers or {})
+        except BaseException:
+            conn.close()
+            self._semaphore.release()
+            raise
+
+        response = StreamResponse(self, key, conn, resp, chunk_size)
+        if response.status >= 400:
+            response.close()
+            raise HTTPError(response.status, response.reason)
+        return response
+
+    async def get_json(self, url, params=None, headers=None):
+        """
+        GET ``url`` with ``params`` in the query string and decode the JSON
+        response.
+        """
+        if params:
+            url = '{}?{}'.format(url, urlencode(params))
+
+        _, _, data = await self.request('GET', url, headers=headers)
+        return json.loads(data.decode('utf-8'))
+
+    async def post_json(self, url, payload=None, headers=None):
+        """
+        POST ``payload`` as JSON to ``url`` and decode the JSON response.
+        """
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        body = json.dumps(payload or {}).encode('utf-8')
+
+        _, _, data = await self.request('POST', url, body=body,
+                                        headers=headers)
+        return json.loads(data.decode('utf-8'))
+
+    async def post_form(self, url, params=None, headers=None):
+        """
+        POST ``params`` form encoded to ``url`` and decode the JSON response.
+        """
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        body = urlencode(params or {}).encode('utf-8')
+
+        _, _, data = await self.request('POST', url, body=body,
+                                        headers=headers)
+        return json.loads(data.decode('utf-8'))
+
+    def close(self):
+        for idle in self._idle.values():
+            for conn in idle:
+                conn.close()
+        self._idle = {}
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,529 @@
+"""
+Run a plugin in a worker process so a crash, a memory leak or a CPU heavy
+handler in it can't stall or take down the bot.
+
+The bot and the worker talk over a socket pair. Each frame is a 4 byte big
+endian length followed by a compact JSON object whose ``t`` key is the frame
+type.
+
+Bot to worker:
+    ``init``        load the plugin ``p`` with config dir ``d`` and options
+                    ``o``. ``mem`` is the memory limit in MB
+    ``conn``        register connection ``c`` with attributes ``a``
+    ``hook``        call the plugin's ``on_connect`` or ``on_disconnect``
+                    (``h``) for connection ``c``
+    ``msg``         pass message ``m`` received on connection ``c`` to the
+                    plugin. Answered with ``done``
+    ``ret``         result ``r`` or error ``e`` of the worker's call ``id``.
+                    ``f`` means the result was a future and a second ``ret``
+                    follows once it resolves
+
+Worker to bot:
+    ``done``        the plugin finished with message ``id``. ``e`` is set if it
+                    raised
+    ``call``        call method ``f`` of connection ``c`` with ``a`` and ``k``
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+
+from ..connections.message import Entity, Message
+
+_HEADER = struct.Struct('>I')
+#: Largest frame accepted
+MAX_FRAME = 16 * 1024 * 1024
+
+#: Connection attributes copied to the worker
+CONNECTION_ATTRS = ('id', 'nick', 'section_name', 'my_id', 'config_dir')
+
+
+def encode_frame(obj):
+    data = json.dumps(obj, separators=(',', ':'), default=str).encode('utf-8')
+    return _HEADER.pack(len(data)) + data
+
+
+async def read_frame(reader):
+    """
+    Returns:
+        dict: the next frame or None once the other side has closed the socket
+    """
+    try:
+        header = await reader.readexactly(_HEADER.size)
+        size, = _HEADER.unpack(header)
+        if size > MAX_FRAME:
+            raise ValueError('Frame of {} bytes is too large'.format(size))
+        return json.loads((await reader.readexactly(size)).decode('utf-8'))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+class RemoteError(Exception):
+    """
+    Error raised on the other side of the socket
+    """
+
+
+def _error(e):
+    return '{}: {}'.format(e.__class__.__name__, e)
+
+
+class IsolatedPlugin(object):
+    """
+    Stands in for a plugin in the bot and forwards everything to the plugin
+    running in a worker process. The worker is restarted if it exits.
+    """
+    def __init__(self, class_path, config_dir=None, options=None,
+                 executor=None, memory_limit=0, message_timeout=30):
+        """
+        Args:
+            class_path (str): the plugin's class path
+            config_dir (str): passed to the plugin
+            options (dict): the plugin's options
+            executor (PluginExecutor): the plugin's executor in the bot
+            memory_limit (int): the worker's address space limit in MB. 0 for
+                no limit
+            message_timeout (float): seconds to wait for the worker to handle
+                a message before giving up on it. 0 waits forever
+        """
+        self._loop = asyncio.get_event_loop()
+
+        self.class_path = class_path
+        self.name = class_path.rsplit('.', 1)[-1]
+        self.log = logging.getLogger('{}[{}]'.format(
+            self.__class__.__name__, self.name))
+
+        self.config_dir = config_dir
+        self.options = options or {}
+        self.executor = executor
+        self.memory_limit = memory_limit
+        self.message_timeout = message_timeout or None
+
+        self._process = None
+        self._reader = None
+        self._writer = None
+        self._ready = asyncio.Event()
+        self._stopping = False
+
+        # connection -> key used in frames and the reverse
+        self._keys = {}
+        self._connections = {}
+        self._last_key = 0
+        # connections the plugin's on_connect was called for
+        self._connected = set()
+
+        # message id -> future resolved when the worker is done with it
+        self._pending = {}
+        self._seq = 0
+
+        self.restarts = 0
+        # messages dropped because the worker was down and messages the
+        # worker didn't finish within ``message_timeout``
+        self.dropped = 0
+        self.timed_out = 0
+
+        self._task = asyncio.ensure_future(self._supervise())
+
+    async def _supervise(self):
+        delay = 1
+        while not self._stopping:
+            started = self._loop.time()
+            try:
+                await self._start_worker()
+                await self._read_frames()
+            except Exception:
+                self.log.exception('Error talking to the worker')
+
+            self._ready.clear()
+            self._writer = None
+
+            # Nothing will answer these now
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_result('worker exited')
+            self._pending.clear()
+
+            code = await self._reap()
+            if self._stopping:
+                break
+
+            if self._loop.time() - started > 60:
+                delay = 1
+            self.restarts += 1
+            self.log.error('Worker exited with {}. Restarting in {}s'.format(
+                code, delay))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    async def _start_worker(self):
+        parent_sock, child_sock = socket.socketpair()
+
+        # make sure the worker can import warmachine however the bot was run
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            p for p in (root, env.get('PYTHONPATH')) if p)
+
+        try:
+            self._process = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', __name__, str(child_sock.fileno()),
+                pass_fds=(child_sock.fileno(),), env=env)
+        finally:
+            child_sock.close()
+
+        self._reader, self._writer = await asyncio.open_connection(
+            sock=parent_sock)
+        self.log.info('Started worker {}'.format(self._process.pid))
+
+        self._send({
+            't': 'init',
+            'p': self.class_path,
+            'd': self.config_dir,
+            'o': self.options,
+            'mem': self.memory_limit,
+            'lvl': logging.getLogger().getEffectiveLevel(),
+        })
+
+        # A restarted worker gets the connections the old one knew about
+        for connection, key in self._keys.items():
+            self._send_connection(connection, key)
+            if connection in self._connected:
+                self._send({'t': 'hook', 'h': 'on_connect', 'c': key})
+
+        self._ready.set()
+
+    async def _reap(self):
+        if self._process is None:
+            return
+        if self._process.returncode is None:
+            try:
+                await asyncio.wait_for(self._process.wait(), 5)
+            except asyncio.TimeoutError:
+                self._process.kill()
+                await self._process.wait()
+        return self._process.returncode
+
+    async def _read_frames(self):
+        while True:
+            frame = await read_frame(self._reader)
+            if frame is None:
+                return
+
+            if frame['t'] == 'done':
+                future = self._pending.pop(frame['id'], None)
+                if future and not future.done():
+                    future.set_result(frame.get('e'))
+            elif frame['t'] == 'call':
+                asyncio.ensure_future(self._call(frame))
+            else:
+                self.log.error('Unknown frame from worker: {}'.format(frame))
+
+    async def _call(self, frame):
+        """
+        Call a connection method for the worker and send back the result
+        """
+        call_id = frame['id']
+        try:
+            connection = self._connections.get(frame['c'])
+            if connection is None or frame['f'].startswith('_'):
+                raise AttributeError(frame['f'])
+
+            result = getattr(connection, frame['f'])(
+                *frame.get('a', []), **frame.get('k', {}))
+            if asyncio.iscoroutine(result):
+                result = await result
+            if isinstance(result, asyncio.Future):
+                self._send({'t': 'ret', 'id': call_id, 'f': 1})
+                result = await result
+
+            self._send({'t': 'ret', 'id': call_id, 'r': result})
+        except Exception as e:
+            self._send({'t': 'ret', 'id': call_id, 'e': _error(e)})
+
+    def _send(self, frame):
+        if self._writer is not None:
+            self._writer.write(encode_frame(frame))
+
+    def _send_connection(self, connection, key):
+        attrs = {}
+        for a in CONNECTION_ATTRS:
+            value = getattr(connection, a, None)
+            if isinstance(value, (str, int, float, bool)):
+                attrs[a] = value
+        self._send({'t': 'conn', 'c': key, 'a': attrs})
+
+    def _key(self, connection):
+        key = self._keys.get(connection)
+        if key is None:
+            # not reused, the worker may still know a removed connection's
+            self._last_key += 1
+            key = self._keys[connection] = self._last_key
+            self._connections[key] = connection
+            self._send_connection(connection, key)
+        return key
+
+    async def on_connect(self, connection):
+        # Doesn't wait for the worker, so one that can't start doesn't hold up
+        # the connection. The worker is told about the connection when it
+        # starts.
+        key = self._key(connection)
+        self._connected.add(connection)
+        if not self._ready.is_set():
+            return
+
+        # The nick may have changed since the last time
+        self._send_connection(connection, key)
+        self._send({'t': 'hook', 'h': 'on_connect', 'c': key})
+
+    async def on_disconnect(self, connection):
+        self._connected.discard(connection)
+        key = self._keys.pop(connection, None)
+        if key is None:
+            return
+        self._send({'t': 'hook', 'h': 'on_disconnect', 'c': key})
+        self._connections.pop(key, None)
+
+    async def recv_msg(self, connection, message):
+        """
+        Pass ``message`` to the worker and wait up to ``message_timeout`` for
+        it to be handled. Messages received while the worker is restarting
+        are dropped so a broken plugin doesn't hold up the bot's dispatch.
+        """
+        if not self._ready.is_set() or self._writer is None:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                self.log.warning('Worker is down, %s messages dropped so far',
+                                 self.dropped)
+            return
+
+        self._seq += 1
+        seq = self._seq
+        future = self._loop.create_future()
+        self._pending[seq] = future
+
+        self._send({
+            't': 'msg',
+            'id': seq,
+            'c': self._key(connection),
+            'm': message.as_dict(),
+            's': message.sender_id,
+            'u': connection.user_record(message.sender_id),
+            'r': message.raw,
+            'x': message.raw_text,
+            'e': [e.as_dict() for e in message.entities],
+        })
+
+        try:
+            error = await asyncio.wait_for(
+                self._wait_done(self._writer, future), self.message_timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(seq, None)
+            self.timed_out += 1
+            self.log.warning('Worker took more than %ss to handle a message '
+                             '(%s so far)', self.message_timeout,
+                             self.timed_out)
+            return
+
+        if error:
+            self.log.error('Error handling message: {}'.format(error))
+
+    async def _wait_done(self, writer, future):
+        await writer.drain()
+        return await future
+
+    def stop(self):
+        """
+        Stop the worker without restarting it
+        """
+        self._stopping = True
+        if self._writer is not None:
+            self._writer.close()
+        if self._process is not None and self._process.returncode is None:
+            self._process.terminate()
+
+    def stats(self):
+        return {
+            'pid': self._process.pid if self._process else None,
+            'restarts': self.restarts,
+            'pending': len(self._pending),
+            'dropped': self.dropped,
+            'timed_out': self.timed_out,
+        }
+
+
+class ConnectionProxy(object):
+    """
+    The plugin's view of a bot connection inside the worker. Attributes are
+    copied from the connection and every other public method is called in
+    the bot.
+    """
+    MAX_USERS = 10000
+
+    def __init__(self, worker, key):
+        self._worker = worker
+        self._key = key
+        self._users = {}
+
+    def update(self, attrs):
+        self.__dict__.update(attrs)
+
+    def user_record(self, user_id):
+        return self._users.get(user_id)
+
+    def remember_user(self, user_id, record):
+        if record is None:
+            return
+        if len(self._users) >= self.MAX_USERS:
+            self._users.clear()
+        self._users[user_id] = record
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            return await self._worker.call(self._key, name, args, kwargs)
+        call.__name__ = name
+        return call
+
+
+class PluginWorker(object):
+    """
+    Runs a plugin in the worker process
+    """
+    def __init__(self):
+        self._loop = asyncio.get_event_loop()
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.plugin = None
+        self.connections = {}  # key -> ConnectionProxy
+
+        self._writer = None
+        self._calls = {}  # call id -> future
+        self._seq = 0
+
+    async def run(self, fd):
+        sock = socket.socket(fileno=fd)
+        reader, self._writer = await asyncio.open_connection(sock=sock)
+
+        while True:
+            frame = await read_frame(reader)
+            if frame is None:
+                break
+            self.handle(frame)
+
+    def _send(self, frame):
+        self._writer.write(encode_frame(frame))
+
+    def handle(self, frame):
+        t = frame['t']
+        if t == 'init':
+            self.init(frame)
+
+        elif t == 'conn':
+            proxy = self.connections.get(frame['c'])
+            if proxy is None:
+                proxy = self.connections[frame['c']] = ConnectionProxy(
+                    self, frame['c'])
+            proxy.update(frame['a'])
+
+        elif t == 'hook':
+            proxy = self.connections.get(frame['c'])
+            hook = getattr(self.plugin, frame['h'], None)
+            if proxy is not None and hook is not None:
+                asyncio.ensure_future(self._hook(hook, proxy))
+            if frame['h'] == 'on_disconnect':
+                self.connections.pop(frame['c'], None)
+
+        elif t == 'msg':
+            asyncio.ensure_future(self._recv_msg(frame))
+
+        elif t == 'ret':
+            self._ret(frame)
+
+    def init(self, frame):
+        from importlib import import_module
+
+        logging.basicConfig(
+            level=frame.get('lvl', logging.INFO),
+            format='%(asctime)s [%(levelname)s] %(name)s[worker]: '
+                   '%(message)s')
+
+        if frame.get('mem'):
+            try:
+                import resource
+                limit = frame['mem'] * 1024 * 1024
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+            except (ImportError, ValueError, OSError) as e:
+                self.log.warning('Unable to limit memory: {}'.format(e))
+
+        mod_path, cls_name = frame['p'].rsplit('.', 1)
+        cls = getattr(import_module(mod_path), cls_name)
+        self.plugin = cls(config_dir=frame['d'], options=frame['o'])
+        self.log.info('Loaded plugin {}'.format(frame['p']))
+
+    async def _hook(self, hook, proxy):
+        try:
+            result = hook(proxy)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception:
+            self.log.exception('Error in {}'.format(hook.__name__))
+
+    async def _recv_msg(self, frame):
+        proxy = self.connections[frame['c']]
+        proxy.remember_user(frame['s'], frame.get('u'))
+
+        message = Message.from_dict(frame['m'], connection=proxy)
+        message.sender_id = frame['s']
+        message.raw = frame.get('r')
+        message.raw_text = frame.get('x', message.message)
+        message.entities = [Entity.from_dict(e) for e in frame.get('e', [])]
+
+        error = None
+        try:
+            await self.plugin.recv_msg(proxy, message)
+        except Exception as e:
+            self.log.exception('Error handling message')
+            error = _error(e)
+
+        self._send({'t': 'done', 'id': frame['id'], 'e': error})
+
+    async def call(self, key, method, args, kwargs):
+        self._seq += 1
+        future = self._loop.create_future()
+        self._calls[self._seq] = future
+
+        self._send({'t': 'call', 'id': self._seq, 'c': key, 'f': method,
+                    'a': list(args), 'k': kwargs})
+        return await future
+
+    def _ret(self, frame):
+        future = self._calls.pop(frame['id'], None)
+        if future is None or future.done():
+            return
+
+        if frame.get('f'):
+            # The bot's method returned a future. Hand the plugin one of its
+            # own that is resolved by the next ret for this call.
+            later = self._loop.create_future()
+            self._calls[frame['id']] = later
+            future.set_result(later)
+        elif frame.get('e'):
+            future.set_exception(RemoteError(frame['e']))
+        else:
+            future.set_result(frame.get('r'))
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    worker = PluginWorker()
+    loop.run_until_complete(worker.run(int(sys.argv[1])))
+
+
+if __name__ == '__main__':
+    main()
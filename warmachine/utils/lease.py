@@ -0,0 +1,92 @@
+import asyncio
+import fcntl
+import logging
+import os
+
+
+class FileLease(object):
+    """
+    Exclusive lease on a lock file, held with ``flock``. The kernel releases
+    the lock as soon as the process holding it exits, however it dies, so a
+    standby waiting in :meth:`wait` takes over within ``poll_interval``
+    seconds.
+    """
+    def __init__(self, path, poll_interval=0.25):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    def acquire(self):
+        """
+        Take the lease if nobody holds it.
+
+        Returns:
+            bool: True if the lease is now held
+        """
+        return self._lock(fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    async def wait(self):
+        """
+        Wait until the lease is free and take it
+        """
+        # Polled rather than a blocking flock in a thread, which couldn't be
+        # interrupted and would keep the process from exiting
+        while not self.acquire():
+            await asyncio.sleep(self.poll_interval)
+
+    def _lock(self, flags):
+        if self.held():
+            return True
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, flags)
+        except (BlockingIOError, PermissionError):
+            os.close(fd)
+            return False
+
+        # The file may have been replaced while we waited for it, in which
+        # case the lock is on a file nobody else will look at
+        try:
+            same = os.path.samestat(os.fstat(fd), os.stat(self.path))
+        except OSError:
+            same = False
+        if not same:
+            os.close(fd)
+            return False
+
+        os.ftruncate(fd, 0)
+        os.write(fd, '{}\n'.format(os.getpid()).encode())
+        self._fd = fd
+        self.log.info('Acquired lease {}'.format(self.path))
+        return True
+
+    def held(self):
+        """
+        Returns:
+            bool: True if the lease is held and the lock file is still the
+                one that was locked
+        """
+        if self._fd is None:
+            return False
+        try:
+            return os.path.samestat(os.fstat(self._fd), os.stat(self.path))
+        except OSError:
+            return False
+
+    def holder(self):
+        """
+        Returns:
+            int: pid written by the holder of the lease or None
+        """
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,71 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through only a fraction of a logger's debug messages. Messages at
+    INFO and above always pass.
+    """
+    def __init__(self, rate):
+        """
+        Args:
+            rate (float): fraction of debug messages to keep, 0.0 - 1.0
+        """
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        return random.random() < self.rate
+
+
+def sample_debug(logger_name, rate):
+    """
+    Only log ``rate`` of the debug messages sent to ``logger_name``.
+
+    Args:
+        logger_name (str): name of the logger, e.g. ``SlackWS``
+        rate (float): fraction of debug messages to keep, 0.0 - 1.0
+    """
+    logging.getLogger(logger_name).addFilter(SamplingFilter(rate))
+
+
+def start_queue_logging():
+    """
+    Move the configured handlers onto background threads. Each logger with
+    handlers gets a :class:`logging.handlers.QueueHandler` instead, so logging
+    from the event loop only puts the record on a queue and the (possibly
+    slow) writes happen on a listener thread.
+
+    Call this after :func:`logging.config.dictConfig`.
+
+    Returns:
+        list: the started :class:`logging.handlers.QueueListener` objects
+    """
+    loggers = [logging.getLogger()] + [
+        l for l in logging.root.manager.loggerDict.values()
+        if isinstance(l, logging.Logger)]
+
+    listeners = []
+    for logger in loggers:
+        if not logger.handlers:
+            continue
+
+        log_queue = queue.Queue(-1)
+        listener = logging.handlers.QueueListener(
+            log_queue, *logger.handlers, respect_handler_level=True)
+
+        logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+
+        listener.start()
+        # Write out whatever is still queued when the bot exits
+        atexit.register(listener.stop)
+
+        listeners.append(listener)
+
+    return listeners
@@ -0,0 +1,79 @@
+from contextlib import contextmanager
+import logging
+import time
+
+
+class StartupProfiler(object):
+    """
+    Records how long each phase of the bot's start up takes. Nothing is
+    recorded unless ``enabled`` is set, which ``bin/dbolla --profile-startup``
+    does.
+    """
+    def __init__(self):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.enabled = False
+        self.started = time.perf_counter()
+
+        # list of (phase, seconds) in the order they completed
+        self.timings = []
+
+    def record(self, phase, seconds):
+        """
+        Record the time spent in ``phase``.
+
+        Args:
+            phase (str): name of the start up phase
+            seconds (float): time spent in the phase
+        """
+        if self.enabled:
+            self.timings.append((phase, seconds))
+
+    @contextmanager
+    def measure(self, phase):
+        """
+        Context manager recording the time spent in the ``with`` block.
+
+        Args:
+            phase (str): name of the start up phase
+        """
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def report(self):
+        """
+        Log the recorded timings and stop recording. Phases run concurrently so
+        the individual timings may add up to more than the total.
+
+        Returns:
+            str: the report
+        """
+        if not self.enabled:
+            return ''
+
+        total = time.perf_counter() - self.started
+        width = max([len(p) for p, _ in self.timings] + [len('total')])
+
+        lines = ['Startup profile:']
+        for phase, seconds in self.timings:
+            lines.append('  {}  {:8.1f}ms'.format(
+                phase.ljust(width), seconds * 1000))
+        lines.append('  {}  {:8.1f}ms'.format(
+            'total'.ljust(width), total * 1000))
+
+        report = '\n'.join(lines)
+        self.log.info(report)
+
+        self.enabled = False
+        self.timings = []
+
+        return report
+
+#: Profiler shared by the bot, connections and plugins
+startup_profiler = StartupProfiler()
@@ -0,0 +1,232 @@
+import asyncio
+from collections import OrderedDict
+import logging
+
+
+def parse_limit(value):
+    """
+    Parse a limit written as ``<count>/<seconds>``, e.g. ``5/10`` for 5
+    commands every 10 seconds.
+
+    Returns:
+        tuple: (count, seconds) or None for ``off`` and ``0``
+    """
+    value = str(value).strip()
+    if value in ('', '0', 'off'):
+        return None
+
+    count, _, seconds = value.partition('/')
+    count = int(count)
+    seconds = float(seconds or 1)
+    if count <= 0 or seconds <= 0:
+        raise ValueError('Invalid rate limit {}'.format(value))
+    return count, seconds
+
+
+class TokenBucket(object):
+    """
+    Allows bursts of up to ``burst`` events, refilling at ``burst`` tokens
+    every ``period`` seconds.
+    """
+    __slots__ = ('burst', 'period', 'rate', 'tokens', 'updated')
+
+    def __init__(self, burst, period, now):
+        self.burst = burst
+        self.period = period
+        self.rate = burst / period
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """
+        Returns:
+            float: seconds until a token is available
+        """
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class LoopLagMonitor(object):
+    """
+    Measures how late the event loop runs a callback scheduled every
+    ``interval`` seconds.
+    """
+    def __init__(self, interval=0.25):
+        self._loop = asyncio.get_event_loop()
+        self.interval = interval
+        self.lag = 0.0  # seconds, smoothed
+        self.lag_max = 0.0
+        self._expected = None
+        self._handle = None
+
+    def start(self):
+        if self._handle is None:
+            self._schedule()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self):
+        self._expected = self._loop.time() + self.interval
+        self._handle = self._loop.call_later(self.interval, self._tick)
+
+    def _tick(self):
+        lag = max(0.0, self._loop.time() - self._expected)
+        # React to a stall at once but recover gradually
+        self.lag = lag if lag > self.lag else self.lag + (lag - self.lag) * 0.2
+        self.lag_max = max(self.lag_max, lag)
+        self._schedule()
+
+
+class CommandLimiter(object):
+    """
+    Rate limits commands with token buckets per user, per channel and per
+    command, and sheds low priority commands while the bot is overloaded.
+
+    Only messages that are commands are limited, so replies to plugins such
+    as the standup questions are never dropped.
+    """
+    def __init__(self, user='5/10', channel='20/10', command='30/10',
+                 commands=None, low_priority=(), shed_lag_ms=500,
+                 shed_queue_depth=500, max_buckets=10000, lag_monitor=None):
+        """
+        Args:
+            user (str): limit for each user. See :func:`parse_limit`
+            channel (str): limit for each channel
+            command (str): limit for each command, for everyone together
+            commands (dict): command -> limit overriding ``command``
+            low_priority (list): commands dropped while overloaded
+            shed_lag_ms (float): the loop lag that means the bot is
+                overloaded. 0 to disable
+            shed_queue_depth (int): the inbound queue depth that means the
+                bot is overloaded. 0 to disable
+            max_buckets (int): buckets kept for each kind. The least recently
+                used are forgotten first
+            lag_monitor (LoopLagMonitor): measures the loop lag
+        """
+        self._loop = asyncio.get_event_loop()
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        self.limits = {
+            'user': parse_limit(user),
+            'channel': parse_limit(channel),
+            'command': parse_limit(command),
+        }
+        self.command_limits = {c: parse_limit(l)
+                               for c, l in (commands or {}).items()}
+        self.low_priority = set(low_priority)
+
+        self.shed_lag = shed_lag_ms / 1000.0
+        self.shed_queue_depth = shed_queue_depth
+        self.lag_monitor = lag_monitor
+
+        self.max_buckets = max_buckets
+        # kind -> key -> TokenBucket, least recently used first
+        self._buckets = {kind: OrderedDict() for kind in self.limits}
+        # (connection id, user) -> loop time until which they aren't told to
+        # slow down again
+        self._warned = {}
+
+        # monitoring
+        self.allowed = 0
+        self.limited = 0
+        self.shed = 0
+
+    def _bucket(self, kind, key, limit, now):
+        buckets = self._buckets[kind]
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(limit[0], limit[1], now)
+            if len(buckets) > self.max_buckets:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+            bucket.refill(now)
+        return bucket
+
+    def overloaded(self, queue_depth=0):
+        """
+        Returns:
+            bool: True if the loop lag or ``queue_depth`` is over its
+                threshold
+        """
+        if self.shed_queue_depth and queue_depth >= self.shed_queue_depth:
+            return True
+        return bool(self.shed_lag and self.lag_monitor and
+                    self.lag_monitor.lag >= self.shed_lag)
+
+    def check(self, connection_id, message, queue_depth=0):
+        """
+        Decide whether the command in ``message`` may run. A token is taken
+        from each of its buckets only if all of them have one.
+
+        Args:
+            connection_id (str): id of the connection the message is from
+            message (Message): the message
+            queue_depth (int): messages waiting in the connection's inbound
+                queue
+
+        Returns:
+            tuple: (allowed, notice). ``notice`` is the text to send the user
+                the first time they are limited in a window, otherwise None
+        """
+        cmd = message.command
+        if not cmd:
+            return True, None
+
+        if cmd in self.low_priority and self.overloaded(queue_depth):
+            self.shed += 1
+            if self.shed == 1 or self.shed % 100 == 0:
+                self.log.warning('Overloaded, %s low priority commands '
+                                 'dropped so far', self.shed)
+            return False, None
+
+        now = self._loop.time()
+        buckets = []
+
+        if self.limits['user']:
+            buckets.append(self._bucket('user', (
+                connection_id, message.sender), self.limits['user'], now))
+        if self.limits['channel'] and message.channel:
+            buckets.append(self._bucket('channel', (
+                connection_id, message.channel), self.limits['channel'], now))
+        limit = self.command_limits.get(cmd, self.limits['command'])
+        if limit:
+            buckets.append(self._bucket('command', (connection_id, cmd),
+                                        limit, now))
+
+        empty = [b for b in buckets if b.tokens < 1]
+        if not empty:
+            for b in buckets:
+                b.tokens -= 1
+            self.allowed += 1
+            return True, None
+
+        self.limited += 1
+
+        key = (connection_id, message.sender)
+        if self._warned.get(key, 0) > now:
+            return False, None
+
+        if len(self._warned) > self.max_buckets:
+            self._warned = {k: t for k, t in self._warned.items() if t > now}
+        self._warned[key] = now + max(b.period for b in empty)
+
+        return False, 'Slow down {}, try again in {:.0f}s'.format(
+            message.sender, max(1, max(b.wait_time() for b in empty)))
+
+    def stats(self):
+        return {
+            'allowed': self.allowed,
+            'limited': self.limited,
+            'shed': self.shed,
+            'buckets': sum(len(b) for b in self._buckets.values()),
+            'loop_lag_ms': round(self.lag_monitor.lag * 1000)
+            if self.lag_monitor else None,
+        }
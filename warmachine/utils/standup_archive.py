@@ -0,0 +1,499 @@
+from array import array
+from collections import OrderedDict
+from datetime import date
+import mmap
+import os
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#: Text offset of the rows recording that a user was asked for their standup
+NO_TEXT = 2 ** 64 - 1
+
+#: (column, array typecode). Each column is a file in the day's directory
+COLUMNS = (
+    ('ts', 'd'),       # unix time the row was written
+    ('channel', 'I'),  # interned channel name
+    ('user', 'I'),     # interned user name
+    ('text', 'Q'),     # offset of the reply in ``replies`` or NO_TEXT
+    ('latency', 'f'),  # seconds from the standup starting to the reply
+)
+
+#: array typecode -> numpy dtype
+DTYPES = {'d': 'f8', 'I': 'u4', 'Q': 'u8', 'f': 'f4'}
+
+#: Number of past days whose memory maps are kept. Each map holds a file
+#: descriptor, so long reports can't keep every day open.
+MAX_SEGMENTS = 32
+
+
+class Segment(object):
+    """
+    The rows of one day, memory mapped read only. Columns are numpy arrays
+    when numpy is installed and memoryviews otherwise. Rows are never loaded
+    as Python objects.
+    """
+    __slots__ = ('day', 'rows', 'columns', 'maps')
+
+    def __init__(self, path, day):
+        """
+        Args:
+            path (str): the day's directory
+            day (int): the day's ordinal
+        """
+        self.day = day
+
+        sizes = {}
+        for name, code in COLUMNS:
+            try:
+                size = os.path.getsize(os.path.join(path, name))
+            except OSError:
+                size = 0
+            sizes[name] = size // array(code).itemsize
+        # a row is only complete once it's in every column
+        self.rows = min(sizes.values())
+
+        self.columns = {}
+        self.maps = []
+        for name, code in COLUMNS:
+            if not self.rows:
+                self.columns[name] = _empty(code)
+                continue
+
+            with open(os.path.join(path, name), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps.append(m)
+
+            if numpy is not None:
+                col = numpy.frombuffer(m, dtype=DTYPES[code], count=self.rows)
+            else:
+                col = memoryview(m)[:self.rows * array(code).itemsize].cast(
+                    code)
+            self.columns[name] = col
+
+    def close(self):
+        """
+        Unmap the columns. A map whose column is still referenced elsewhere
+        is closed when the column is garbage collected instead.
+        """
+        self.columns = {}
+        for m in self.maps:
+            try:
+                m.close()
+            except BufferError:
+                pass
+        self.maps = []
+
+
+def _empty(code):
+    if numpy is not None:
+        return numpy.empty(0, dtype=DTYPES[code])
+    return memoryview(array(code)).cast('B').cast(code)
+
+
+class StandupArchive(object):
+    """
+    Append-only archive of who was asked for their standup and their replies.
+
+    Rows are kept in a directory per day, named after the date of the standup
+    they belong to, with a file per column so reports only read the columns
+    they need. Reply texts are appended to the day's ``replies`` file, each
+    after its length, and rows hold their offset. Channel and user names are
+    interned in ``names``, one per line.
+
+    Past days never change, so the memory maps of the last
+    :data:`MAX_SEGMENTS` days read are cached. Reports may run on another
+    thread while rows are appended.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        self._names = []
+        self._name_ids = {}
+        names_path = os.path.join(path, 'names')
+        if os.path.exists(names_path):
+            with open(names_path) as f:
+                for line in f:
+                    self._add_name(line.rstrip('\n'))
+        self._names_file = open(names_path, 'a')
+
+        self._day = None  # ordinal of the day being written
+        self._files = {}  # column -> file open for appending
+        self._text_file = None
+        self._text_offsets = {}  # (user, text) -> offset in today's text
+
+        # day ordinal -> Segment, least recently used first
+        self._segments = OrderedDict()
+        self._segments_lock = threading.Lock()
+
+    def _add_name(self, name):
+        self._name_ids[name] = len(self._names)
+        self._names.append(name)
+
+    def intern(self, name):
+        """
+        Returns:
+            int: the id of ``name``, adding it if it's new
+        """
+        if name not in self._name_ids:
+            self._names_file.write(name + '\n')
+            self._names_file.flush()
+            self._add_name(name)
+        return self._name_ids[name]
+
+    def _day_path(self, day):
+        return os.path.join(self.path, date.fromordinal(day).isoformat())
+
+    def _open_day(self, day):
+        """
+        Start appending to ``day``. Rows only partly written by a crash are
+        cut off first.
+        """
+        self.close()
+
+        path = self._day_path(day)
+        os.makedirs(path, exist_ok=True)
+
+        rows = Segment(path, day).rows
+        for name, code in COLUMNS:
+            f = open(os.path.join(path, name), 'ab')
+            f.truncate(rows * array(code).itemsize)
+            self._files[name] = f
+        self._text_file = open(os.path.join(path, 'replies'), 'ab')
+
+        self._day = day
+        with self._segments_lock:
+            segment = self._segments.pop(day, None)
+        if segment is not None:
+            segment.close()
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        if self._text_file:
+            self._text_file.close()
+            self._text_file = None
+        self._text_offsets = {}
+        self._day = None
+
+    def _append(self, day, ts, channel, user, text, latency):
+        day = day.toordinal()
+        if day != self._day:
+            self._open_day(day)
+
+        row = {
+            'ts': ts,
+            'channel': self.intern(channel),
+            'user': self.intern(user),
+            'text': text,
+            'latency': latency,
+        }
+        for name, code in COLUMNS:
+            self._files[name].write(array(code, [row[name]]).tobytes())
+        for f in self._files.values():
+            f.flush()
+
+    def asked(self, day, ts, channel, user):
+        """
+        Record that ``user`` was asked for their standup in ``channel``
+
+        Args:
+            day (date): the day of the standup
+            ts (float): unix time
+            channel (str): the channel
+            user (str): the user
+        """
+        self._append(day, ts, channel, user, NO_TEXT, float('nan'))
+
+    def replied(self, day, ts, channel, user, text, latency):
+        """
+        Record ``user``'s reply to a standup in ``channel``. A reply posted to
+        several channels is only stored once.
+
+        Args:
+            day (date): the day of the standup
+            ts (float): unix time
+            channel (str): the channel
+            user (str): the user
+            text (str): the reply
+            latency (float): seconds from the standup starting to the reply
+        """
+        if day.toordinal() != self._day:
+            self._open_day(day.toordinal())
+
+        offset = self._text_offsets.get((user, text))
+        if offset is None:
+            offset = self._text_file.tell()
+            data = text.encode('utf-8')
+            self._text_file.write(array('I', [len(data)]).tobytes() + data)
+            self._text_file.flush()
+            self._text_offsets[(user, text)] = offset
+
+        self._append(day, ts, channel, user, offset, latency)
+
+    def text(self, day, offset):
+        """
+        Returns:
+            str: the reply stored at ``offset`` on ``day``
+        """
+        with open(os.path.join(self._day_path(day.toordinal()), 'replies'),
+                  'rb') as f:
+            f.seek(offset)
+            size = array('I')
+            size.frombytes(f.read(size.itemsize))
+            return f.read(size[0]).decode('utf-8')
+
+    def _segment(self, day):
+        """
+        Returns:
+            tuple: (:class:`Segment` or None if there are no rows for
+                ``day``, True if the segment is cached)
+        """
+        if day != self._day:
+            with self._segments_lock:
+                segment = self._segments.get(day)
+                if segment is not None:
+                    self._segments.move_to_end(day)
+                    return segment, True
+
+        path = self._day_path(day)
+        if not os.path.isdir(path):
+            return None, False
+        segment = Segment(path, day)
+
+        # the day being written still changes
+        if day == self._day:
+            return segment, False
+
+        with self._segments_lock:
+            self._segments[day] = segment
+            while len(self._segments) > MAX_SEGMENTS:
+                # a report only holds the segment it is reading, which is
+                # the newest
+                self._segments.popitem(last=False)[1].close()
+        return segment, True
+
+    def segments(self, days, today):
+        """
+        Yields:
+            :class:`Segment`: the segment of each of the ``days`` days up to
+                and including ``today`` that has rows. Only a few are open at
+                a time, so a long report doesn't run out of file descriptors.
+        """
+        end = today.toordinal()
+        for d in range(end - days + 1, end + 1):
+            segment, cached = self._segment(d)
+            if segment is None:
+                continue
+            try:
+                if segment.rows:
+                    yield segment
+            finally:
+                if not cached:
+                    segment.close()
+
+    def channel_report(self, channel, days, today):
+        """
+        Participation of the users asked in ``channel``.
+
+        Args:
+            channel (str): the channel
+            days (int): number of days to report on
+            today (date): the last day to report on
+
+        Returns:
+            dict: see :meth:`_report`. Groups are user names
+        """
+        if channel not in self._name_ids:
+            return None
+        return self._report(self.segments(days, today), 'channel',
+                            self._name_ids[channel], 'user')
+
+    def user_report(self, user, days, today):
+        """
+        Participation of ``user`` in each channel they were asked in.
+
+        Returns:
+            dict: see :meth:`_report`. Groups are channel names
+        """
+        if user not in self._name_ids:
+            return None
+        return self._report(self.segments(days, today), 'user',
+                            self._name_ids[user], 'channel')
+
+    def _report(self, segments, column, key, group_by):
+        """
+        Summarize the rows where ``column`` is ``key``, grouped by
+        ``group_by``.
+
+        Returns:
+            dict:
+                ``standups``: number of days with a standup,
+                ``asked``: number of times someone was asked,
+                ``replied``: number of those that got a reply,
+                ``latency_median`` and ``latency_p90``: seconds to reply,
+                ``groups``: list of dicts with the ``name``, ``asked``,
+                ``replied``, ``streak`` (current run of standups replied to),
+                ``best_streak`` and ``latency_avg`` of each group, best
+                participation first
+        """
+        if numpy is not None:
+            report = _report_numpy(segments, column, key, group_by)
+        else:
+            report = _report_python(segments, column, key, group_by)
+
+        for g in report['groups']:
+            g['name'] = self._names[g['name']]
+        report['groups'].sort(key=lambda g: (
+            -g['replied'] / g['asked'], -g['streak'], g['name']))
+        return report
+
+    def stats(self):
+        return {
+            'names': len(self._names),
+            'days': len([d for d in os.listdir(self.path)
+                         if os.path.isdir(os.path.join(self.path, d))]),
+            'cached_segments': len(self._segments),
+        }
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def _report_python(segments, column, key, group_by):
+    asked = set()    # (group, day)
+    answered = set()
+    latency = {}  # group -> latencies
+
+    for s in segments:
+        cols = s.columns
+        keys = cols[column]
+        groups = cols[group_by]
+        texts = cols['text']
+        latencies = cols['latency']
+        for i in range(s.rows):
+            if keys[i] != key:
+                continue
+            pair = (groups[i], s.day)
+            if texts[i] == NO_TEXT:
+                asked.add(pair)
+            else:
+                answered.add(pair)
+                latency.setdefault(groups[i], []).append(latencies[i])
+
+    by_group = {}
+    for pair in sorted(asked):
+        by_group.setdefault(pair[0], []).append(pair in answered)
+
+    result = []
+    for group, replies in by_group.items():
+        best = run = 0
+        for replied in replies:
+            run = run + 1 if replied else 0
+            best = max(best, run)
+        lat = latency.get(group, [])
+        result.append({
+            'name': group,
+            'asked': len(replies),
+            'replied': sum(replies),
+            'streak': run,
+            'best_streak': best,
+            'latency_avg': sum(lat) / len(lat) if lat else None,
+        })
+
+    all_latency = [l for lat in latency.values() for l in lat]
+    return {
+        'standups': len(set(day for _, day in asked)),
+        'asked': len(asked),
+        'replied': len(asked & answered),
+        'latency_median': _percentile(all_latency, 0.5),
+        'latency_p90': _percentile(all_latency, 0.9),
+        'groups': result,
+    }
+
+
+def _report_numpy(segments, column, key, group_by):
+    empty = {'standups': 0, 'asked': 0, 'replied': 0, 'latency_median': None,
+             'latency_p90': None, 'groups': []}
+
+    # Only the matching rows of each segment are copied
+    groups, days, is_reply, latency = [], [], [], []
+    for s in segments:
+        mask = s.columns[column] == key
+        groups.append(s.columns[group_by][mask])
+        days.append(numpy.full(int(mask.sum()), s.day, dtype='i8'))
+        is_reply.append(s.columns['text'][mask] != NO_TEXT)
+        latency.append(s.columns['latency'][mask])
+    if not groups:
+        return empty
+
+    groups = numpy.concatenate(groups).astype('i8')
+    days = numpy.concatenate(days)
+    is_reply = numpy.concatenate(is_reply)
+    latency = numpy.concatenate(latency)
+    if not len(groups):
+        return empty
+
+    # One entry per (group, day) asked, sorted by group then day, flagged
+    # when there was a reply that day
+    pairs = (groups << 32) | days
+    asked = numpy.unique(pairs[~is_reply])
+    replied = numpy.isin(asked, pairs[is_reply])
+    if not len(asked):
+        return empty
+
+    asked_groups = asked >> 32
+    starts = numpy.flatnonzero(numpy.r_[True, asked_groups[1:] !=
+                                        asked_groups[:-1]])
+    ends = numpy.r_[starts[1:], len(asked)] - 1
+
+    # Streaks: the distance to the last entry without a reply in the group
+    idx = numpy.arange(len(asked))
+    group_start = numpy.zeros(len(asked), dtype=bool)
+    group_start[starts] = True
+    last_miss = numpy.maximum.accumulate(numpy.where(
+        ~replied, idx, numpy.where(group_start, idx - 1, -1)))
+    runs = idx - last_miss
+
+    names = asked_groups[starts]
+    asked_counts = numpy.diff(numpy.r_[starts, len(asked)])
+    replied_counts = numpy.add.reduceat(replied.astype('i8'), starts)
+    best = numpy.maximum.reduceat(runs, starts)
+
+    reply_groups = groups[is_reply]
+    reply_latency = latency[is_reply].astype('f8')
+    lat_sum = numpy.bincount(reply_groups, weights=reply_latency,
+                             minlength=int(names.max()) + 1)
+    lat_count = numpy.bincount(reply_groups, minlength=int(names.max()) + 1)
+
+    result = []
+    for i, name in enumerate(names.tolist()):
+        count = lat_count[name] if name < len(lat_count) else 0
+        result.append({
+            'name': name,
+            'asked': int(asked_counts[i]),
+            'replied': int(replied_counts[i]),
+            'streak': int(runs[ends[i]]),
+            'best_streak': int(best[i]),
+            'latency_avg': float(lat_sum[name] / count) if count else None,
+        })
+
+    return {
+        'standups': len(numpy.unique(asked & 0xffffffff)),
+        'asked': len(asked),
+        'replied': int(replied.sum()),
+        'latency_median': float(numpy.median(reply_latency))
+        if len(reply_latency) else None,
+        'latency_p90': float(numpy.percentile(reply_latency, 90))
+        if len(reply_latency) else None,
+        'groups': result,
+    }
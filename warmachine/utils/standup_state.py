@@ -0,0 +1,278 @@
+import asyncio
+from collections import OrderedDict
+import heapq
+
+
+class PendingUser(object):
+    """
+    What the standup plugin knows about one user's standup.
+    """
+    __slots__ = ('user', 'channels', 'reply', 'reply_expires', 'pester')
+
+    def __init__(self, user):
+        self.user = user
+        # channels waiting for the user's reply, in the order they were asked
+        self.channels = OrderedDict()
+        # the user's standup message and the loop time it is forgotten
+        self.reply = None
+        self.reply_expires = None
+        # TimerHandle for asking the user again
+        self.pester = None
+
+    def cancel_pester(self):
+        if self.pester:
+            self.pester.cancel()
+            self.pester = None
+
+    def is_empty(self):
+        return not self.channels and self.reply is None and not self.pester
+
+    def as_dict(self):
+        return {
+            'for_channels': list(self.channels),
+            'standup_msg': self.reply,
+            'pester_task': self.pester,
+        }
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class StandupState(object):
+    """
+    Users the standup plugin is waiting on, indexed by user and by channel.
+
+    A user's reply is kept for ``reply_ttl`` seconds so standups later in the
+    day can reuse it. ``channel_ttl`` seconds after a channel's standup starts
+    the channel stops waiting for anyone who hasn't replied. Both expire from
+    a single timer for the earliest deadline rather than a timer per user.
+
+    Users are removed once they have no reply, no pending channel and no
+    pester scheduled, so memory only holds today's standups.
+    """
+    def __init__(self, reply_ttl=16*60*60, channel_ttl=8*60*60, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+
+        self.reply_ttl = reply_ttl
+        self.channel_ttl = channel_ttl
+
+        self.users = {}     # user -> PendingUser
+        self.channels = {}  # channel -> set of users the channel waits on
+        # channel -> loop time the channel stops waiting
+        self.channel_expires = {}
+
+        # (deadline, kind, key) entries. Entries made stale by a newer deadline
+        # are skipped when they come up.
+        self._deadlines = []
+        self._sweep_handle = None
+        self._sweep_at = None
+
+    def __contains__(self, user):
+        return user in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, user):
+        """
+        Returns:
+            PendingUser: the user's record or None
+        """
+        return self.users.get(user)
+
+    def reply(self, user):
+        """
+        Returns:
+            str: the user's standup message if they replied recently
+        """
+        record = self.users.get(user)
+        return record.reply if record else None
+
+    def pending(self, channel):
+        """
+        Returns:
+            set: users ``channel`` is waiting on
+        """
+        return set(self.channels.get(channel, ()))
+
+    def wait_for(self, user, channel):
+        """
+        Make ``channel`` wait for ``user``'s reply.
+
+        Returns:
+            PendingUser: the user's record
+        """
+        record = self.users.get(user)
+        if record is None:
+            record = self.users[user] = PendingUser(user)
+
+        record.channels[channel] = True
+        self.channels.setdefault(channel, set()).add(user)
+        return record
+
+    def set_reply(self, user, text):
+        """
+        Remember ``user``'s reply and stop waiting for it.
+
+        Returns:
+            list: the channels that were waiting for the reply, oldest first
+        """
+        record = self.users.get(user)
+        if record is None:
+            record = self.users[user] = PendingUser(user)
+
+        record.cancel_pester()
+        record.reply = text
+        record.reply_expires = self._loop.time() + self.reply_ttl
+        self._add_deadline(record.reply_expires, 'reply', user)
+
+        channels = list(record.channels)
+        for c in channels:
+            self._unindex(user, c)
+        record.channels.clear()
+
+        return channels
+
+    def start_channel(self, channel):
+        """
+        Start the clock on ``channel``'s standup. After ``channel_ttl`` seconds
+        it stops waiting for replies.
+        """
+        expires = self._loop.time() + self.channel_ttl
+        self.channel_expires[channel] = expires
+        self._add_deadline(expires, 'channel', channel)
+
+    def clear_channel(self, channel):
+        """
+        Stop ``channel`` waiting for anyone. Only the users it was waiting on
+        are touched.
+
+        Returns:
+            list: the users that were removed from the channel
+        """
+        self.channel_expires.pop(channel, None)
+        users = self.channels.pop(channel, set())
+
+        for u in users:
+            record = self.users[u]
+            record.channels.pop(channel, None)
+
+            # if that was the last channel, stop asking
+            if not record.channels:
+                record.cancel_pester()
+            self._discard_if_empty(record)
+
+        return list(users)
+
+    def forget_channels(self, channels):
+        """
+        Stop ``channels`` waiting for anyone, e.g. because their connection
+        went away. The users they were waiting on aren't asked again, and
+        users left waiting on no other channel are forgotten along with their
+        reply.
+
+        Returns:
+            list: the users that were forgotten
+        """
+        touched = set()
+        for channel in channels:
+            touched.update(self.clear_channel(channel))
+
+        forgotten = []
+        for u in touched:
+            record = self.users.get(u)
+            if record is None:
+                forgotten.append(u)
+                continue
+
+            # the pester may be bound to the channels' connection
+            record.cancel_pester()
+            if not record.channels:
+                del self.users[u]
+                forgotten.append(u)
+
+        return forgotten
+
+    def clear_reply(self, user):
+        record = self.users.get(user)
+        if record is None:
+            return
+
+        record.reply = None
+        record.reply_expires = None
+        self._discard_if_empty(record)
+
+    def clear(self):
+        """
+        Forget everything and cancel all pesters
+        """
+        for record in self.users.values():
+            record.cancel_pester()
+        self.users.clear()
+        self.channels.clear()
+        self.channel_expires.clear()
+        self._deadlines = []
+        self.stop()
+
+    def stop(self):
+        if self._sweep_handle:
+            self._sweep_handle.cancel()
+            self._sweep_handle = None
+            self._sweep_at = None
+
+    def _unindex(self, user, channel):
+        users = self.channels.get(channel)
+        if users is not None:
+            users.discard(user)
+            if not users:
+                del self.channels[channel]
+
+    def _discard_if_empty(self, record):
+        if record.is_empty():
+            self.users.pop(record.user, None)
+
+    def _add_deadline(self, deadline, kind, key):
+        heapq.heappush(self._deadlines, (deadline, kind, key))
+
+        if self._sweep_at is None or deadline < self._sweep_at:
+            self._schedule_sweep(deadline)
+
+    def _schedule_sweep(self, deadline):
+        if self._sweep_handle:
+            self._sweep_handle.cancel()
+        self._sweep_at = deadline
+        self._sweep_handle = self._loop.call_at(deadline, self.sweep)
+
+    def sweep(self):
+        """
+        Expire everything whose deadline has passed and schedule the next
+        sweep.
+        """
+        self._sweep_handle = None
+        self._sweep_at = None
+
+        now = self._loop.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, kind, key = heapq.heappop(self._deadlines)
+
+            if kind == 'reply':
+                record = self.users.get(key)
+                if record and record.reply_expires == deadline:
+                    self.clear_reply(key)
+
+            elif kind == 'channel':
+                if self.channel_expires.get(key) == deadline:
+                    self.clear_channel(key)
+
+        if self._deadlines:
+            self._schedule_sweep(self._deadlines[0][0])
+
+    def as_dict(self):
+        return {u: r.as_dict() for u, r in self.users.items()}
+
+    def stats(self):
+        return {
+            'users': len(self.users),
+            'channels': len(self.channels),
+            'deadlines': len(self._deadlines),
+        }
@@ -0,0 +1,53 @@
+import asyncio
+import selectors
+
+
+class _VirtualSelector(object):
+    """
+    Wraps a real selector. Instead of sleeping until the next timer is due the
+    loop's clock is moved forward to it.
+    """
+    def __init__(self, loop, selector):
+        self._loop = loop
+        self._selector = selector
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if not events and timeout:
+            self._loop.advance(timeout)
+        return events
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop whose clock only moves when there is nothing to do. Whenever
+    every task is waiting on a timer the clock jumps straight to the next one,
+    so days of timers run in as long as the callbacks take.
+
+    Real I/O still works but doesn't advance the clock, so this is only
+    useful with fake connections.
+    """
+    def __init__(self, start=0.0):
+        self._virtual_time = start
+        super().__init__(selector=_VirtualSelector(
+            self, selectors.DefaultSelector()))
+
+    def time(self):
+        return self._virtual_time
+
+    def advance(self, seconds):
+        """
+        Move the clock forward
+        """
+        self._virtual_time += seconds
+
+    def timer_count(self):
+        """
+        Returns:
+            int: the number of scheduled timers, including cancelled ones not
+                yet removed
+        """
+        return len(self._scheduled)